@@ -0,0 +1,212 @@
+import json
+import sqlite3
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+from loguru import logger
+from useful_tools import iter_json_array_items
+
+# 可以用来排序的列
+ORDER_BY_COLUMNS = {
+    "create_time",
+    "digg_count",
+    "comment_count",
+    "share_count",
+    "collect_count",
+    "play_count",
+    "duration",
+    "video_data_size",
+}
+
+
+def first_url(obj: Dict[str, Any] | None) -> str | None:
+    url_list = (obj or {}).get("url_list") or []
+    return url_list[0] if url_list else None
+
+
+def normalize_aweme(aweme: Dict[str, Any]) -> Dict[str, Any]:
+    """从接口返回的原始作品数据中取出需要查询的字段"""
+    author = aweme.get("author") or {}
+    statistics = aweme.get("statistics") or {}
+    video = aweme.get("video") or {}
+    play_addr = video.get("play_addr") or {}
+    return {
+        "aweme_id": aweme.get("aweme_id"),
+        "author_uid": author.get("uid"),
+        "author_sec_uid": author.get("sec_uid"),
+        "author_nickname": author.get("nickname"),
+        "description": aweme.get("desc"),
+        "create_time": aweme.get("create_time"),
+        "digg_count": statistics.get("digg_count"),
+        "comment_count": statistics.get("comment_count"),
+        "share_count": statistics.get("share_count"),
+        "collect_count": statistics.get("collect_count"),
+        "play_count": statistics.get("play_count"),
+        "duration": video.get("duration"),
+        "video_url": first_url(play_addr),
+        "video_data_size": play_addr.get("data_size"),
+        "cover_url": first_url(video.get("cover")),
+        "music_url": first_url((aweme.get("music") or {}).get("play_url")),
+    }
+
+
+class AwemeCatalog:
+    """
+    所有用户作品的本地索引(SQLite), 保存在数据目录下
+    每个作品一行, 常用字段单独成列并建索引, 原始作品数据保存在data列,
+    不需要读取所有aweme.json就可以按条件筛选/排序作品
+    """
+
+    def __init__(self, data_dir: str | Path, filename: str = "catalog.sqlite3"):
+        assert isinstance(data_dir, (str, Path)), "data_dir must be a string or Path"
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.data_dir / filename
+        self.conn = sqlite3.connect(self.db_path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS awemes (
+                aweme_id TEXT PRIMARY KEY,
+                user_dir TEXT,
+                author_uid TEXT,
+                author_sec_uid TEXT,
+                author_nickname TEXT,
+                description TEXT,
+                create_time INTEGER,
+                digg_count INTEGER,
+                comment_count INTEGER,
+                share_count INTEGER,
+                collect_count INTEGER,
+                play_count INTEGER,
+                duration INTEGER,
+                video_url TEXT,
+                video_data_size INTEGER,
+                cover_url TEXT,
+                music_url TEXT,
+                data TEXT
+            );
+            CREATE INDEX IF NOT EXISTS idx_awemes_create_time ON awemes(create_time);
+            CREATE INDEX IF NOT EXISTS idx_awemes_digg_count ON awemes(digg_count);
+            CREATE INDEX IF NOT EXISTS idx_awemes_author_uid ON awemes(author_uid);
+            CREATE INDEX IF NOT EXISTS idx_awemes_user_dir ON awemes(user_dir);
+            """)
+        self.conn.commit()
+
+    def upsert_awemes(
+        self,
+        awemes: Iterable[Dict[str, Any]],
+        user_dir: str | Path,
+        batch_size: int = 1000,
+    ) -> int:
+        """写入或更新作品, user_dir是aweme.json所在目录"""
+        user_dir = Path(user_dir)
+        try:
+            user_dir_key = user_dir.relative_to(self.data_dir).as_posix()
+        except ValueError:
+            user_dir_key = user_dir.as_posix()
+        count = 0
+        rows = []
+        for aweme in awemes:
+            if not aweme.get("aweme_id"):
+                continue
+            record = normalize_aweme(aweme)
+            record["user_dir"] = user_dir_key
+            record["data"] = json.dumps(aweme, ensure_ascii=False)
+            rows.append(record)
+            # 分批写入, 作品很多时内存占用不会一直增长
+            if len(rows) >= batch_size:
+                count += self._insert_rows(rows)
+                rows = []
+        count += self._insert_rows(rows)
+        return count
+
+    def _insert_rows(self, rows: List[Dict[str, Any]]) -> int:
+        if not rows:
+            return 0
+        columns = list(rows[0].keys())
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO awemes ({', '.join(columns)})"
+            f" VALUES ({', '.join(':' + column for column in columns)})",
+            rows,
+        )
+        self.conn.commit()
+        return len(rows)
+
+    def upsert_aweme_jsons(
+        self, jsons: Iterable[Dict[str, Any]], user_dir: str | Path
+    ) -> int:
+        """写入aweme.json格式(接口原始响应列表)的数据"""
+        return self.upsert_awemes(
+            (aweme for obj in jsons for aweme in obj.get("aweme_list") or []),
+            user_dir,
+        )
+
+    def iter_awemes(
+        self,
+        since: int | float | None = None,
+        until: int | float | None = None,
+        authors: Iterable[str] | None = None,
+        min_digg_count: int | None = None,
+        order_by: str = "create_time",
+        descending: bool = True,
+        limit: int | None = None,
+    ) -> Iterator[Tuple[Path, Dict[str, Any]]]:
+        """
+        按条件查询作品, 返回(aweme.json所在目录, 原始作品数据)
+        since/until: 发布时间范围(时间戳); authors: 作者uid/sec_uid/昵称
+        例如 最近一周点赞最多的100个作品:
+        iter_awemes(since=time.time() - 7 * 86400, order_by="digg_count", limit=100)
+        """
+        assert (
+            order_by in ORDER_BY_COLUMNS
+        ), f"order_by must be one of {ORDER_BY_COLUMNS}"
+        conditions, params = [], []
+        if since is not None:
+            conditions.append("create_time >= ?")
+            params.append(int(since))
+        if until is not None:
+            conditions.append("create_time < ?")
+            params.append(int(until))
+        if authors:
+            authors = list(authors)
+            placeholders = ", ".join("?" * len(authors))
+            conditions.append(
+                f"(author_uid IN ({placeholders}) OR author_sec_uid IN ({placeholders})"
+                f" OR author_nickname IN ({placeholders}))"
+            )
+            params.extend(authors * 3)
+        if min_digg_count is not None:
+            conditions.append("digg_count >= ?")
+            params.append(min_digg_count)
+        sql = "SELECT user_dir, data FROM awemes"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += f" ORDER BY {order_by} {'DESC' if descending else 'ASC'}"
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(int(limit))
+        for user_dir, data in self.conn.execute(sql, params):
+            yield self.data_dir / user_dir, json.loads(data)
+
+    def count(self) -> int:
+        return self.conn.execute("SELECT COUNT(*) FROM awemes").fetchone()[0]
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def rebuild_catalog(data_save_path: str | Path = "data") -> int:
+    """从已有的aweme.json文件建立索引"""
+    catalog = AwemeCatalog(data_save_path)
+    count = 0
+    try:
+        for json_file in Path(data_save_path).glob("**/aweme.json"):
+            with open(json_file, "r", encoding="utf-8") as f:
+                count += catalog.upsert_aweme_jsons(
+                    iter_json_array_items(f), json_file.parent
+                )
+            logger.info(f"indexed {json_file.as_posix()}")
+    finally:
+        catalog.close()
+    logger.success(f"catalog rebuilt: {count} awemes")
+    return count
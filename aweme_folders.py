@@ -0,0 +1,77 @@
+import os
+import re
+from pathlib import Path
+from loguru import logger
+from download_manifest import DownloadManifest
+
+# 作品目录名: {sanitized_desc}-{aweme_id}-{formatted_digg_count_str}, desc中也可能有"-"
+AWEME_FOLDER_PATTERN = re.compile(r"-(\d+)-[^-]*$")
+
+
+class AwemeFolderIndex:
+    """
+    按aweme_id查找用户目录下已经存在的作品目录
+    目录名中的点赞数(以及作者修改后的描述)在两次抓取之间会变化, 目录名变了但作品没有变,
+    这时把旧目录重命名为新的名字, 描述变化时目录中以描述命名的文件也一起重命名,
+    清单中的路径一起更新, 已下载的文件不会重新下载;
+    每个用户目录只在第一次用到时扫描一次
+    """
+
+    def __init__(self, manifest: DownloadManifest | None = None):
+        self.manifest = manifest
+        self.renamed = 0
+        self._folders: dict[Path, dict[str, str]] = {}
+
+    def folders_of(self, user_dir: Path) -> dict[str, str]:
+        """返回{aweme_id: 目录名}"""
+        if user_dir not in self._folders:
+            folders = {}
+            if user_dir.is_dir():
+                with os.scandir(user_dir) as entries:
+                    for entry in entries:
+                        match = AWEME_FOLDER_PATTERN.search(entry.name)
+                        if match and entry.is_dir():
+                            folders[match.group(1)] = entry.name
+            self._folders[user_dir] = folders
+        return self._folders[user_dir]
+
+    def resolve(self, user_dir: Path, aweme_id: str, folder_name: str) -> Path:
+        """返回作品目录, 同一个aweme_id的旧目录存在时重命名为folder_name"""
+        folders = self.folders_of(user_dir)
+        existing = folders.get(str(aweme_id))
+        folder = user_dir / folder_name
+        if existing and existing != folder_name and not folder.exists():
+            try:
+                os.rename(user_dir / existing, folder)
+            except OSError as e:
+                # 重命名失败时继续使用旧目录, 也不会重新下载
+                logger.warning(f"Failed to rename {existing} to {folder_name}: {e}")
+                return user_dir / existing
+            if self.manifest is not None:
+                self.manifest.rename_dir(user_dir / existing, folder)
+            old_desc = existing[: AWEME_FOLDER_PATTERN.search(existing).start()]
+            new_desc = folder_name[: AWEME_FOLDER_PATTERN.search(folder_name).start()]
+            if old_desc != new_desc:
+                self.rename_desc_files(folder, old_desc, new_desc)
+            self.renamed += 1
+            logger.info(f"renamed aweme folder: {existing} -> {folder_name}")
+        folders[str(aweme_id)] = folder_name
+        return folder
+
+    def rename_desc_files(self, folder: Path, old_desc: str, new_desc: str) -> None:
+        """视频/音乐/图片文件名是{desc}.mp4, {desc}_{index}.mp4等, 把文件名中的旧描述换成新的"""
+        for file_path in folder.glob("*/*"):
+            name = file_path.name
+            rest = name[len(old_desc) :]
+            if not name.startswith(old_desc) or rest[:1] not in (".", "_"):
+                continue
+            new_path = file_path.with_name(new_desc + rest)
+            if new_path.exists():
+                continue
+            try:
+                os.rename(file_path, new_path)
+            except OSError as e:
+                logger.warning(f"Failed to rename {file_path.as_posix()}: {e}")
+                continue
+            if self.manifest is not None:
+                self.manifest.rename_file(file_path, new_path)
@@ -0,0 +1,137 @@
+"""
+对比读取aweme.json时的峰值内存(RSS)
+旧实现: json.load整个文件, 再把所有作品放进列表
+新实现: iter_json_array_items逐页流式解析, 作品处理完即可释放
+
+python benchmarks/bench_aweme_json_memory.py --awemes 100000
+"""
+
+import argparse
+import json
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+PAGE_SIZE = 18
+
+
+def make_aweme(aweme_id: int) -> dict:
+    cdn = f"https://v{aweme_id % 30}-web.douyinvod.com/{aweme_id:x}"
+    return {
+        "aweme_id": str(7000000000000000000 + aweme_id),
+        "desc": f"作品描述 {aweme_id} #话题" * 3,
+        "create_time": 1700000000 + aweme_id,
+        "author": {
+            "uid": "1234567890",
+            "sec_uid": "MS4wLjABAAAA" + "x" * 40,
+            "nickname": "用户昵称",
+        },
+        "statistics": {
+            "digg_count": random.randint(0, 10**6),
+            "comment_count": random.randint(0, 10**4),
+            "share_count": random.randint(0, 10**4),
+            "collect_count": random.randint(0, 10**4),
+        },
+        "video": {
+            "duration": random.randint(5000, 300000),
+            "play_addr": {
+                "url_list": [f"{cdn}/play/{i}?a=6383&br=1024" for i in range(3)],
+                "data_size": random.randint(10**6, 10**8),
+            },
+            "cover": {"url_list": [f"{cdn}/cover/{i}.jpeg" for i in range(3)]},
+            "bit_rate": [
+                {
+                    "gear_name": f"normal_{q}_0",
+                    "bit_rate": q * 1000,
+                    "play_addr": {
+                        "url_list": [f"{cdn}/{q}/{i}?br={q}" for i in range(3)]
+                    },
+                }
+                for q in (540, 720, 1080)
+            ],
+        },
+        "music": {"play_url": {"url_list": [f"{cdn}/music.mp3"]}},
+    }
+
+
+def write_aweme_json(path: Path, awemes: int) -> None:
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("[")
+        for page, start in enumerate(range(0, awemes, PAGE_SIZE)):
+            obj = {
+                "status_code": 0,
+                "has_more": 1,
+                "max_cursor": start,
+                "aweme_list": [
+                    make_aweme(i) for i in range(start, min(start + PAGE_SIZE, awemes))
+                ],
+            }
+            f.write(("," if page else "") + json.dumps(obj, ensure_ascii=False))
+        f.write("]")
+
+
+def run_legacy(path: Path) -> int:
+    with open(path, "r", encoding="utf-8") as f:
+        load_json_objs = json.load(f)
+    awemes = []
+    for obj in load_json_objs:
+        awemes.extend(obj.get("aweme_list") or [])
+    return sum(1 for aweme in awemes if aweme.get("desc") and aweme.get("aweme_id"))
+
+
+def run_streaming(path: Path) -> int:
+    from download_videos import iter_aweme_json_tree
+
+    return sum(1 for _ in iter_aweme_json_tree(path.parent))
+
+
+def measure(mode: str, path: Path) -> None:
+    """在子进程中运行, 打印作品数, 耗时和峰值RSS"""
+    start = time.perf_counter()
+    count = (run_legacy if mode == "legacy" else run_streaming)(path)
+    elapsed = time.perf_counter() - start
+    # Linux下ru_maxrss单位是KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(json.dumps({"count": count, "seconds": elapsed, "peak_rss_mb": peak_rss}))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--awemes", type=int, default=100000)
+    parser.add_argument("--measure", choices=["legacy", "streaming"])
+    parser.add_argument("--path", type=Path)
+    args = parser.parse_args()
+    if args.measure:
+        measure(args.measure, args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / "user_1" / "aweme.json"
+        path.parent.mkdir()
+        write_aweme_json(path, args.awemes)
+        print(
+            f"aweme.json: {args.awemes} awemes, {path.stat().st_size / 1024 / 1024:.1f}MB"
+        )
+        for mode in ("legacy", "streaming"):
+            # 每种实现单独一个进程, 峰值RSS互不影响
+            output = subprocess.run(
+                [sys.executable, __file__, "--measure", mode, "--path", str(path)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(
+                f"{mode:>9}: {result['count']} awemes, {result['seconds']:.2f}s, "
+                f"peak RSS {result['peak_rss_mb']:.1f}MB"
+            )
+
+
+if __name__ == "__main__":
+    main()
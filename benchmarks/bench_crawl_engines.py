@@ -0,0 +1,60 @@
+"""
+对比滚动页面(scroll)和接口翻页(api)两种抓取方式的单个用户耗时
+需要已经登录过(项目根目录下有state.json), 会访问抖音
+
+python benchmarks/bench_crawl_engines.py users.txt --rounds 1
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from playwright.async_api import async_playwright
+from playwright_dy import parse_home_page
+
+
+async def crawl_once(context, user_home_url: str, crawl_engine: str) -> tuple:
+    page = await context.new_page()
+    try:
+        start_time = time.perf_counter()
+        data = await parse_home_page(
+            page, user_home_url, True, crawl_engine=crawl_engine
+        )
+        elapsed = time.perf_counter() - start_time
+    finally:
+        await page.close()
+    aweme_count = sum(len(obj.get("aweme_list") or []) for obj in data["jsons"])
+    return elapsed, aweme_count
+
+
+async def main(user_home_urls: list[str], rounds: int) -> None:
+    assert os.path.exists("state.json"), "请先运行一次main.py登录, 生成state.json"
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True, args=["--disable-gpu"])
+        context = await browser.new_context(storage_state="state.json")
+        for user_home_url in user_home_urls:
+            for crawl_engine in ["scroll", "api"]:
+                for _ in range(rounds):
+                    elapsed, aweme_count = await crawl_once(
+                        context, user_home_url, crawl_engine
+                    )
+                    print(
+                        f"{crawl_engine:>6}: {elapsed:7.2f}s, {aweme_count} awemes, "
+                        f"{aweme_count / elapsed:7.1f} awemes/s  {user_home_url}"
+                    )
+        await browser.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("users_file", help="用户主页链接文件, 每行一个链接")
+    parser.add_argument("--rounds", type=int, default=1)
+    args = parser.parse_args()
+    with open(args.users_file, "r", encoding="utf-8") as f:
+        urls = [line.strip() for line in f if line.strip().startswith("http")]
+    asyncio.run(main(urls, args.rounds))
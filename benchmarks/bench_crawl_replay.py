@@ -0,0 +1,122 @@
+"""
+可回放的离线抓取基准测试
+先录制一次真实的用户主页会话(需要登录和网络), 之后用本地Chromium从HAR回放, 不访问网络,
+统计打开主页(含match_*选择器), 翻页抓取和响应捕获的耗时, 并换算成每1000个作品的耗时;
+选择器读不到用户信息或者没有捕获到作品数据时报错, 用来发现页面改版导致的选择器失效
+
+录制: python benchmarks/bench_crawl_replay.py record fixtures/profile.har URL --engine scroll
+回放: python benchmarks/bench_crawl_replay.py replay fixtures/profile.har URL --rounds 3
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from loguru import logger
+from playwright.async_api import async_playwright
+from crawl_replay import CrawlReplay
+from playwright_dy import parse_home_page, print_aweme_responses
+
+
+async def record(har_path: str, user_home_urls: list[str], crawl_engine: str) -> None:
+    # 和正常抓取走同一套流程, 只是上下文的请求会被录制到HAR
+    datas = await print_aweme_responses(
+        user_home_urls,
+        headless=True,
+        crawl_engine=crawl_engine,
+        max_pages=1,
+        replay=CrawlReplay(har_path, "record"),
+    )
+    for data in datas:
+        aweme_count = sum(len(obj.get("aweme_list") or []) for obj in data["jsons"])
+        print(
+            f"recorded {data['name']}: {len(data['jsons'])} pages, {aweme_count} awemes"
+        )
+
+
+async def replay_once(context, user_home_url: str, crawl_engine: str) -> dict:
+    page = await context.new_page()
+    try:
+        start_time = time.perf_counter()
+        data = await parse_home_page(
+            page, user_home_url, True, crawl_engine=crawl_engine
+        )
+        elapsed = time.perf_counter() - start_time
+    finally:
+        await page.close()
+    aweme_count = sum(len(obj.get("aweme_list") or []) for obj in data["jsons"])
+    problems = [
+        name
+        for name, ok in (
+            ("douyin_number", bool(data["douyin_number"])),
+            ("name", bool(data["name"])),
+            ("expected_works_count", str(data["expected_works_count"]).isdigit()),
+            ("aweme pages", bool(data["jsons"])),
+        )
+        if not ok
+    ]
+    return {
+        "elapsed": elapsed,
+        "load": data["timings"]["load"],
+        "crawl": data["timings"]["crawl"],
+        "pages": len(data["jsons"]),
+        "awemes": aweme_count,
+        "expected": data["expected_works_count"],
+        "problems": problems,
+    }
+
+
+async def replay(
+    har_path: str, user_home_urls: list[str], crawl_engine: str, rounds: int
+) -> int:
+    failed = 0
+    async with async_playwright() as p:
+        browser = await p.chromium.launch(headless=True, args=["--disable-gpu"])
+        context = await browser.new_context()
+        crawl_replay = CrawlReplay(har_path, "replay")
+        await crawl_replay.attach(context)
+        for user_home_url in user_home_urls:
+            for _ in range(rounds):
+                result = await replay_once(context, user_home_url, crawl_engine)
+                per_1k = result["crawl"] / max(result["awemes"], 1) * 1000
+                print(
+                    f"{crawl_engine:>6}: total {result['elapsed']:6.2f}s, "
+                    f"load {result['load']:5.2f}s, crawl {result['crawl']:6.2f}s, "
+                    f"{result['pages']} pages, {result['awemes']}/{result['expected']} awemes, "
+                    f"{per_1k:.2f}s per 1k works  {user_home_url}"
+                )
+                if result["problems"]:
+                    failed += 1
+                    print(f"  selector check failed: {', '.join(result['problems'])}")
+        print(
+            f"replayed aweme/post pages: {crawl_replay.replayed}, "
+            f"missing from HAR: {crawl_replay.missed}"
+        )
+        await browser.close()
+    return failed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("har", help="HAR文件路径")
+    parser.add_argument("urls", nargs="+", help="用户主页链接")
+    parser.add_argument("--engine", choices=["scroll", "api"], default="scroll")
+    parser.add_argument("--rounds", type=int, default=1)
+    args = parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    if args.mode == "record":
+        asyncio.run(record(args.har, args.urls, args.engine))
+    else:
+        failed = asyncio.run(replay(args.har, args.urls, args.engine, args.rounds))
+        sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
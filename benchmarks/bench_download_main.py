@@ -0,0 +1,185 @@
+"""
+download_main离线基准测试
+在子进程中启动本地模拟CDN(fake_cdn.py), 生成合成的aweme.json目录(1k~100k个作品),
+运行download_main并报告: 墙钟时间, 吞吐(MB/s, 文件/s), 峰值RSS, 事件循环延迟
+
+python benchmarks/bench_download_main.py --items 1000
+python benchmarks/bench_download_main.py --items 10000 --video-kb 64 --latency-ms 20 \
+    --bandwidth-mbps 200 --disconnect-rate 0.01 --throttle-every 500 --throttle-burst 20
+python benchmarks/bench_download_main.py --items 1000 --race-mirrors --segments 4
+python benchmarks/bench_download_main.py --items 10000 --processes 4
+"""
+
+import argparse
+import asyncio
+import json
+import multiprocessing
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import aiohttp
+from loguru import logger
+from fake_cdn import FakeCDNConfig, run_server, write_aweme_tree
+
+
+class LoopLagMonitor:
+    """每interval秒醒来一次, 实际醒来时间比预期晚多少就是事件循环延迟"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list[float] = []
+        self._task: asyncio.Task | None = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(loop.time() - expected, 0.0))
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    def summary(self) -> str:
+        if not self.samples:
+            return "no samples"
+        samples = sorted(self.samples)
+        p99 = samples[min(int(len(samples) * 0.99), len(samples) - 1)]
+        return (
+            f"mean {sum(samples) / len(samples) * 1000:.1f}ms, "
+            f"p99 {p99 * 1000:.1f}ms, max {samples[-1] * 1000:.1f}ms"
+        )
+
+
+async def wait_for_server(port: int) -> None:
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/stats"):
+                    return
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+    raise RuntimeError("fake CDN did not start")
+
+
+async def server_stats(port: int) -> dict:
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"http://127.0.0.1:{port}/stats") as response:
+            return await response.json()
+
+
+async def run_benchmark(args: argparse.Namespace, data_path: Path) -> None:
+    from download_videos import download_main
+
+    await wait_for_server(args.port)
+    monitor = LoopLagMonitor()
+    monitor.start()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    await download_main(
+        data_save_path=data_path,
+        download_quality=None if args.race_mirrors else -1,
+        workers=args.workers,
+        segments=args.segments,
+        race_mirrors=args.race_mirrors,
+        use_manifest=not args.no_manifest,
+        processes=args.processes,
+    )
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    await monitor.stop()
+
+    metrics = json.loads((data_path / "run_metrics.json").read_text(encoding="utf-8"))
+    failures_path = data_path / "failures.json"
+    failures = (
+        len(json.loads(failures_path.read_text(encoding="utf-8")))
+        if failures_path.exists()
+        else 0
+    )
+    cdn = await server_stats(args.port)
+    # Linux下ru_maxrss单位是KB
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    megabytes = metrics["bytes_downloaded"] / 1024 / 1024
+    print(
+        f"\nitems: {args.items}, files: {metrics['files_completed']}, failed: {failures}\n"
+        f"wall: {wall:.2f}s, cpu: {cpu:.2f}s\n"
+        f"throughput: {megabytes / wall:.1f} MB/s, "
+        f"{metrics['files_completed'] / wall:.1f} files/s\n"
+        f"peak RSS: {peak_rss:.1f}MB\n"
+        f"event loop lag: {monitor.summary()}\n"
+        f"ttfb p50/p99: {metrics['ttfb_seconds']['p50']}/{metrics['ttfb_seconds']['p99']}s, "
+        f"retries: {metrics['retries_by_cause']}\n"
+        f"fake CDN: {cdn}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--items", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--video-kb", type=int, default=256)
+    parser.add_argument("--cover-kb", type=int, default=16)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--disconnect-rate", type=float, default=0)
+    parser.add_argument("--throttle-every", type=int, default=0)
+    parser.add_argument("--throttle-burst", type=int, default=0)
+    parser.add_argument("--throttle-status", type=int, default=429)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--segments", type=int, default=1)
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument("--race-mirrors", action="store_true")
+    parser.add_argument("--no-manifest", action="store_true")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--keep", action="store_true", help="保留生成的数据目录")
+    args = parser.parse_args()
+
+    # 每个作品一行日志会明显拖慢大规模测试, 只保留警告
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+
+    config = FakeCDNConfig(
+        bandwidth=args.bandwidth_mbps * 1024 * 1024 / 8,
+        latency=args.latency_ms / 1000,
+        disconnect_rate=args.disconnect_rate,
+        throttle_every=args.throttle_every,
+        throttle_burst=args.throttle_burst,
+        throttle_status=args.throttle_status,
+    )
+    server = multiprocessing.Process(
+        target=run_server, args=(args.port, config), daemon=True
+    )
+    server.start()
+    data_path = Path(tempfile.mkdtemp(prefix="bench_download_"))
+    try:
+        start = time.perf_counter()
+        write_aweme_tree(
+            data_path,
+            args.items,
+            args.port,
+            users=args.users,
+            video_size=args.video_kb * 1024,
+            cover_size=args.cover_kb * 1024,
+        )
+        print(f"generated {args.items} awemes in {time.perf_counter() - start:.2f}s")
+        asyncio.run(run_benchmark(args, data_path))
+    finally:
+        server.terminate()
+        if args.keep:
+            print(f"data kept in {data_path}")
+        else:
+            shutil.rmtree(data_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
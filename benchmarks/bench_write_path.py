@@ -0,0 +1,115 @@
+"""
+对比download_file_async写盘路径改造前后的吞吐
+旧实现: 每次read(1024) + 事件循环内同步写盘 + 每块刷新进度条
+新实现: stream_response_to_file (iter_any + 合并缓冲写盘到线程池 + 限频进度条)
+
+python benchmarks/bench_write_path.py --size-mb 100 --rounds 3
+"""
+
+import argparse
+import asyncio
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import aiohttp
+from aiohttp import web
+from tqdm import tqdm
+from download_videos import stream_response_to_file
+
+PAYLOAD_BLOCK = os.urandom(1024 * 1024)
+
+
+async def handle_blob(request: web.Request) -> web.StreamResponse:
+    size = int(request.query.get("size", 1024 * 1024))
+    response = web.StreamResponse(
+        headers={"Content-Type": "video/mp4", "Content-Length": str(size)}
+    )
+    await response.prepare(request)
+    sent = 0
+    while sent < size:
+        block = PAYLOAD_BLOCK[: min(len(PAYLOAD_BLOCK), size - sent)]
+        await response.write(block)
+        sent += len(block)
+    await response.write_eof()
+    return response
+
+
+def run_server(port: int) -> None:
+    app = web.Application()
+    app.router.add_get("/blob", handle_blob)
+    web.run_app(app, host="127.0.0.1", port=port, print=None)
+
+
+async def legacy_stream(response, file_path, file_mode, bar):
+    with open(file_path, file_mode) as file:
+        while True:
+            chunk = await response.content.read(1024)
+            if not chunk:
+                break
+            downloaded_size = file.write(chunk)
+            bar.update(downloaded_size)
+            bar.refresh()
+
+
+async def new_stream(response, file_path, file_mode, bar):
+    await stream_response_to_file(response, file_path, file_mode, bar)
+
+
+async def measure(stream_func, url: str, size: int, devnull) -> tuple[float, float]:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = Path(tmp_dir) / "bench.mp4"
+        async with aiohttp.ClientSession() as session:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            async with session.get(url) as response:
+                bar = tqdm(total=size, unit="iB", unit_scale=True, file=devnull)
+                await stream_func(response, file_path, "wb", bar)
+                bar.close()
+            wall, cpu = (
+                time.perf_counter() - wall_start,
+                time.process_time() - cpu_start,
+            )
+        assert file_path.stat().st_size == size, "incomplete download"
+    return wall, cpu
+
+
+async def main(size_mb: int, rounds: int, port: int) -> None:
+    size = size_mb * 1024 * 1024
+    url = f"http://127.0.0.1:{port}/blob?size={size}"
+    async with aiohttp.ClientSession() as session:
+        for _ in range(50):
+            try:
+                async with session.get(f"http://127.0.0.1:{port}/blob?size=1"):
+                    break
+            except aiohttp.ClientConnectionError:
+                await asyncio.sleep(0.1)
+    with open(os.devnull, "w") as devnull:
+        for name, stream_func in [("legacy", legacy_stream), ("new", new_stream)]:
+            results = [
+                await measure(stream_func, url, size, devnull) for _ in range(rounds)
+            ]
+            wall = min(r[0] for r in results)
+            cpu = min(r[1] for r in results)
+            print(
+                f"{name:>6}: {size_mb / wall:8.1f} MB/s wall, "
+                f"{size_mb / cpu:8.1f} MB/s per core (cpu {cpu:.2f}s, wall {wall:.2f}s)"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size-mb", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8799)
+    args = parser.parse_args()
+    server = multiprocessing.Process(target=run_server, args=(args.port,), daemon=True)
+    server.start()
+    try:
+        asyncio.run(main(args.size_mb, args.rounds, args.port))
+    finally:
+        server.terminate()
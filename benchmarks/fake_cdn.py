@@ -0,0 +1,258 @@
+"""
+本地模拟CDN, 给离线基准测试使用, 不需要访问抖音
+
+/media/{aweme_id}/{name}?size=字节数  返回确定性的合成数据, content-type按后缀决定
+支持Range(206/416), 可以配置带宽, 首字节延迟, 中途断开的概率, 以及周期性的429/403突发
+/stats 返回服务端统计(请求数, 各状态码次数, 发送字节数)
+
+python benchmarks/fake_cdn.py --port 8800 --bandwidth-mbps 50 --latency-ms 20
+"""
+
+import argparse
+import asyncio
+import json
+import random
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from aiohttp import web
+
+CONTENT_TYPES = {
+    ".mp4": "video/mp4",
+    ".mp3": "audio/mpeg",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".webp": "image/webp",
+}
+
+BLOCK_SIZE = 64 * 1024
+
+
+@dataclass
+class FakeCDNConfig:
+    # 每个响应的带宽(字节/秒), 0表示不限速
+    bandwidth: float = 0
+    # 返回响应头之前的延迟(秒)
+    latency: float = 0
+    # 每个响应中途断开的概率
+    disconnect_rate: float = 0
+    # 每throttle_every个请求中, 连续throttle_burst个请求返回throttle_status
+    throttle_every: int = 0
+    throttle_burst: int = 0
+    throttle_status: int = 429
+    retry_after: float = 1
+    seed: int = 0
+
+
+@dataclass
+class FakeCDNStats:
+    requests: int = 0
+    bytes_sent: int = 0
+    statuses: Counter = field(default_factory=Counter)
+    disconnects: int = 0
+
+
+def synthetic_block(key: str) -> bytes:
+    # 同一个文件每次返回相同的数据, 续传/分段下载可以拼出完整文件
+    return random.Random(key).randbytes(BLOCK_SIZE)
+
+
+def synthetic_bytes(block: bytes, start: int, end: int) -> bytes:
+    """返回合成文件[start, end)区间的数据"""
+    offset = start % BLOCK_SIZE
+    data = bytearray()
+    while len(data) < end - start:
+        data += block[offset:]
+        offset = 0
+    return bytes(data[: end - start])
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """返回[start, end)区间, 不合法时返回None"""
+    try:
+        unit, spec = range_header.split("=", 1)
+        start_text, end_text = spec.split(",")[0].strip().split("-", 1)
+        if unit.strip() != "bytes":
+            return None
+        if not start_text:
+            return max(size - int(end_text), 0), size
+        start = int(start_text)
+        end = min(int(end_text) + 1, size) if end_text else size
+        return start, end
+    except ValueError:
+        return None
+
+
+def create_app(config: FakeCDNConfig) -> web.Application:
+    stats = FakeCDNStats()
+    rng = random.Random(config.seed)
+
+    async def handle_media(request: web.Request) -> web.StreamResponse:
+        stats.requests += 1
+        if config.latency:
+            await asyncio.sleep(config.latency)
+        if (
+            config.throttle_every
+            and stats.requests % config.throttle_every < config.throttle_burst
+        ):
+            stats.statuses[config.throttle_status] += 1
+            return web.Response(
+                status=config.throttle_status,
+                headers={"Retry-After": str(config.retry_after)},
+            )
+
+        name = request.match_info["name"]
+        size = int(request.query.get("size", 1024 * 1024))
+        content_type = CONTENT_TYPES.get(Path(name).suffix, "application/octet-stream")
+        start, end = 0, size
+        headers = {"Content-Type": content_type, "Accept-Ranges": "bytes"}
+        status = 200
+        if "Range" in request.headers:
+            byte_range = parse_range(request.headers["Range"], size)
+            if byte_range is None or byte_range[0] >= size:
+                stats.statuses[416] += 1
+                return web.Response(
+                    status=416, headers={"Content-Range": f"bytes */{size}"}
+                )
+            start, end = byte_range
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        headers["Content-Length"] = str(end - start)
+        stats.statuses[status] += 1
+
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        block = synthetic_block(request.path)
+        disconnect_at = (
+            rng.randint(start, end - 1)
+            if end > start and rng.random() < config.disconnect_rate
+            else None
+        )
+        position = start
+        chunk_size = (
+            BLOCK_SIZE
+            if not config.bandwidth
+            else max(int(config.bandwidth / 20), 1024)
+        )
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        while position < end:
+            chunk_end = min(position + chunk_size, end)
+            if disconnect_at is not None and chunk_end > disconnect_at:
+                await response.write(synthetic_bytes(block, position, disconnect_at))
+                stats.bytes_sent += disconnect_at - position
+                stats.disconnects += 1
+                request.transport.close()
+                return response
+            await response.write(synthetic_bytes(block, position, chunk_end))
+            stats.bytes_sent += chunk_end - position
+            position = chunk_end
+            if config.bandwidth:
+                # 按带宽限速: 已发送的字节数不能超过 带宽 * 经过的时间
+                delay = (position - start) / config.bandwidth - (loop.time() - started)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+    async def handle_stats(request: web.Request) -> web.Response:
+        return web.json_response(
+            {
+                "requests": stats.requests,
+                "bytes_sent": stats.bytes_sent,
+                "disconnects": stats.disconnects,
+                "statuses": {str(k): v for k, v in stats.statuses.items()},
+            }
+        )
+
+    app = web.Application()
+    app.router.add_get("/media/{aweme_id}/{name}", handle_media)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+def run_server(port: int, config: FakeCDNConfig) -> None:
+    web.run_app(create_app(config), host="127.0.0.1", port=port, print=None)
+
+
+def write_aweme_tree(
+    base_path: str | Path,
+    items: int,
+    port: int,
+    users: int = 10,
+    video_size: int = 256 * 1024,
+    cover_size: int = 16 * 1024,
+    page_size: int = 18,
+) -> int:
+    """
+    生成合成的数据目录: users个用户目录, 共items个作品, 每个aweme.json按接口分页保存,
+    每个作品的视频和封面各有两个镜像(127.0.0.1和localhost, 都指向本地CDN)
+    边生成边写入, 十万个作品也不会占用很多内存; 返回写入的作品数
+    """
+    base_path = Path(base_path)
+    hosts = [f"http://127.0.0.1:{port}", f"http://localhost:{port}"]
+    written = 0
+    for user in range(users):
+        user_items = items // users + (1 if user < items % users else 0)
+        user_dir = base_path / f"user{user}_{100000 + user}"
+        user_dir.mkdir(parents=True, exist_ok=True)
+        with open(user_dir / "aweme.json", "w", encoding="utf-8") as f:
+            f.write("[")
+            for page, page_start in enumerate(range(0, user_items, page_size)):
+                awemes = []
+                for index in range(page_start, min(page_start + page_size, user_items)):
+                    aweme_id = str(7000000000000000000 + written)
+                    written += 1
+                    awemes.append(
+                        {
+                            "aweme_id": aweme_id,
+                            "desc": f"bench {aweme_id}",
+                            "create_time": 1700000000 + written,
+                            "author": {"nickname": f"user{user}", "uid": str(user)},
+                            "statistics": {"digg_count": written % 100000},
+                            "video": {
+                                "play_addr": {
+                                    "url_list": [
+                                        f"{host}/media/{aweme_id}/video.mp4?size={video_size}"
+                                        for host in hosts
+                                    ],
+                                    "data_size": video_size,
+                                },
+                                "cover": {
+                                    "url_list": [
+                                        f"{host}/media/{aweme_id}/cover.jpg?size={cover_size}"
+                                        for host in hosts
+                                    ]
+                                },
+                            },
+                        }
+                    )
+                f.write(
+                    ("," if page else "")
+                    + json.dumps({"aweme_list": awemes, "has_more": 1})
+                )
+            f.write("]")
+    return written
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--bandwidth-mbps", type=float, default=0)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--disconnect-rate", type=float, default=0)
+    parser.add_argument("--throttle-every", type=int, default=0)
+    parser.add_argument("--throttle-burst", type=int, default=0)
+    parser.add_argument("--throttle-status", type=int, default=429)
+    args = parser.parse_args()
+    run_server(
+        args.port,
+        FakeCDNConfig(
+            bandwidth=args.bandwidth_mbps * 1024 * 1024 / 8,
+            latency=args.latency_ms / 1000,
+            disconnect_rate=args.disconnect_rate,
+            throttle_every=args.throttle_every,
+            throttle_burst=args.throttle_burst,
+            throttle_status=args.throttle_status,
+        ),
+    )
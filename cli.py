@@ -0,0 +1,313 @@
+"""
+命令行入口, 每个子命令只导入自己需要的模块:
+verify/stats只读取本地的清单和索引, 不会导入playwright/aiohttp等, 适合定时任务频繁运行
+
+python cli.py crawl users.txt --data-dir data --headless --incremental
+python cli.py download --data-dir data --quality -1 --processes 4
+python cli.py download --data-dir data --order-by digg_count --limit 100
+python cli.py download --data-dir data --max-resolution 720 --budget-gb 50
+python cli.py run users.txt --data-dir data --incremental --max-resolution 720
+python cli.py verify --data-dir data --deep
+python cli.py stats --data-dir data
+
+users.txt每行一个用户主页链接, 空行和#开头的行会被忽略, 文件名为-时从标准输入读取
+"""
+
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+
+
+def read_user_urls(path: str) -> list[str]:
+    lines = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        return [
+            line.strip()
+            for line in lines
+            if line.strip().startswith("http") and not line.startswith("#")
+        ]
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+
+
+def add_log_file() -> None:
+    from loguru import logger
+
+    logger.add(
+        f"logs/log_{time.strftime('%Y-%m-%d', time.localtime())}.log",
+        rotation="10 MB",
+        retention="10 days",
+        level="INFO",
+    )
+
+
+def crawl_kwargs(args: argparse.Namespace) -> dict:
+    """save_user_videos_aneme_jsonobjs_async的参数(不含链接和数据目录)"""
+    from crawl_replay import CrawlReplay
+
+    replay = None
+    if args.record:
+        replay = CrawlReplay(args.record, "record")
+    elif args.replay:
+        replay = CrawlReplay(args.replay, "replay")
+    return dict(
+        headless=args.headless or None,
+        incremental=args.incremental,
+        crawl_engine=args.engine,
+        max_pages=args.max_pages,
+        browser_processes=args.browsers,
+        contexts_per_browser=args.contexts,
+        update_catalog=not args.no_catalog,
+        replay=replay,
+    )
+
+
+def download_kwargs(args: argparse.Namespace) -> dict:
+    """download_main的参数(不含数据目录)"""
+    # 按清晰度/码率/大小/总流量预算选择视频版本(见video_variants.VariantPolicy)
+    video_variant = {
+        key: value
+        for key, value in (
+            ("max_resolution", args.max_resolution),
+            ("max_bit_rate", args.max_bitrate and args.max_bitrate * 1000),
+            ("max_size", args.max_size_mb and int(args.max_size_mb * 1024**2)),
+            ("budget", args.budget_gb and int(args.budget_gb * 1024**3)),
+            ("allow_h265", False if args.no_h265 else None),
+        )
+        if value is not None
+    } or None
+    return dict(
+        download_quality=None if args.quality == "all" else int(args.quality),
+        download_num=args.num,
+        workers=args.workers,
+        segments=args.segments,
+        race_mirrors=args.race_mirrors,
+        use_manifest=not args.no_manifest,
+        metrics_port=args.metrics_port,
+        include_music=args.include_music,
+        include_images=args.include_images,
+        dedup_assets=not args.no_dedup,
+        video_variant=video_variant,
+    )
+
+
+def run_crawl(args: argparse.Namespace) -> int:
+    import asyncio
+    from playwright_dy import save_user_videos_aneme_jsonobjs_async
+
+    user_home_urls = read_user_urls(args.users)
+    if not user_home_urls:
+        print(f"no user home page urls in {args.users}", file=sys.stderr)
+        return 2
+    add_log_file()
+    asyncio.run(
+        save_user_videos_aneme_jsonobjs_async(
+            user_home_urls,
+            args.data_dir,
+            metrics_port=args.metrics_port,
+            **crawl_kwargs(args),
+        )
+    )
+    return 0
+
+
+def run_download(args: argparse.Namespace) -> int:
+    import asyncio
+    from download_videos import download_main
+
+    add_log_file()
+    # 指定了排序/数量/点赞数时从作品索引中选择作品, 否则遍历所有aweme.json
+    catalog_query = {
+        key: value
+        for key, value in (
+            ("order_by", args.order_by),
+            ("limit", args.limit),
+            ("min_digg_count", args.min_digg_count),
+        )
+        if value is not None
+    } or None
+    asyncio.run(
+        download_main(
+            data_save_path=args.data_dir,
+            catalog_query=catalog_query,
+            processes=args.processes,
+            run_id=args.run_id,
+            join_run=args.join,
+            join_timeout=args.join_timeout,
+            **download_kwargs(args),
+        )
+    )
+    failures_path = Path(args.data_dir) / "failures.json"
+    return 1 if failures_path.exists() else 0
+
+
+def run_pipeline(args: argparse.Namespace) -> int:
+    import asyncio
+    from crawl_pipeline import crawl_and_download
+
+    user_home_urls = read_user_urls(args.users)
+    if not user_home_urls:
+        print(f"no user home page urls in {args.users}", file=sys.stderr)
+        return 2
+    add_log_file()
+    asyncio.run(
+        crawl_and_download(
+            user_home_urls,
+            args.data_dir,
+            crawl_kwargs=crawl_kwargs(args),
+            download_kwargs=download_kwargs(args),
+        )
+    )
+    failures_path = Path(args.data_dir) / "failures.json"
+    return 1 if failures_path.exists() else 0
+
+
+def run_verify(args: argparse.Namespace) -> int:
+    from download_manifest import verify_downloads
+
+    if not (Path(args.data_dir) / "manifest.sqlite3").exists():
+        print(f"no manifest in {args.data_dir}", file=sys.stderr)
+        return 2
+    report = verify_downloads(args.data_dir, max_workers=args.workers, deep=args.deep)
+    broken = sum(len(paths) for status, paths in report.items() if status != "ok")
+    for status, paths in report.items():
+        if status != "ok":
+            for path in paths:
+                print(f"{status}: {path}")
+    return 1 if broken else 0
+
+
+def run_stats(args: argparse.Namespace) -> int:
+    data_dir = Path(args.data_dir)
+    stats = {}
+    if (data_dir / "manifest.sqlite3").exists():
+        from download_manifest import DownloadManifest
+
+        manifest = DownloadManifest(data_dir)
+        stats["manifest"] = manifest.stats()
+        manifest.close()
+    if (data_dir / "catalog.sqlite3").exists():
+        from aweme_catalog import AwemeCatalog
+
+        catalog = AwemeCatalog(data_dir)
+        stats["catalog_awemes"] = catalog.count()
+        catalog.close()
+    for name in ("run_metrics", "crawl_metrics"):
+        path = data_dir / f"{name}.json"
+        if path.exists():
+            metrics = json.loads(path.read_text(encoding="utf-8"))
+            stats[name] = {
+                key: metrics.get(key)
+                for key in (
+                    "started_at",
+                    "elapsed",
+                    "bytes_downloaded",
+                    "files_completed",
+                    "files_failed",
+                    "files_skipped",
+                    "pages_crawled",
+                    "profiles_crawled",
+                )
+                if metrics.get(key)
+            }
+    failures_path = data_dir / "failures.json"
+    if failures_path.exists():
+        stats["failures"] = len(json.loads(failures_path.read_text(encoding="utf-8")))
+    print(json.dumps(stats, indent=4, ensure_ascii=False))
+    return 0
+
+
+def add_crawl_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("users", help="用户主页链接列表文件, 每行一个, -表示标准输入")
+    parser.add_argument("--headless", action="store_true")
+    parser.add_argument("--incremental", action="store_true", help="只抓取新作品")
+    parser.add_argument("--engine", choices=["scroll", "api"], default="scroll")
+    parser.add_argument("--max-pages", type=int, default=4)
+    parser.add_argument("--browsers", type=int, default=1, help="浏览器进程数")
+    parser.add_argument("--contexts", type=int, default=1, help="每个浏览器的上下文数")
+    parser.add_argument("--no-catalog", action="store_true", help="不更新作品索引")
+    replay = parser.add_mutually_exclusive_group()
+    replay.add_argument("--record", metavar="HAR", help="把抓取会话录制到HAR文件")
+    replay.add_argument("--replay", metavar="HAR", help="从HAR文件离线回放")
+
+
+def add_download_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--quality", default="-1", help="url_list的下标, -1为最高清晰度, all下载全部"
+    )
+    parser.add_argument("--num", type=int, default=0, help="最多下载的作品数, 0为全部")
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--segments", type=int, default=1)
+    parser.add_argument("--race-mirrors", action="store_true")
+    parser.add_argument("--no-manifest", action="store_true")
+    parser.add_argument("--no-dedup", action="store_true", help="不使用素材库去重")
+    parser.add_argument("--include-music", action="store_true")
+    parser.add_argument("--include-images", action="store_true")
+    parser.add_argument(
+        "--max-resolution", type=int, help="视频短边最大像素数, 例如720"
+    )
+    parser.add_argument("--max-bitrate", type=int, help="视频最大码率(kbps)")
+    parser.add_argument("--max-size-mb", type=float, help="单个视频最大大小(MB)")
+    parser.add_argument(
+        "--budget-gb", type=float, help="所有视频的总流量预算(GB), 超过时降低清晰度"
+    )
+    parser.add_argument("--no-h265", action="store_true", help="不选择h265编码的版本")
+    parser.add_argument("--metrics-port", type=int)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="抖音用户作品抓取和下载")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    crawl = subparsers.add_parser("crawl", help="抓取用户主页的作品数据(aweme.json)")
+    add_crawl_arguments(crawl)
+    crawl.add_argument("--data-dir", default="data")
+    crawl.add_argument("--metrics-port", type=int)
+    crawl.set_defaults(func=run_crawl)
+
+    download = subparsers.add_parser("download", help="下载数据目录中的作品")
+    download.add_argument("--data-dir", default="data")
+    add_download_arguments(download)
+    download.add_argument("--processes", type=int, default=1)
+    download.add_argument("--order-by", help="从作品索引中按该列排序选择作品")
+    download.add_argument("--limit", type=int, help="从作品索引中最多选择的作品数")
+    download.add_argument("--min-digg-count", type=int, help="从作品索引中按点赞数选择")
+    download.add_argument("--run-id", default="default")
+    download.add_argument(
+        "--join", action="store_true", help="加入其他机器上正在运行的多进程下载"
+    )
+    download.add_argument(
+        "--join-timeout", type=float, default=600, help="等待运行创建的最长秒数"
+    )
+    download.set_defaults(func=run_download)
+
+    pipeline = subparsers.add_parser(
+        "run", help="边抓取边下载, 抓取到的作品直接进入下载队列"
+    )
+    add_crawl_arguments(pipeline)
+    pipeline.add_argument("--data-dir", default="data")
+    add_download_arguments(pipeline)
+    pipeline.set_defaults(func=run_pipeline)
+
+    verify = subparsers.add_parser("verify", help="离线校验已下载的文件")
+    verify.add_argument("--data-dir", default="data")
+    verify.add_argument("--workers", type=int, default=32)
+    verify.add_argument("--deep", action="store_true", help="同时校验sha256")
+    verify.set_defaults(func=run_verify)
+
+    stats = subparsers.add_parser("stats", help="显示清单/索引/最近一次运行的统计")
+    stats.add_argument("--data-dir", default="data")
+    stats.set_defaults(func=run_stats)
+    return parser
+
+
+def main(argv: list[str] | None = None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,204 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Awaitable, Callable
+from urllib.parse import urlsplit
+from loguru import logger
+
+
+def media_asset_key(kind: str, url: str, media_id: str | None = None) -> str:
+    """
+    共享素材的稳定键: 有素材id(例如背景音乐的id)时用id,
+    否则用url的路径部分(不含域名和签名参数, 不同镜像/不同时间抓取的同一个文件相同)
+    """
+    return f"{kind}:{media_id}" if media_id else f"{kind}:{urlsplit(url).path}"
+
+
+def file_hasher(
+    file_path: Path, size: int | None = None, chunk_size: int = 1024 * 1024
+) -> "hashlib._Hash":
+    """返回已经读入文件前size个字节(None表示整个文件)的sha256对象, 续传时接着更新即可"""
+    sha256 = hashlib.sha256()
+    remaining = size
+    with open(file_path, "rb") as f:
+        while remaining is None or remaining > 0:
+            chunk = f.read(
+                chunk_size if remaining is None else min(chunk_size, remaining)
+            )
+            if not chunk:
+                break
+            sha256.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha256
+
+
+def file_sha256(file_path: Path) -> str:
+    return file_hasher(file_path).hexdigest()
+
+
+def link_file(source: Path, target: Path) -> str:
+    """
+    把source放到target: 优先硬链接, 跨文件系统时用符号链接, 都不支持时复制
+    返回使用的方式
+    """
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists() and os.path.samefile(source, target):
+        return "exists"
+    tmp_target = target.with_name(f".{target.name}.link")
+    tmp_target.unlink(missing_ok=True)
+    try:
+        os.link(source, tmp_target)
+        method = "hardlink"
+    except OSError:
+        try:
+            os.symlink(source.resolve(), tmp_target)
+            method = "symlink"
+        except OSError:
+            shutil.copy2(source, tmp_target)
+            method = "copy"
+    # 先链接到临时名字再替换, 目标已存在(旧的独立副本)时也能原子替换
+    os.replace(tmp_target, target)
+    return method
+
+
+class ContentStore:
+    """
+    内容寻址的素材库, 保存在数据目录下的.store中
+    objects/{sha256前两位}/{sha256}{后缀} 每份内容只保存一次,
+    assets表记录素材键(见media_asset_key)到内容哈希的映射;
+    各作品目录中的文件是指向素材库的硬链接(或符号链接),
+    同一次运行中同一个素材只下载一次, 之后的运行直接链接不再访问网络;
+    下载过程中查询和写入索引都在线程中进行, 等待其他下载进程释放写锁时不会卡住事件循环
+    """
+
+    def __init__(
+        self, data_dir: str | Path, dirname: str = ".store", tmp_name: str = ""
+    ):
+        """tmp_name: 多进程下载时每个工作进程使用各自的临时目录, 避免同时写同一个临时文件"""
+        assert isinstance(data_dir, (str, Path)), "data_dir must be a string or Path"
+        self.root = Path(data_dir) / dirname
+        self.objects_dir = self.root / "objects"
+        self.tmp_dir = self.root / "tmp" / tmp_name if tmp_name else self.root / "tmp"
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+        # 多个下载进程共用一个索引, 等待写锁的时间长一些
+        self.conn = sqlite3.connect(
+            self.root / "store.sqlite3", timeout=60, check_same_thread=False
+        )
+        # 同一个连接同一时间只在一个线程中使用
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS assets (
+                asset_key TEXT PRIMARY KEY,
+                sha256 TEXT NOT NULL,
+                size INTEGER,
+                suffix TEXT,
+                updated_at REAL
+            )
+            """)
+        self.conn.commit()
+        self._inflight: dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.fetches = 0
+        self.bytes_saved = 0
+
+    def object_path(self, sha256: str, suffix: str) -> Path:
+        return self.objects_dir / sha256[:2] / f"{sha256}{suffix}"
+
+    def lookup(self, asset_key: str) -> Path | None:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT sha256, suffix FROM assets WHERE asset_key = ?", (asset_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        object_path = self.object_path(*row)
+        return object_path if object_path.exists() else None
+
+    async def lookup_async(self, asset_key: str) -> Path | None:
+        return await asyncio.to_thread(self.lookup, asset_key)
+
+    def _save_asset(self, asset_key: str, sha256: str, size: int, suffix: str) -> None:
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO assets"
+                " (asset_key, sha256, size, suffix, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (asset_key, sha256, size, suffix, time.time()),
+            )
+            self.conn.commit()
+
+    def temp_path(self, asset_key: str, suffix: str) -> Path:
+        # 同一个素材的临时文件名固定, 中断后下次可以续传
+        name = hashlib.sha1(asset_key.encode("utf-8")).hexdigest()
+        return self.tmp_dir / f"{name}{suffix}"
+
+    async def ingest(self, asset_key: str, tmp_path: Path) -> Path:
+        """下载完成的临时文件按内容哈希移动到objects中, 内容相同的文件只保留一份"""
+        sha256 = await asyncio.to_thread(file_sha256, tmp_path)
+        object_path = self.object_path(sha256, tmp_path.suffix)
+        size = tmp_path.stat().st_size
+        if object_path.exists():
+            tmp_path.unlink()
+            self.bytes_saved += size
+        else:
+            object_path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, object_path)
+        await asyncio.to_thread(
+            self._save_asset, asset_key, sha256, size, tmp_path.suffix
+        )
+        return object_path
+
+    async def materialize(
+        self,
+        asset_key: str,
+        target: Path,
+        fetch: Callable[[Path], Awaitable],
+    ) -> Path | None:
+        """
+        把素材放到target, 返回素材库中的文件; 素材库中没有时调用fetch(临时路径)下载,
+        同一个素材正在被其他任务下载时等它完成; fetch没有生成文件时返回None
+        """
+        object_path = await self.lookup_async(asset_key)
+        while object_path is None and asset_key in self._inflight:
+            # 等待的下载失败时拿到None, 重新检查素材库和是否有别的任务已经开始下载
+            await asyncio.shield(self._inflight[asset_key])
+            object_path = await self.lookup_async(asset_key)
+        if object_path is None:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[asset_key] = future
+            try:
+                tmp_path = self.temp_path(asset_key, target.suffix)
+                await fetch(tmp_path)
+                if tmp_path.exists() and tmp_path.stat().st_size > 0:
+                    object_path = await self.ingest(asset_key, tmp_path)
+                    self.fetches += 1
+            finally:
+                # 失败时等待的任务拿到None, 其中一个会接着下载
+                future.set_result(object_path)
+                self._inflight.pop(asset_key, None)
+            if object_path is None:
+                return None
+        else:
+            self.hits += 1
+            self.bytes_saved += object_path.stat().st_size
+        method = await asyncio.to_thread(link_file, object_path, target)
+        logger.debug(f"{method}: {target.as_posix()} -> {object_path.name}")
+        return object_path
+
+    def summary(self) -> str:
+        return (
+            f"fetched assets: {self.fetches}, reused assets: {self.hits}, "
+            f"saved: {self.bytes_saved / 1024 / 1024:.2f}MB"
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
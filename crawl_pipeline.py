@@ -0,0 +1,67 @@
+import asyncio
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List
+from loguru import logger
+from download_videos import download_main
+from playwright_dy import save_user_videos_aneme_jsonobjs_async
+
+
+async def iter_aweme_queue(
+    awemes: asyncio.Queue[tuple[Path, dict] | None],
+) -> AsyncIterator[tuple[Path, dict]]:
+    while (item := await awemes.get()) is not None:
+        yield item
+
+
+async def crawl_and_download(
+    user_home_urls: List[str],
+    data_save_dir: str = "data",
+    crawl_kwargs: Dict[str, Any] | None = None,
+    download_kwargs: Dict[str, Any] | None = None,
+) -> List[Dict[str, Any]]:
+    """
+    边抓取边下载: handle_response hook到的每一页作品直接交给下载调度器生成下载任务,
+    抓取和下载同时进行, 总耗时接近两者中较长的一个, 而不是两者之和;
+    aweme.json和作品索引照常在每个用户抓取完成时保存
+    crawl_kwargs是save_user_videos_aneme_jsonobjs_async的参数, download_kwargs是download_main的参数;
+    只下载这次抓取到的作品, 之前失败的文件用download_main重新下载
+    """
+    crawl_kwargs = crawl_kwargs or {}
+    download_kwargs = download_kwargs or {}
+    # 不限长度: 抓取不会因为下载慢而停下, 背压由下载调度器自己的任务队列负责
+    awemes: asyncio.Queue[tuple[Path, dict] | None] = asyncio.Queue()
+    timings = {}
+
+    def on_awemes(user_dir: Path, aweme_list: List[Dict[str, Any]]) -> None:
+        for aweme in aweme_list:
+            awemes.put_nowait((user_dir, aweme))
+
+    async def crawl() -> List[Dict[str, Any]]:
+        start_time = time.perf_counter()
+        try:
+            return await save_user_videos_aneme_jsonobjs_async(
+                user_home_urls, data_save_dir, on_awemes=on_awemes, **crawl_kwargs
+            )
+        finally:
+            timings["crawl"] = time.perf_counter() - start_time
+            awemes.put_nowait(None)
+
+    async def download() -> None:
+        start_time = time.perf_counter()
+        try:
+            await download_main(
+                data_save_path=data_save_dir,
+                aweme_source=iter_aweme_queue(awemes),
+                **download_kwargs,
+            )
+        finally:
+            timings["download"] = time.perf_counter() - start_time
+
+    start_time = time.perf_counter()
+    return_datas, _ = await asyncio.gather(crawl(), download())
+    logger.info(
+        f"crawl and download: {time.perf_counter() - start_time:.2f}s "
+        f"(crawl {timings['crawl']:.2f}s, download {timings['download']:.2f}s)"
+    )
+    return return_datas
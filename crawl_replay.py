@@ -0,0 +1,87 @@
+import base64
+import json
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl
+from playwright.async_api import BrowserContext, Request, Route
+from loguru import logger
+
+AWEME_POST_PATTERN = "**/aweme/v1/web/aweme/post/**"
+
+
+def aweme_post_key(url: str) -> tuple[str, str]:
+    """
+    aweme/post请求的回放键: (sec_user_id, max_cursor)
+    页面脚本每次都会生成不同的签名参数(a_bogus/msToken等), 不能按完整url匹配
+    """
+    query = dict(parse_qsl(urlsplit(url).query, keep_blank_values=True))
+    return query.get("sec_user_id", ""), query.get("max_cursor", "0")
+
+
+def load_aweme_post_pages(har_path: str | Path) -> dict[tuple[str, str], str]:
+    """从HAR中取出所有aweme/post响应体, 按回放键索引"""
+    with open(har_path, "r", encoding="utf-8") as f:
+        har = json.load(f)
+    pages = {}
+    for entry in har.get("log", {}).get("entries", []):
+        url = entry.get("request", {}).get("url", "")
+        content = entry.get("response", {}).get("content", {})
+        if "aweme/v1/web/aweme/post" not in url or "text" not in content:
+            continue
+        text = content["text"]
+        if content.get("encoding") == "base64":
+            text = base64.b64decode(text).decode("utf-8")
+        if text:
+            pages[aweme_post_key(url)] = text
+    return pages
+
+
+class CrawlReplay:
+    """
+    录制/回放抓取会话
+    record: 正常访问抖音, 经过浏览器上下文的请求(页面, 脚本, aweme/post接口等)录制到HAR,
+            上下文关闭时写入文件
+    replay: 不访问网络, 页面和静态资源从HAR回放, aweme/post按(sec_user_id, max_cursor)回放,
+            HAR中没有的请求直接中止
+    """
+
+    def __init__(self, har_path: str | Path, mode: str = "replay"):
+        assert mode in ("record", "replay"), "mode must be 'record' or 'replay'"
+        self.har_path = Path(har_path)
+        self.mode = mode
+        self.aweme_post_pages: dict[tuple[str, str], str] = {}
+        self.replayed = 0
+        self.missed = 0
+
+    @property
+    def offline(self) -> bool:
+        return self.mode == "replay"
+
+    async def attach(self, context: BrowserContext) -> None:
+        if self.mode == "record":
+            self.har_path.parent.mkdir(parents=True, exist_ok=True)
+            await context.route_from_har(
+                self.har_path, update=True, update_content="embed"
+            )
+            logger.info(f"录制抓取会话到: {self.har_path.as_posix()}")
+            return
+        assert self.har_path.exists(), f"HAR file not found: {self.har_path}"
+        await context.route_from_har(self.har_path, not_found="abort")
+        self.aweme_post_pages = load_aweme_post_pages(self.har_path)
+        # 后注册的路由先匹配, aweme/post由这里回放
+        await context.route(AWEME_POST_PATTERN, self.handle_aweme_post)
+        logger.info(
+            f"回放抓取会话: {self.har_path.as_posix()}, "
+            f"{len(self.aweme_post_pages)} 页作品数据"
+        )
+
+    async def handle_aweme_post(self, route: Route, request: Request) -> None:
+        body = self.aweme_post_pages.get(aweme_post_key(request.url))
+        if body is None:
+            self.missed += 1
+            logger.debug(f"No recorded aweme/post page: {request.url}")
+            await route.abort()
+            return
+        self.replayed += 1
+        await route.fulfill(
+            status=200, body=body, content_type="application/json; charset=utf-8"
+        )
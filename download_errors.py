@@ -0,0 +1,121 @@
+import json
+import random
+import time
+from collections import Counter
+from dataclasses import dataclass, asdict, field
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+import aiohttp
+
+# 这些状态码重试也不会成功(链接失效/不存在/参数错误)
+PERMANENT_STATUSES = frozenset({400, 401, 404, 405, 410, 451})
+
+
+class PermanentDownloadError(ValueError):
+    """重试也不会成功的错误, 例如返回的不是媒体文件"""
+
+
+class DownloadFailedError(Exception):
+    """重试结束后仍然失败, failure中是结构化的失败信息"""
+
+    def __init__(self, failure: "DownloadFailure"):
+        super().__init__(f"{failure.reason}: {failure.error_type}: {failure.message}")
+        self.failure = failure
+
+
+@dataclass
+class DownloadFailure:
+    func_name: str
+    url: str | None
+    file_save_path: str | None
+    # permanent: 不可重试的错误; retries_exhausted: 重试次数用完; budget_exhausted: 全局重试预算用完
+    reason: str
+    error_type: str
+    message: str
+    status: int | None = None
+    attempts: int = 1
+    failed_at: float = field(default_factory=time.time)
+
+
+@dataclass
+class FailureReport:
+    failures: list[DownloadFailure] = field(default_factory=list)
+
+    def add(self, failure: DownloadFailure) -> None:
+        self.failures.append(failure)
+
+    def summary(self) -> str:
+        reasons: dict[str, int] = {}
+        for failure in self.failures:
+            reasons[failure.reason] = reasons.get(failure.reason, 0) + 1
+        return f"failed files: {len(self.failures)}, by reason: {reasons}"
+
+    def save(self, path: str | Path) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                [asdict(failure) for failure in self.failures],
+                f,
+                indent=4,
+                ensure_ascii=False,
+            )
+
+
+@dataclass
+class RetryBudget:
+    """
+    一次运行的全局重试预算: 重试次数不超过 min_retries + ratio * 首次请求数,
+    CDN大面积故障时不会每个文件都把重试次数用完
+    """
+
+    ratio: float = 0.2
+    min_retries: int = 20
+    attempts: int = 0
+    retries: int = 0
+    # 每种原因(状态码或异常类型)的重试次数
+    by_cause: Counter = field(default_factory=Counter)
+
+    def record_attempt(self) -> None:
+        self.attempts += 1
+
+    def try_spend(self, cause: str = "unknown") -> bool:
+        if self.retries >= self.min_retries + self.ratio * self.attempts:
+            return False
+        self.retries += 1
+        self.by_cause[cause] += 1
+        return True
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Retry-After可以是秒数或者HTTP日期"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def classify_exception(e: BaseException) -> tuple[bool, int | None, float | None]:
+    """返回(是否可重试, 状态码, Retry-After秒数)"""
+    if isinstance(e, aiohttp.ClientResponseError):
+        retry_after = parse_retry_after((e.headers or {}).get("Retry-After"))
+        return e.status not in PERMANENT_STATUSES, e.status, retry_after
+    if isinstance(e, (PermanentDownloadError, aiohttp.InvalidURL)):
+        return False, None, None
+    # 连接错误/超时/响应不完整等都按临时错误处理
+    return True, None, None
+
+
+def backoff_delay(
+    attempt: int, base: float, cap: float, retry_after: float | None = None
+) -> float:
+    """指数退避, 一半固定一半随机(抖动), 服务器给了Retry-After时至少等这么久"""
+    delay = min(cap, base * 2**attempt)
+    delay = delay / 2 + random.uniform(0, delay / 2)
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, cap))
+    return delay
@@ -0,0 +1,223 @@
+import asyncio
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from loguru import logger
+from content_store import file_sha256
+
+
+class DownloadManifest:
+    """
+    本地下载清单(SQLite), 保存在数据目录下
+    记录每个文件的url, aweme_id, 预期大小, ETag/Last-Modified, 下载时计算的sha256和是否下载完成,
+    重新运行时已完成的文件直接跳过, 不再发送请求;
+    未完成的文件也记录ETag/Last-Modified, 续传时用If-Range确认服务器上的文件没有变化;
+    下载过程中用*_async方法在线程中读写, 等待其他下载进程释放写锁时不会卡住事件循环
+    """
+
+    def __init__(self, data_dir: str | Path, filename: str = "manifest.sqlite3"):
+        assert isinstance(data_dir, (str, Path)), "data_dir must be a string or Path"
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        self.db_path = self.data_dir / filename
+        # 多个下载进程共用一个清单, 等待写锁的时间长一些
+        self.conn = sqlite3.connect(self.db_path, timeout=60, check_same_thread=False)
+        # 同一个连接同一时间只在一个线程中使用
+        self._lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                url TEXT,
+                aweme_id TEXT,
+                expected_size INTEGER,
+                etag TEXT,
+                last_modified TEXT,
+                completed INTEGER NOT NULL DEFAULT 0,
+                updated_at REAL,
+                sha256 TEXT
+            )
+            """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(files)")}
+        if "sha256" not in columns:
+            # 旧版本创建的清单没有sha256列
+            self.conn.execute("ALTER TABLE files ADD COLUMN sha256 TEXT")
+        self.conn.commit()
+
+    def key(self, file_path: str | Path) -> str:
+        # 用相对数据目录的路径作为主键, 数据目录整体移动后清单仍然有效
+        file_path = Path(file_path)
+        try:
+            return file_path.relative_to(self.data_dir).as_posix()
+        except ValueError:
+            return file_path.as_posix()
+
+    def get(self, file_path: str | Path) -> dict | None:
+        with self._lock:
+            cursor = self.conn.execute(
+                "SELECT path, url, aweme_id, expected_size, etag, last_modified,"
+                " completed, sha256 FROM files WHERE path = ?",
+                (self.key(file_path),),
+            )
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def is_complete(self, file_path: str | Path) -> bool:
+        """清单中标记为完成且本地文件大小一致, 只需要一次stat, 不访问网络"""
+        record = self.get(file_path)
+        if not record or not record["completed"]:
+            return False
+        file_path = Path(file_path)
+        return file_path.exists() and (
+            not record["expected_size"]
+            or file_path.stat().st_size == record["expected_size"]
+        )
+
+    def record(
+        self,
+        file_path: str | Path,
+        url: str,
+        aweme_id: str | None = None,
+        expected_size: int | None = None,
+        etag: str | None = None,
+        last_modified: str | None = None,
+        completed: bool = True,
+        sha256: str | None = None,
+    ) -> None:
+        with self._lock:
+            self.conn.execute(
+                """
+                INSERT INTO files
+                    (path, url, aweme_id, expected_size, etag, last_modified, completed,
+                     updated_at, sha256)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    url = excluded.url,
+                    aweme_id = COALESCE(excluded.aweme_id, files.aweme_id),
+                    expected_size = COALESCE(excluded.expected_size, files.expected_size),
+                    etag = COALESCE(excluded.etag, files.etag),
+                    last_modified = COALESCE(excluded.last_modified, files.last_modified),
+                    completed = excluded.completed,
+                    updated_at = excluded.updated_at,
+                    sha256 = excluded.sha256
+                """,
+                (
+                    self.key(file_path),
+                    url,
+                    aweme_id,
+                    expected_size,
+                    etag,
+                    last_modified,
+                    int(completed),
+                    time.time(),
+                    sha256,
+                ),
+            )
+            self.conn.commit()
+
+    def rename_dir(self, old_dir: str | Path, new_dir: str | Path) -> int:
+        """目录重命名后更新其中所有文件的路径, 返回更新的记录数"""
+        old_prefix = f"{self.key(old_dir)}/"
+        new_prefix = f"{self.key(new_dir)}/"
+        with self._lock:
+            cursor = self.conn.execute(
+                "UPDATE files SET path = ? || substr(path, ?)"
+                " WHERE substr(path, 1, ?) = ?",
+                (new_prefix, len(old_prefix) + 1, len(old_prefix), old_prefix),
+            )
+            self.conn.commit()
+        return cursor.rowcount
+
+    def rename_file(self, old_path: str | Path, new_path: str | Path) -> None:
+        with self._lock:
+            self.conn.execute(
+                "UPDATE files SET path = ? WHERE path = ?",
+                (self.key(new_path), self.key(old_path)),
+            )
+            self.conn.commit()
+
+    def stats(self) -> dict[str, int]:
+        """清单中的文件数, 已完成的文件数和它们的总大小"""
+        with self._lock:
+            files, completed, completed_bytes = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(completed), 0),"
+                " COALESCE(SUM(CASE WHEN completed = 1 THEN expected_size END), 0)"
+                " FROM files"
+            ).fetchone()
+        return {
+            "files": files,
+            "completed": completed,
+            "completed_bytes": completed_bytes,
+        }
+
+    def verify(self, max_workers: int = 32, deep: bool = False) -> dict[str, list[str]]:
+        """
+        离线校验: 并发stat清单中所有已完成的文件, 和预期大小比较,
+        丢失或大小不一致的文件标记为未完成, 下次下载时会重新下载;
+        deep为True时再读取文件和下载时记录的sha256比较(很慢, 只在怀疑磁盘损坏时使用)
+        """
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT path, expected_size, sha256 FROM files WHERE completed = 1"
+            ).fetchall()
+
+        def stat_file(row: tuple[str, int | None, str | None]) -> tuple[str, str]:
+            path, expected_size, sha256 = row
+            file_path = self.data_dir / path
+            if not file_path.exists():
+                return path, "missing"
+            if expected_size and file_path.stat().st_size != expected_size:
+                return path, "size_mismatch"
+            if deep and sha256 and file_sha256(file_path) != sha256:
+                return path, "hash_mismatch"
+            return path, "ok"
+
+        report = {"ok": [], "missing": [], "size_mismatch": [], "hash_mismatch": []}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for path, status in executor.map(stat_file, rows):
+                report[status].append(path)
+        broken = report["missing"] + report["size_mismatch"] + report["hash_mismatch"]
+        if broken:
+            with self._lock:
+                self.conn.executemany(
+                    "UPDATE files SET completed = 0, updated_at = ? WHERE path = ?",
+                    [(time.time(), path) for path in broken],
+                )
+                self.conn.commit()
+        logger.info(
+            f"verify manifest: ok: {len(report['ok'])}, missing: {len(report['missing'])}, "
+            f"size mismatch: {len(report['size_mismatch'])}, "
+            f"hash mismatch: {len(report['hash_mismatch'])}"
+        )
+        return report
+
+    async def get_async(self, file_path: str | Path) -> dict | None:
+        return await asyncio.to_thread(self.get, file_path)
+
+    async def is_complete_async(self, file_path: str | Path) -> bool:
+        return await asyncio.to_thread(self.is_complete, file_path)
+
+    async def record_async(
+        self, file_path: str | Path, url: str, *args, **kwargs
+    ) -> None:
+        """参数同record"""
+        await asyncio.to_thread(self.record, file_path, url, *args, **kwargs)
+
+    def close(self) -> None:
+        with self._lock:
+            self.conn.close()
+
+
+def verify_downloads(
+    data_save_path: str | Path = "data", max_workers: int = 32, deep: bool = False
+) -> dict[str, list[str]]:
+    manifest = DownloadManifest(data_save_path)
+    try:
+        return manifest.verify(max_workers=max_workers, deep=deep)
+    finally:
+        manifest.close()
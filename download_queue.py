@@ -0,0 +1,333 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Iterable
+from loguru import logger
+
+
+def shard_of(aweme_id: str | None, shards: int) -> int:
+    """按aweme_id分片, 同一个作品的视频/封面/音乐总在同一个分片, 由同一个进程下载"""
+    return zlib.crc32(str(aweme_id or "").encode("utf-8")) % shards
+
+
+class JobQueue:
+    """
+    多进程下载的任务队列(SQLite), 保存在数据目录下
+    协调进程把下载任务按aweme_id哈希分到shards个分片写入jobs表,
+    工作进程按分片批量领取任务(带租约), 完成/失败后写回, 并定期在workers表上报运行指标;
+    自己的分片领完后会领取其他分片剩下的任务, 租约过期(进程退出/机器断开)的任务会被重新领取.
+    共享同一个数据目录的多台机器可以加入同一个运行(run_id);
+    网络文件系统上不能使用WAL, 需要journal_mode="DELETE";
+    check_same_thread=False时连接可以在其他线程中使用, 调用方负责同一时间只有一个线程使用
+    """
+
+    def __init__(
+        self,
+        data_dir: str | Path,
+        filename: str = "job_queue.sqlite3",
+        journal_mode: str = "WAL",
+        timeout: float = 60,
+        check_same_thread: bool = True,
+    ):
+        assert isinstance(data_dir, (str, Path)), "data_dir must be a string or Path"
+        assert journal_mode in ("WAL", "DELETE"), "journal_mode must be WAL or DELETE"
+        self.data_dir = Path(data_dir)
+        self.data_dir.mkdir(parents=True, exist_ok=True)
+        # 自动提交, 需要原子性的地方显式BEGIN IMMEDIATE
+        self.conn = sqlite3.connect(
+            self.data_dir / filename,
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=check_same_thread,
+        )
+        self.conn.execute(f"PRAGMA journal_mode={journal_mode}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                shards INTEGER NOT NULL,
+                enqueued INTEGER NOT NULL DEFAULT 0,
+                finished INTEGER NOT NULL DEFAULT 0,
+                created_at REAL
+            );
+            CREATE TABLE IF NOT EXISTS jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                run_id TEXT NOT NULL,
+                shard INTEGER NOT NULL,
+                aweme_id TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_until REAL,
+                error TEXT,
+                updated_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (run_id, status, shard);
+            CREATE TABLE IF NOT EXISTS workers (
+                worker_id TEXT,
+                run_id TEXT,
+                shard INTEGER,
+                snapshot TEXT,
+                heartbeat REAL,
+                PRIMARY KEY (run_id, worker_id)
+            );
+            """)
+
+    def create_run(self, run_id: str, shards: int) -> None:
+        """新建运行, 同名的旧运行(任务和指标)会被清除"""
+        assert isinstance(shards, int) and shards > 0, "shards must be positive"
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in ("runs", "jobs", "workers"):
+                self.conn.execute(f"DELETE FROM {table} WHERE run_id = ?", (run_id,))
+            self.conn.execute(
+                "INSERT INTO runs (run_id, shards, created_at) VALUES (?, ?, ?)",
+                (run_id, shards, time.time()),
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def get_run(self, run_id: str) -> dict | None:
+        cursor = self.conn.execute(
+            "SELECT run_id, shards, enqueued, finished, created_at FROM runs"
+            " WHERE run_id = ?",
+            (run_id,),
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return dict(zip([column[0] for column in cursor.description], row))
+
+    def enqueue(
+        self, run_id: str, shards: int, payloads: Iterable[dict], batch_size: int = 1000
+    ) -> int:
+        """按批写入任务, payloads可以是生成器, 返回写入的任务数"""
+        count = 0
+        batch = []
+
+        def flush():
+            self.conn.execute("BEGIN IMMEDIATE")
+            self.conn.executemany(
+                "INSERT INTO jobs (run_id, shard, aweme_id, payload, updated_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                batch,
+            )
+            self.conn.execute("COMMIT")
+            batch.clear()
+
+        for payload in payloads:
+            aweme_id = payload.get("aweme_id")
+            batch.append(
+                (
+                    run_id,
+                    shard_of(aweme_id, shards),
+                    aweme_id,
+                    json.dumps(payload, ensure_ascii=False),
+                    time.time(),
+                )
+            )
+            count += 1
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+        self.conn.execute("UPDATE runs SET enqueued = 1 WHERE run_id = ?", (run_id,))
+        return count
+
+    def claim(
+        self,
+        run_id: str,
+        shard: int,
+        worker_id: str,
+        limit: int = 16,
+        lease: float = 120,
+    ) -> list[tuple[int, dict]]:
+        """
+        领取最多limit个任务, 返回[(任务id, payload)]
+        先领自己分片中待下载或租约过期的任务, 没有时领取其他分片的
+        """
+        now = time.time()
+        claimable = (
+            "run_id = ? AND (status = 'pending'"
+            " OR (status = 'running' AND lease_until < ?))"
+        )
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = self.conn.execute(
+                f"SELECT id, payload FROM jobs WHERE {claimable} AND shard = ?"
+                " ORDER BY id LIMIT ?",
+                (run_id, now, shard, limit),
+            ).fetchall()
+            if not rows:
+                rows = self.conn.execute(
+                    f"SELECT id, payload FROM jobs WHERE {claimable} ORDER BY id LIMIT ?",
+                    (run_id, now, limit),
+                ).fetchall()
+            self.conn.executemany(
+                "UPDATE jobs SET status = 'running', worker = ?, lease_until = ?,"
+                " updated_at = ? WHERE id = ?",
+                [(worker_id, now + lease, now, job_id) for job_id, _ in rows],
+            )
+            self.conn.execute("COMMIT")
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+        return [(job_id, json.loads(payload)) for job_id, payload in rows]
+
+    def finish(self, job_id: int, status: str, error: dict | None = None) -> None:
+        """status: done / failed"""
+        self.conn.execute(
+            "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ?"
+            " WHERE id = ?",
+            (
+                status,
+                json.dumps(error, ensure_ascii=False) if error else None,
+                time.time(),
+                job_id,
+            ),
+        )
+
+    def renew(self, worker_id: str, lease: float = 120) -> None:
+        """延长这个工作进程领取的所有任务的租约(包括还在本地队列中等待的)"""
+        self.conn.execute(
+            "UPDATE jobs SET lease_until = ? WHERE worker = ? AND status = 'running'",
+            (time.time() + lease, worker_id),
+        )
+
+    def heartbeat(
+        self, run_id: str, worker_id: str, shard: int, snapshot: dict
+    ) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO workers (worker_id, run_id, shard, snapshot, heartbeat)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (worker_id, run_id, shard, json.dumps(snapshot), time.time()),
+        )
+
+    def remaining(self, run_id: str) -> int:
+        """还没有完成的任务数(待下载+下载中)"""
+        return self.conn.execute(
+            "SELECT COUNT(*) FROM jobs WHERE run_id = ? AND status IN ('pending', 'running')",
+            (run_id,),
+        ).fetchone()[0]
+
+    def counts(self, run_id: str) -> dict[str, int]:
+        return dict(
+            self.conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE run_id = ? GROUP BY status",
+                (run_id,),
+            ).fetchall()
+        )
+
+    def worker_snapshots(self, run_id: str) -> list[dict]:
+        return [
+            json.loads(snapshot)
+            for (snapshot,) in self.conn.execute(
+                "SELECT snapshot FROM workers WHERE run_id = ?", (run_id,)
+            )
+        ]
+
+    def failures(self, run_id: str) -> list[dict]:
+        return [
+            json.loads(error)
+            for (error,) in self.conn.execute(
+                "SELECT error FROM jobs WHERE run_id = ? AND status = 'failed'"
+                " AND error IS NOT NULL ORDER BY id",
+                (run_id,),
+            )
+        ]
+
+    def finish_run(self, run_id: str) -> None:
+        self.conn.execute("UPDATE runs SET finished = 1 WHERE run_id = ?", (run_id,))
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+class QueueWorker:
+    """
+    工作进程一侧: 领取自己分片的任务, 写回结果, 上报指标并续租
+    数据库操作都在线程中进行(job_queue需要check_same_thread=False), 等待其他进程释放锁时不会卡住下载
+    """
+
+    def __init__(
+        self,
+        job_queue: JobQueue,
+        run_id: str,
+        shard: int,
+        claim_size: int = 16,
+        lease: float = 120,
+        poll_interval: float = 1.0,
+    ):
+        self.job_queue = job_queue
+        self.run_id = run_id
+        self.shard = shard
+        self.claim_size = claim_size
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        # 同一台机器上同一个分片的临时文件目录, 重新运行时可以续传
+        self.local_name = f"{socket.gethostname()}-{shard}"
+        # 同一个连接同一时间只在一个线程中使用
+        self._lock = threading.Lock()
+
+    def _locked(self, func: Callable[..., Any], *args) -> Any:
+        with self._lock:
+            return func(*args)
+
+    async def _call(self, func: Callable[..., Any], *args) -> Any:
+        return await asyncio.to_thread(self._locked, func, *args)
+
+    async def iter_jobs(self) -> AsyncIterator[tuple[int, dict]]:
+        """依次返回领取到的任务, 所有任务都完成后结束"""
+        while True:
+            jobs = await self._call(
+                self.job_queue.claim,
+                self.run_id,
+                self.shard,
+                self.worker_id,
+                self.claim_size,
+                self.lease,
+            )
+            for job in jobs:
+                yield job
+            if jobs:
+                continue
+            run = await self._call(self.job_queue.get_run, self.run_id)
+            # 运行已经结束(例如加入时协调进程已经退出)时不再等待任务写入
+            if (
+                run is None
+                or run["finished"]
+                or (
+                    run["enqueued"]
+                    and not await self._call(self.job_queue.remaining, self.run_id)
+                )
+            ):
+                return
+            # 任务还在写入, 或者其他进程下载中的任务可能因为租约过期被重新领取
+            await asyncio.sleep(self.poll_interval)
+
+    async def finish(self, job_id: int, status: str, error: dict | None = None) -> None:
+        await self._call(
+            self.job_queue.finish,
+            job_id,
+            "done" if status in ("completed", "skipped") else "failed",
+            error,
+        )
+
+    def _publish(self, snapshot: dict) -> None:
+        self.job_queue.heartbeat(self.run_id, self.worker_id, self.shard, snapshot)
+        self.job_queue.renew(self.worker_id, self.lease)
+
+    async def publish(self, snapshot: dict) -> None:
+        try:
+            await self._call(self._publish, snapshot)
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Failed to publish worker heartbeat: {e}")
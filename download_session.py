@@ -0,0 +1,119 @@
+import random
+from dataclasses import dataclass
+from functools import lru_cache
+import aiohttp
+from loguru import logger
+
+
+@dataclass
+class ConnectionStats:
+    """连接复用统计, 用于衡量一次运行中节省的TCP+TLS握手次数"""
+
+    requests: int = 0
+    new_connections: int = 0
+    reused_connections: int = 0
+    dns_lookups: int = 0
+    dns_cache_hits: int = 0
+
+    @property
+    def handshakes_saved(self) -> int:
+        # 每个请求如果都新建连接就需要一次握手, 复用的连接就是省下来的握手
+        return max(self.requests - self.new_connections, 0)
+
+    def summary(self) -> str:
+        return (
+            f"requests: {self.requests}, new connections: {self.new_connections}, "
+            f"reused connections: {self.reused_connections}, "
+            f"handshakes saved: {self.handshakes_saved}, "
+            f"dns lookups: {self.dns_lookups}, dns cache hits: {self.dns_cache_hits}"
+        )
+
+
+@lru_cache(maxsize=1)
+def user_agent_pool(size: int = 32) -> tuple[str, ...]:
+    """
+    每个进程只生成一次UA池
+    fake_useragent导入和构造UserAgent要上百毫秒, 每次取.random也要几毫秒,
+    每个文件都调用时CPU时间大部分花在这里
+    """
+    from fake_useragent import UserAgent
+
+    user_agent = UserAgent()
+    return tuple({user_agent.random for _ in range(size)})
+
+
+def random_user_agent() -> str:
+    return random.choice(user_agent_pool())
+
+
+def create_connection_trace_config(stats: ConnectionStats) -> aiohttp.TraceConfig:
+    trace_config = aiohttp.TraceConfig()
+
+    async def on_request_start(session, ctx, params):
+        stats.requests += 1
+
+    async def on_connection_create_end(session, ctx, params):
+        stats.new_connections += 1
+
+    async def on_connection_reuseconn(session, ctx, params):
+        stats.reused_connections += 1
+
+    async def on_dns_resolvehost_end(session, ctx, params):
+        stats.dns_lookups += 1
+
+    async def on_dns_cache_hit(session, ctx, params):
+        stats.dns_cache_hits += 1
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    trace_config.on_dns_resolvehost_end.append(on_dns_resolvehost_end)
+    trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+    return trace_config
+
+
+def create_download_session(
+    limit: int = 100,
+    limit_per_host: int = 10,
+    keepalive_timeout: float = 60,
+    ttl_dns_cache: int = 600,
+    connect_timeout: float = 10,
+    sock_read_timeout: float = 60,
+    total_timeout: float | None = None,
+    stats: ConnectionStats | None = None,
+    trace_configs: list[aiohttp.TraceConfig] | None = None,
+) -> tuple[aiohttp.ClientSession, ConnectionStats]:
+    """
+    创建整个下载过程共用的ClientSession
+    同一个CDN域名的连接会被复用(keep-alive), DNS解析结果会被缓存,
+    所以成千上万个文件只需要很少的握手次数
+    """
+    assert isinstance(limit, int) and limit >= 0, "limit must be a non-negative integer"
+    assert (
+        isinstance(limit_per_host, int) and limit_per_host >= 0
+    ), "limit_per_host must be a non-negative integer"
+    assert isinstance(
+        stats, (ConnectionStats, type(None))
+    ), "stats must be a ConnectionStats or None"
+
+    stats = stats if stats is not None else ConnectionStats()
+    connector = aiohttp.TCPConnector(
+        limit=limit,
+        limit_per_host=limit_per_host,
+        keepalive_timeout=keepalive_timeout,
+        ttl_dns_cache=ttl_dns_cache,
+        use_dns_cache=True,
+    )
+    session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(
+            total=total_timeout,
+            connect=connect_timeout,
+            sock_read=sock_read_timeout,
+        ),
+        trace_configs=[create_connection_trace_config(stats), *(trace_configs or [])],
+    )
+    logger.debug(
+        f"created download session, limit: {limit}, limit_per_host: {limit_per_host}"
+    )
+    return session, stats
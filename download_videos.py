@@ -1,42 +1,110 @@
+import hashlib
 import json
+import multiprocessing
 import re
+import sys
+import time
 from pathlib import Path
 import aiohttp
 from rich import print
 from loguru import logger
 from tqdm import tqdm
 import asyncio
-from fake_useragent import UserAgent
-from useful_decorators import async_download_retry_decorator, semaphore_decorator
+from useful_decorators import async_download_retry_decorator
 from useful_tools import sanitize_filename, format_digg_count
 import random
-from useful_tools import read_statejson_and_get_cookie_headers
+from useful_tools import read_statejson_and_get_cookie_headers, iter_json_array_items
 from functools import wraps
+from dataclasses import asdict, dataclass, field
+from itertools import islice
+from typing import AsyncIterator, Iterator
+from download_session import create_download_session, random_user_agent
+from mirror_stats import MirrorStats
+from download_manifest import DownloadManifest
+from aweme_catalog import AwemeCatalog
+from aweme_folders import AwemeFolderIndex
+from content_store import ContentStore, file_hasher, media_asset_key
+from video_variants import VariantPlanner
+from download_queue import JobQueue, QueueWorker
+from rate_control import RateController, RateSlot
+from run_metrics import (
+    FileProgress,
+    MetricsReporter,
+    RunMetrics,
+    create_metrics_trace_config,
+)
+from download_errors import (
+    DownloadFailedError,
+    DownloadFailure,
+    FailureReport,
+    PermanentDownloadError,
+    RetryBudget,
+)
 
 
-@logger.catch
+@dataclass
+class DownloadJob:
+    url: str
+    file_save_path: Path
+    # 同一个文件的多个CDN镜像, 不为空时竞速下载
+    mirror_urls: list[str] = field(default_factory=list)
+    aweme_id: str | None = None
+    # 共享素材(封面/音乐/图片)的稳定键, 不为空时经过素材库去重
+    asset_key: str | None = None
+    # 多进程下载时在任务队列(download_queue.JobQueue)中的id
+    job_id: int | None = None
+    # 作品数据中声明的文件大小(play_addr.data_size), 未知时为None
+    expected_size: int | None = None
+
+
+def job_to_payload(job: DownloadJob) -> dict:
+    return {
+        "url": job.url,
+        "file_save_path": job.file_save_path.as_posix(),
+        "mirror_urls": job.mirror_urls,
+        "aweme_id": job.aweme_id,
+        "asset_key": job.asset_key,
+        "expected_size": job.expected_size,
+    }
+
+
+def job_from_payload(job_id: int, payload: dict) -> DownloadJob:
+    return DownloadJob(
+        **{**payload, "file_save_path": Path(payload["file_save_path"])}, job_id=job_id
+    )
+
+
+# 分段下载时每段的最小字节数
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+
+@logger.catch(exclude=DownloadFailedError)
 @async_download_retry_decorator(
-    retry_times=30,
-    sleep_interval_min=5,
-    sleep_interval_max=15,
+    retry_times=8,
+    sleep_interval_min=1,
+    sleep_interval_max=60,
 )
-@semaphore_decorator()
 async def download_file_async(
     url: str,
     file_save_path: str | Path,
     headers: dict = None,
     mix_size: int = 512,
     session: aiohttp.ClientSession = None,
+    write_buffer_size: int = 4 * 1024 * 1024,
+    progress_interval: float = 0.5,
+    segments: int = 1,
+    min_segment_size: int = MIN_SEGMENT_SIZE,
+    manifest: DownloadManifest | None = None,
+    aweme_id: str | None = None,
+    rate_controller: RateController | None = None,
+    metrics: RunMetrics | None = None,
 ):
     headers = (
         headers.copy()
         if isinstance(headers, dict)
-        else {
-            "User-Agent": UserAgent().random,
-            "Referer": "https://www.douyin.com/",
-        }
+        else {"Referer": "https://www.douyin.com/"}
     )
-    headers.update({"User-Agent": UserAgent().random})
+    headers.update({"User-Agent": random_user_agent()})
 
     assert isinstance(url, str), "url must be a string"
     assert isinstance(
@@ -44,6 +112,12 @@ async def download_file_async(
     ), "file_save_path must be a string or Path"
     assert isinstance(headers, dict), "headers must be a dictionary"
     assert isinstance(mix_size, int), "mix_size must be an integer"
+    assert (
+        isinstance(write_buffer_size, int) and write_buffer_size > 0
+    ), "write_buffer_size must be a positive integer"
+    assert (
+        isinstance(segments, int) and segments > 0
+    ), "segments must be a positive integer"
     assert isinstance(
         session, (aiohttp.ClientSession, type(None))
     ), "session must be an aiohttp.ClientSession or None"
@@ -51,70 +125,103 @@ async def download_file_async(
     file_path = (
         Path(file_save_path) if isinstance(file_save_path, str) else file_save_path
     )
-    file_mode = "wb"
-    resume_header = {}
-    if file_path.exists():
-        existing_file_size = file_path.stat().st_size
-        resume_header = {"Range": f"bytes={existing_file_size}-"}
-        file_mode = "ab"
-    else:
-        existing_file_size = 0
     total_size = 0
     bar = None
+    # 没有传入限流器时单独下载一个文件, 用默认参数
+    rate_controller = rate_controller or RateController()
+    pool = rate_controller.pool_for(file_path)
     gived_session = bool(session and isinstance(session, aiohttp.ClientSession))
     if not gived_session:
-        session = aiohttp.ClientSession(
-            timeout=aiohttp.ClientTimeout(connect=10),
-        )
+        # 分段下载的各段要同时连接
+        session, _ = create_download_session(limit=segments, limit_per_host=segments)
     try:
-        async with session.get(
-            url, headers={**headers, **resume_header}, timeout=10
-        ) as response:
-            total_size = (
-                int(response.headers.get("content-length", 0)) + existing_file_size
+        # 有分段记录的文件是预分配到完整大小的, 文件大小不能当作续传位置,
+        # 不管segments是多少都按分段记录续传;
+        # 已存在且没有分段记录的文件(完整文件或单连接下载的部分文件)走单连接续传
+        if segment_state_path(file_path).exists() or (
+            segments > 1 and not file_path.exists()
+        ):
+            # 分段下载, 服务器不支持Range时返回None, 退回单连接下载
+            total_size = await download_file_segmented_async(
+                url,
+                file_path,
+                headers,
+                session,
+                segments=segments,
+                min_segment_size=min_segment_size,
+                mix_size=mix_size,
+                write_buffer_size=write_buffer_size,
+                progress_interval=progress_interval,
+                rate_controller=rate_controller,
+                pool=pool,
+                metrics=metrics,
             )
-            if existing_file_size >= total_size:
+            if total_size is not None:
+                if manifest is not None:
+                    await manifest.record_async(file_path, url, aweme_id, total_size)
+                return total_size
+        existing_file_size = file_path.stat().st_size if file_path.exists() else 0
+        async with rate_controller.slot(url, pool) as rate_slot, session.get(
+            url,
+            headers={
+                **headers,
+                **await resume_headers(manifest, file_path, existing_file_size),
+            },
+        ) as response:
+            rate_slot.observe(response.status)
+            if existing_file_size and response.status == 416:
+                # 416表示续传的起点已经是文件末尾(If-Range匹配时服务器才会按Range处理)
+                total_size = existing_file_size
+                check_unsatisfiable_range(response, file_path, existing_file_size)
                 logger.success(
                     f"Downloaded {file_path.name} to {file_path.parent.as_posix()}, {existing_file_size}={total_size}"
                 )
-                return
-            # 检查是否是媒体文件
-            content_type = response.headers.get("content-type", "")
-            if not re.match(r"^video|audio|image", content_type):
-                logger.debug(
-                    f"Content type is not video/audio/image, is this the correct file? {url} {content_type}"
-                )
-                raise ValueError(
-                    f"Content type is not video/audio/image, is this the correct file? {url} {content_type}"
-                )
-            if total_size <= mix_size:
-                logger.debug(
-                    f"File size too small, is this the correct file? {url} {total_size}"
-                )
-                raise ValueError(
-                    f"File size too small, is this the correct file? {url} {total_size}"
-                )
-            bar = tqdm(
-                desc=file_path.name,
-                total=total_size,
-                initial=existing_file_size,
-                unit="iB",
-                unit_scale=True,
-                unit_divisor=1024,
-                smoothing=0.1,
-                colour="green",
+                if manifest is not None:
+                    sha256 = await asyncio.to_thread(file_hasher, file_path)
+                    await record_manifest_response(
+                        manifest,
+                        file_path,
+                        url,
+                        aweme_id,
+                        total_size,
+                        response,
+                        sha256=sha256.hexdigest(),
+                    )
+                return total_size
+            # 其他错误状态码不能当作下载完成
+            response.raise_for_status()
+            offset = resume_offset(response, existing_file_size)
+            total_size = response_total_size(response)
+            check_media_response(url, response, total_size, mix_size)
+            sha256 = await start_file_hasher(
+                file_path, offset, manifest, url, aweme_id, total_size, response
+            )
+            bar = create_progress_bar(file_path, total_size, offset, metrics)
+            await stream_response_to_file(
+                response,
+                file_path,
+                "ab" if offset else "wb",
+                bar,
+                write_buffer_size=write_buffer_size,
+                progress_interval=progress_interval,
+                hasher=sha256,
             )
-            with open(file_save_path, file_mode) as file:
-                while True:
-                    chunk = await response.content.read(1024)
-                    # logger.debug(f"chunk size: {len(chunk)}")
-                    if not chunk:
-                        break
-                    downloaded_size = file.write(chunk)
-                    bar.update(downloaded_size)
-                    bar.refresh()
             if file_path.stat().st_size == total_size:
                 bar.set_postfix_str("Downloaded")
+                if manifest is not None:
+                    await record_manifest_response(
+                        manifest,
+                        file_path,
+                        url,
+                        aweme_id,
+                        total_size,
+                        response,
+                        sha256=sha256.hexdigest(),
+                    )
+            else:
+                raise ValueError(
+                    f"Incomplete download {file_path.stat().st_size}/{total_size}: {url}"
+                )
             logger.success(
                 f"Downloaded {file_path.name} to {file_path.parent.as_posix()}"
             )
@@ -131,90 +238,1411 @@ async def download_file_async(
     return total_size
 
 
+async def open_mirror_response(
+    url: str,
+    headers: dict,
+    session: aiohttp.ClientSession,
+    offset: int,
+    mix_size: int,
+    mirror_stats: MirrorStats,
+    rate_controller: RateController,
+    pool: str,
+    range_headers: dict | None = None,
+) -> tuple[str, aiohttp.ClientResponse, int, RateSlot]:
+    """
+    请求一个镜像, 返回(url, 响应, 文件总大小, 限流名额),
+    响应和名额由调用方负责关闭/释放
+    range_headers是续传用的Range/If-Range请求头(见resume_headers)
+    """
+    loop = asyncio.get_running_loop()
+    rate_slot = await rate_controller.acquire(url, pool)
+    start_time = loop.time()
+    try:
+        try:
+            response = await session.get(
+                url, headers={**headers, **(range_headers or {})}
+            )
+        except Exception:
+            rate_slot.fail()
+            raise
+        rate_slot.observe(response.status)
+        try:
+            if offset and response.status == 416:
+                # 文件已经下载完整
+                total_size = offset
+            else:
+                response.raise_for_status()
+                total_size = response_total_size(response)
+                check_media_response(url, response, total_size, mix_size)
+        except BaseException:
+            response.close()
+            raise
+    except asyncio.CancelledError:
+        rate_slot.release()
+        raise
+    except Exception:
+        rate_slot.release()
+        mirror_stats.record_failure(url)
+        raise
+    mirror_stats.record_success(url, loop.time() - start_time)
+    return url, response, total_size, rate_slot
+
+
+async def race_mirror_responses(
+    urls: list[str],
+    headers: dict,
+    session: aiohttp.ClientSession,
+    offset: int,
+    mix_size: int,
+    mirror_stats: MirrorStats,
+    hedge_delay: float,
+    rate_controller: RateController,
+    pool: str,
+    range_headers: dict | None = None,
+) -> tuple[str, aiohttp.ClientResponse, int, RateSlot]:
+    """
+    按排名依次请求镜像, 前一个镜像hedge_delay秒内没有返回响应头(或者失败)就请求下一个,
+    最先返回有效响应的镜像胜出, 其余请求取消
+    """
+    remaining = list(urls)
+    pending: set[asyncio.Task] = set()
+    last_exception = None
+
+    def start_next():
+        pending.add(
+            asyncio.create_task(
+                open_mirror_response(
+                    remaining.pop(0),
+                    headers,
+                    session,
+                    offset,
+                    mix_size,
+                    mirror_stats,
+                    rate_controller,
+                    pool,
+                    range_headers,
+                )
+            )
+        )
+
+    start_next()
+    try:
+        while pending:
+            done, _ = await asyncio.wait(
+                pending,
+                timeout=hedge_delay if remaining else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if not done:
+                start_next()
+                continue
+            for task in done:
+                pending.discard(task)
+                if task.exception() is None:
+                    return task.result()
+                last_exception = task.exception()
+                logger.debug(f"Mirror failed: {type(last_exception)}: {last_exception}")
+            if remaining and not pending:
+                start_next()
+    finally:
+        for task in pending:
+            task.cancel()
+        for result in await asyncio.gather(*pending, return_exceptions=True):
+            if isinstance(result, tuple):
+                result[1].close()
+                result[3].release()
+    raise last_exception or ValueError(f"No mirror available: {urls}")
+
+
+@logger.catch(exclude=DownloadFailedError)
+@async_download_retry_decorator(
+    retry_times=8,
+    sleep_interval_min=1,
+    sleep_interval_max=60,
+)
+async def download_file_from_mirrors_async(
+    urls: list[str],
+    file_save_path: str | Path,
+    session: aiohttp.ClientSession,
+    mirror_stats: MirrorStats,
+    headers: dict = None,
+    mix_size: int = 512,
+    hedge_delay: float = 0.5,
+    write_buffer_size: int = 4 * 1024 * 1024,
+    progress_interval: float = 0.5,
+    manifest: DownloadManifest | None = None,
+    aweme_id: str | None = None,
+    rate_controller: RateController | None = None,
+    metrics: RunMetrics | None = None,
+):
+    """
+    把url列表当作同一个文件的多个镜像下载
+    开始时竞速选出最快的镜像, 下载中途出错时用Range从当前位置切换到下一个镜像继续,
+    各域名的延迟和错误率记录在mirror_stats中, 用于给后面的文件排序镜像
+    """
+    assert isinstance(urls, list) and urls, "urls must be a non-empty list"
+    assert isinstance(
+        file_save_path, (str, Path)
+    ), "file_save_path must be a string or Path"
+    assert isinstance(
+        session, aiohttp.ClientSession
+    ), "session must be an aiohttp.ClientSession"
+    assert isinstance(mirror_stats, MirrorStats), "mirror_stats must be a MirrorStats"
+    headers = (
+        headers.copy()
+        if isinstance(headers, dict)
+        else {"Referer": "https://www.douyin.com/"}
+    )
+    headers.update({"User-Agent": random_user_agent()})
+
+    file_path = (
+        Path(file_save_path) if isinstance(file_save_path, str) else file_save_path
+    )
+    rate_controller = rate_controller or RateController()
+    pool = rate_controller.pool_for(file_path)
+    ranked_urls = mirror_stats.rank(urls)
+    # 镜像下载只能从文件末尾续传, 分段下载留下的预分配文件要重新下载
+    discard_segmented_partial(file_path)
+    bar = None
+    # 已写入文件的数据的sha256, 换镜像续传时接着更新
+    sha256 = None
+    last_exception = None
+    try:
+        while ranked_urls:
+            offset = file_path.stat().st_size if file_path.exists() else 0
+            url, response, total_size, rate_slot = await race_mirror_responses(
+                ranked_urls,
+                headers,
+                session,
+                offset,
+                mix_size,
+                mirror_stats,
+                hedge_delay,
+                rate_controller,
+                pool,
+                await resume_headers(manifest, file_path, offset),
+            )
+            try:
+                if offset and response.status == 416:
+                    check_unsatisfiable_range(response, file_path, offset)
+                    logger.success(
+                        f"Downloaded {file_path.name} to {file_path.parent.as_posix()}, {offset}={total_size}"
+                    )
+                    if manifest is not None:
+                        sha256 = sha256 or await asyncio.to_thread(
+                            file_hasher, file_path
+                        )
+                        await record_manifest_response(
+                            manifest,
+                            file_path,
+                            url,
+                            aweme_id,
+                            offset,
+                            response,
+                            sha256=sha256.hexdigest(),
+                        )
+                    return total_size
+                new_offset = resume_offset(response, offset)
+                if new_offset != offset or sha256 is None:
+                    # 第一次请求或者镜像返回了完整文件(没有按Range返回/文件已经变化)
+                    offset = new_offset
+                    sha256 = await start_file_hasher(
+                        file_path, offset, manifest, url, aweme_id, total_size, response
+                    )
+                if bar is None:
+                    bar = create_progress_bar(file_path, total_size, offset, metrics)
+                else:
+                    bar.n = offset
+                try:
+                    await stream_response_to_file(
+                        response,
+                        file_path,
+                        "ab" if offset else "wb",
+                        bar,
+                        write_buffer_size=write_buffer_size,
+                        progress_interval=progress_interval,
+                        hasher=sha256,
+                    )
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # 中途断开, 换下一个镜像从当前位置继续
+                    last_exception = e
+                    mirror_stats.record_failure(url)
+                    ranked_urls.remove(url)
+                    logger.debug(f"Mirror {url} failed mid-download, failover: {e}")
+                    continue
+                if manifest is not None and file_path.stat().st_size >= total_size:
+                    await record_manifest_response(
+                        manifest,
+                        file_path,
+                        url,
+                        aweme_id,
+                        total_size,
+                        response,
+                        sha256=sha256.hexdigest(),
+                    )
+            finally:
+                response.release()
+                rate_slot.release()
+            if file_path.stat().st_size >= total_size:
+                bar.set_postfix_str("Downloaded")
+                logger.success(
+                    f"Downloaded {file_path.name} to {file_path.parent.as_posix()} from {mirror_stats.host_of(url)}"
+                )
+                return total_size
+            last_exception = ValueError(
+                f"Incomplete download {file_path.stat().st_size}/{total_size}: {url}"
+            )
+            ranked_urls.remove(url)
+    finally:
+        if bar is not None:
+            bar.close()
+    raise last_exception or ValueError(f"All mirrors failed: {urls}")
+
+
+async def record_manifest_response(
+    manifest: DownloadManifest,
+    file_path: Path,
+    url: str,
+    aweme_id: str | None,
+    size: int,
+    response: aiohttp.ClientResponse,
+    sha256: str | None = None,
+    completed: bool = True,
+) -> None:
+    await manifest.record_async(
+        file_path,
+        url,
+        aweme_id,
+        size,
+        etag=response.headers.get("etag"),
+        last_modified=response.headers.get("last-modified"),
+        completed=completed,
+        sha256=sha256,
+    )
+
+
+def resume_validator(record: dict | None) -> str | None:
+    """If-Range只能用强ETag或Last-Modified"""
+    if not record:
+        return None
+    etag = record.get("etag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return record.get("last_modified")
+
+
+async def resume_headers(
+    manifest: DownloadManifest | None, file_path: Path, offset: int
+) -> dict:
+    """
+    从offset续传的请求头
+    清单中记录了开始下载时的ETag/Last-Modified时带上If-Range,
+    服务器上的文件变化后(签名url指向了不同的编码等)服务器返回完整的200响应而不是拼接错误的206
+    """
+    if not offset:
+        return {}
+    headers = {"Range": f"bytes={offset}-"}
+    validator = resume_validator(
+        await manifest.get_async(file_path) if manifest is not None else None
+    )
+    if validator:
+        headers["If-Range"] = validator
+    return headers
+
+
+def resume_offset(response: aiohttp.ClientResponse, offset: int) -> int:
+    """
+    按响应决定从文件的哪个位置开始写: 206且Content-Range从offset开始时续传,
+    200(服务器忽略了Range或者If-Range不匹配)从头写, 覆盖原来的部分文件
+    """
+    if response.status != 206:
+        if offset:
+            logger.debug(
+                f"Server returned {response.status} for a resume request, restart: {response.url}"
+            )
+        return 0
+    match = re.match(r"bytes (\d+)-", response.headers.get("content-range", ""))
+    if match is None or int(match.group(1)) != offset:
+        raise ValueError(
+            f"Unexpected Content-Range for offset {offset}: "
+            f"{response.headers.get('content-range')} {response.url}"
+        )
+    return offset
+
+
+def check_unsatisfiable_range(
+    response: aiohttp.ClientResponse, file_path: Path, offset: int
+) -> None:
+    """
+    416说明续传的起点不在文件内, 只有本地文件和服务器上的一样大时才是已经下载完整,
+    本地文件更大说明不是同一个文件, 删除后抛出异常重试
+    """
+    content_range = response.headers.get("content-range", "")
+    if content_range.startswith("bytes */") and (
+        int(content_range.rsplit("/", 1)[1]) != offset
+    ):
+        file_path.unlink()
+        raise ValueError(f"Local file larger than remote {content_range}: {file_path}")
+
+
+def response_total_size(response: aiohttp.ClientResponse) -> int:
+    """206响应从Content-Range取完整文件大小, 200响应就是Content-Length"""
+    content_range = response.headers.get("content-range", "")
+    if response.status == 206 and "/" in content_range:
+        return int(content_range.rsplit("/", 1)[1])
+    return int(response.headers.get("content-length", 0))
+
+
+async def start_file_hasher(
+    file_path: Path,
+    offset: int,
+    manifest: DownloadManifest | None,
+    url: str,
+    aweme_id: str | None,
+    total_size: int,
+    response: aiohttp.ClientResponse,
+) -> "hashlib._Hash":
+    """
+    开始写入响应前的准备, 返回边下载边更新的sha256对象
+    从头下载时记录这次响应的ETag/Last-Modified(未完成), 中断后续传用它做If-Range;
+    续传时只需要读一次已有的部分计算哈希, 下载完成后不需要再读整个文件
+    """
+    if offset:
+        return await asyncio.to_thread(file_hasher, file_path, offset)
+    if manifest is not None:
+        await record_manifest_response(
+            manifest, file_path, url, aweme_id, total_size, response, completed=False
+        )
+    return hashlib.sha256()
+
+
+def check_media_response(
+    url: str, response: aiohttp.ClientResponse, total_size: int, mix_size: int
+) -> None:
+    # 4xx/5xx抛出ClientResponseError, 由重试装饰器按状态码决定是否重试
+    response.raise_for_status()
+    # 检查是否是媒体文件
+    content_type = response.headers.get("content-type", "")
+    if not re.match(r"^video|audio|image", content_type):
+        logger.debug(
+            f"Content type is not video/audio/image, is this the correct file? {url} {content_type}"
+        )
+        raise PermanentDownloadError(
+            f"Content type is not video/audio/image, is this the correct file? {url} {content_type}"
+        )
+    if total_size <= mix_size:
+        logger.debug(
+            f"File size too small, is this the correct file? {url} {total_size}"
+        )
+        raise PermanentDownloadError(
+            f"File size too small, is this the correct file? {url} {total_size}"
+        )
+
+
+def segment_state_path(file_path: Path) -> Path:
+    return file_path.with_name(f"{file_path.name}.segments.json")
+
+
+def save_segment_state(state_path: Path, state: dict) -> None:
+    # 先写临时文件再替换, 中断时不会留下写了一半的分段记录
+    tmp_path = state_path.with_name(f"{state_path.name}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    tmp_path.replace(state_path)
+
+
+def discard_segmented_partial(file_path: Path) -> None:
+    """之前分段下载的预分配文件不能用来单连接续传, 删除文件和分段记录"""
+    if segment_state_path(file_path).exists():
+        logger.debug(f"Discard preallocated partial file: {file_path.as_posix()}")
+        file_path.unlink(missing_ok=True)
+        segment_state_path(file_path).unlink(missing_ok=True)
+
+
+def split_byte_ranges(
+    total_size: int, segments: int, min_segment_size: int
+) -> list[tuple[int, int]]:
+    """把[0, total_size)切成最多segments段, 每段不小于min_segment_size, 返回闭区间"""
+    segments = max(1, min(segments, total_size // max(min_segment_size, 1)))
+    segment_size = -(-total_size // segments)
+    return [
+        (start, min(start + segment_size, total_size) - 1)
+        for start in range(0, total_size, segment_size)
+    ]
+
+
+async def download_file_segmented_async(
+    url: str,
+    file_path: Path,
+    headers: dict,
+    session: aiohttp.ClientSession,
+    segments: int = 4,
+    min_segment_size: int = MIN_SEGMENT_SIZE,
+    mix_size: int = 512,
+    write_buffer_size: int = 4 * 1024 * 1024,
+    progress_interval: float = 0.5,
+    rate_controller: RateController | None = None,
+    pool: str = "large",
+    metrics: RunMetrics | None = None,
+) -> int | None:
+    """
+    分段并发下载
+    先用Range: bytes=0-0探测文件大小, 预分配文件后多个连接并发下载各自的字节区间,
+    直接写到文件对应的位置; 已完成的分段记录在{文件名}.segments.json中,
+    断点续传时只下载缺失的分段, 文件大小或ETag/Last-Modified变化时重新下载,
+    分段请求带If-Range, 下载过程中文件变化时分段请求失败, 重试时重新开始.
+    分段乱序写入, 不计算sha256
+    服务器忽略Range(返回200)时返回None, 由调用方退回单连接下载
+    """
+    rate_controller = rate_controller or RateController()
+    async with rate_controller.slot(url, pool) as rate_slot, session.get(
+        url, headers={**headers, "Range": "bytes=0-0"}
+    ) as response:
+        rate_slot.observe(response.status)
+        content_range = response.headers.get("content-range", "")
+        if response.status != 206 or "/" not in content_range:
+            logger.debug(f"Range not supported, fallback to single stream: {url}")
+            discard_segmented_partial(file_path)
+            return None
+        total_size = int(content_range.rsplit("/", 1)[1])
+        check_media_response(url, response, total_size, mix_size)
+        validator = resume_validator(
+            {
+                "etag": response.headers.get("etag"),
+                "last_modified": response.headers.get("last-modified"),
+            }
+        )
+
+    state_path = segment_state_path(file_path)
+    state = {}
+    if state_path.exists() and file_path.exists():
+        with open(state_path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+    if state.get("total_size") != total_size or state.get("validator") != validator:
+        # 第一次下载或者文件已经变化, 重新预分配
+        state = {
+            "total_size": total_size,
+            "validator": validator,
+            "ranges": split_byte_ranges(total_size, segments, min_segment_size),
+            "completed": [],
+        }
+        with open(file_path, "wb") as file:
+            file.truncate(total_size)
+        save_segment_state(state_path, state)
+
+    ranges = [tuple(byte_range) for byte_range in state["ranges"]]
+    completed = set(state["completed"])
+    bar = create_progress_bar(
+        file_path,
+        total_size,
+        sum(
+            end - start + 1
+            for index, (start, end) in enumerate(ranges)
+            if index in completed
+        ),
+        metrics,
+    )
+
+    async def fetch_segment(index: int, start: int, end: int):
+        async with rate_controller.slot(url, pool) as rate_slot, session.get(
+            url,
+            headers={
+                **headers,
+                "Range": f"bytes={start}-{end}",
+                **({"If-Range": validator} if validator else {}),
+            },
+        ) as response:
+            rate_slot.observe(response.status)
+            response.raise_for_status()
+            if response.status != 206:
+                raise ValueError(
+                    f"Segment request returned {response.status}, expected 206: {url}"
+                )
+            written_size = await stream_response_to_file(
+                response,
+                file_path,
+                "r+b",
+                bar,
+                write_buffer_size=write_buffer_size,
+                progress_interval=progress_interval,
+                offset=start,
+            )
+        if written_size != end - start + 1:
+            raise ValueError(
+                f"Segment {index} incomplete: {written_size}/{end - start + 1} {url}"
+            )
+        completed.add(index)
+        state["completed"] = sorted(completed)
+        save_segment_state(state_path, state)
+
+    tasks = [
+        asyncio.create_task(fetch_segment(index, start, end))
+        for index, (start, end) in enumerate(ranges)
+        if index not in completed
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    except BaseException:
+        # 一个分段失败时取消其他分段并等它们结束,
+        # 重试时不会有上一次的分段还在写同一段文件和分段记录
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        bar.close()
+    state_path.unlink(missing_ok=True)
+    logger.success(
+        f"Downloaded {file_path.name} to {file_path.parent.as_posix()} in {len(ranges)} segments"
+    )
+    return total_size
+
+
+def create_progress_bar(
+    file_path: Path, total_size: int, initial: int, metrics: RunMetrics | None = None
+) -> tqdm | FileProgress:
+    # download_main中所有文件共用一个汇总进度, 单独下载一个文件时才显示自己的进度条
+    if metrics is not None:
+        return FileProgress(metrics, initial)
+    return tqdm(
+        desc=file_path.name,
+        total=total_size,
+        initial=initial,
+        unit="iB",
+        unit_scale=True,
+        unit_divisor=1024,
+        smoothing=0.1,
+        colour="green",
+    )
+
+
+async def stream_response_to_file(
+    response: aiohttp.ClientResponse,
+    file_path: Path,
+    file_mode: str,
+    bar: tqdm | FileProgress | None = None,
+    write_buffer_size: int = 4 * 1024 * 1024,
+    progress_interval: float = 0.5,
+    offset: int | None = None,
+    hasher: "hashlib._Hash | None" = None,
+) -> int:
+    """
+    把响应体写入文件
+    iter_any按网络实际到达的数据块读取(大小自适应), 数据先合并到缓冲区,
+    攒够write_buffer_size再交给线程池写盘, 不阻塞事件循环;
+    进度条每progress_interval秒最多刷新一次.
+    offset不为None时从文件的offset位置开始写(分段下载)
+    hasher不为None时写盘的同时更新哈希(在同一个线程中, 大块数据计算哈希时不持有GIL)
+    """
+    loop = asyncio.get_running_loop()
+    buffer = bytearray()
+    written_size = 0
+    pending_progress = 0
+    last_progress_time = loop.time()
+    file = await asyncio.to_thread(open, file_path, file_mode)
+    if offset is not None:
+        file.seek(offset)
+
+    def write(data: bytes) -> int:
+        if hasher is not None:
+            hasher.update(data)
+        return file.write(data)
+
+    try:
+        async for chunk in response.content.iter_any():
+            buffer += chunk
+            pending_progress += len(chunk)
+            if len(buffer) >= write_buffer_size:
+                data, buffer = bytes(buffer), bytearray()
+                written_size += await asyncio.to_thread(write, data)
+            now = loop.time()
+            if bar is not None and now - last_progress_time >= progress_interval:
+                bar.update(pending_progress)
+                pending_progress = 0
+                last_progress_time = now
+    finally:
+        # 出错时也把已收到的数据写盘, 下次断点续传可以从这里继续
+        if buffer:
+            written_size += await asyncio.to_thread(write, bytes(buffer))
+        await asyncio.to_thread(file.close)
+        if bar is not None and pending_progress:
+            bar.update(pending_progress)
+    return written_size
+
+
 @logger.catch
 async def download_main(
     data_save_path: str | Path = "data",
     download_quality: int | None = None,
     download_num: int = 0,
+    limit: int = 100,
+    limit_per_host: int | None = None,
+    connect_timeout: float = 10,
+    sock_read_timeout: float = 60,
+    workers: int = 32,
+    queue_size: int = 100,
+    segments: int = 1,
+    race_mirrors: bool = False,
+    use_manifest: bool = True,
+    catalog_query: dict | None = None,
+    rate_control: dict[str, dict] | None = None,
+    retry_budget_ratio: float = 0.2,
+    metrics_interval: float = 1.0,
+    metrics_port: int | None = None,
+    include_music: bool = False,
+    include_images: bool = False,
+    dedup_assets: bool = True,
+    video_variant: dict | None = None,
+    aweme_source: AsyncIterator[tuple[Path, dict]] | None = None,
+    processes: int = 1,
+    run_id: str = "default",
+    join_run: bool = False,
+    join_timeout: float = 600,
+    queue_journal_mode: str = "WAL",
+    worker_shard: int | None = None,
 ):
+    """
+    rate_control: 按池覆盖限流参数(见rate_control.PoolConfig),
+    small是封面/图片, large是视频/音乐, 例如{"large": {"max_concurrency": 8}};
+    每个域名的并发数和每秒请求数会根据响应自动调整, workers只是同时处理的任务数上限
+    limit_per_host: 连接池中每个域名的连接数上限, None时取各个池的max_concurrency之和,
+    否则连接池会先于限流器卡住并发, 排队等连接的时间也会被算进首字节时间
+    retry_budget_ratio: 整个运行的重试次数最多为文件数的这个比例(另外至少允许20次)
+    最终失败的文件保存在{data_save_path}/failures.json
+    运行指标(吞吐/延迟直方图/重试原因/各域名错误率)每隔几秒写到{data_save_path}/run_metrics.json,
+    metrics_port不为None时同时在该端口提供Prometheus格式的/metrics
+    include_music/include_images: 同时下载背景音乐和图集图片
+    dedup_assets: 封面/音乐/图片保存到{data_save_path}/.store(见content_store.ContentStore),
+    同一个素材只下载和保存一次, 各作品目录中是指向它的硬链接
+    video_variant: 按video.bit_rate中声明的分辨率/码率/大小选择视频版本(见video_variants.VariantPolicy),
+    例如{"max_resolution": 720, "budget": 50 * 1024**3}, 不为None时忽略download_quality对视频的作用,
+    开始下载前会用声明的大小估算视频的总传输量
+    aweme_source: 边抓取边下载时的作品来源(见crawl_pipeline.crawl_and_download),
+    异步返回(aweme.json所在目录, 作品数据), 不为None时不读取数据目录中的aweme.json,
+    有预算时不能提前估算总大小, 按到达顺序使用预算; 只支持单进程下载
+    processes: 大于1时用多个进程下载(见download_main_sharded), 每个进程有自己的事件循环和连接池;
+    join_run: 加入共享同一个数据目录的其他机器上正在运行的run_id, 只启动processes个工作进程,
+    运行已经结束时直接返回, 等待join_timeout秒运行还没有创建时也返回;
+    queue_journal_mode: 任务队列的SQLite日志模式, 数据目录在网络文件系统上时用"DELETE";
+    worker_shard由download_main_sharded在工作进程中设置, 不需要手动传入
+    """
     assert isinstance(
         download_quality, (int, type(None))
     ), "download_quality must be an integer or None"
     assert isinstance(
         data_save_path, (str, Path)
     ), "data_save_path must be a string or Path"
+    assert (
+        isinstance(processes, int) and processes > 0
+    ), "processes must be a positive integer"
+    assert aweme_source is None or (
+        processes == 1 and not join_run
+    ), "aweme_source only supports a single download process"
     base_path = (
         Path(data_save_path) if isinstance(data_save_path, str) else data_save_path
     )
-    json_files_generator = base_path.glob("**/*.json")
-    session = None
-    tasks = []
+    if worker_shard is None and (processes > 1 or join_run):
+        await download_main_sharded(
+            base_path,
+            processes=processes,
+            run_id=run_id,
+            join_run=join_run,
+            join_timeout=join_timeout,
+            queue_journal_mode=queue_journal_mode,
+            metrics_interval=metrics_interval,
+            metrics_port=metrics_port,
+            download_kwargs=dict(
+                download_quality=download_quality,
+                download_num=download_num,
+                limit=limit,
+                limit_per_host=limit_per_host,
+                connect_timeout=connect_timeout,
+                sock_read_timeout=sock_read_timeout,
+                workers=workers,
+                queue_size=queue_size,
+                segments=segments,
+                race_mirrors=race_mirrors,
+                use_manifest=use_manifest,
+                catalog_query=catalog_query,
+                rate_control=rate_control,
+                retry_budget_ratio=retry_budget_ratio,
+                metrics_interval=metrics_interval,
+                include_music=include_music,
+                include_images=include_images,
+                dedup_assets=dedup_assets,
+                video_variant=video_variant,
+            ),
+        )
+        return
+    # 多进程下载的工作进程: 从任务队列领取任务, 指标和失败记录交给协调进程汇总
+    queue_worker = (
+        QueueWorker(
+            JobQueue(
+                base_path, journal_mode=queue_journal_mode, check_same_thread=False
+            ),
+            run_id,
+            worker_shard,
+        )
+        if worker_shard is not None
+        else None
+    )
+    metrics = RunMetrics("download")
+    rate_controller = RateController.from_config(rate_control)
+    if limit_per_host is None:
+        limit_per_host = rate_controller.max_host_concurrency
+    # 整个下载过程共用一个session, 由download_main负责关闭
+    session, connection_stats = create_download_session(
+        limit=max(limit, limit_per_host),
+        limit_per_host=limit_per_host,
+        connect_timeout=connect_timeout,
+        sock_read_timeout=sock_read_timeout,
+        trace_configs=[create_metrics_trace_config(metrics)],
+    )
+    mirror_stats_path = base_path / "mirror_stats.json"
+    mirror_stats = MirrorStats.load(mirror_stats_path)
+    # 下载清单, 已完成的文件不再访问网络
+    manifest = DownloadManifest(base_path) if use_manifest else None
+    retry_budget = RetryBudget(ratio=retry_budget_ratio)
+    metrics.retries_by_cause = retry_budget.by_cause
+    failure_report = FailureReport()
+    content_store = (
+        ContentStore(
+            base_path, tmp_name=queue_worker.local_name if queue_worker else ""
+        )
+        if dedup_assets
+        else None
+    )
+    reporter = (
+        MetricsReporter(
+            metrics,
+            base_path / "run_metrics.json",
+            interval=metrics_interval,
+            prometheus_port=metrics_port,
+        )
+        if queue_worker is None
+        else MetricsReporter(
+            metrics,
+            interval=metrics_interval,
+            export_interval=metrics_interval,
+            show_progress=False,
+            publish=queue_worker.publish,
+        )
+    )
+    try:
+        await reporter.start()
+        await _download_main(
+            base_path,
+            download_quality,
+            download_num,
+            session,
+            workers=workers,
+            queue_size=queue_size,
+            segments=segments,
+            race_mirrors=race_mirrors,
+            mirror_stats=mirror_stats,
+            manifest=manifest,
+            catalog_query=catalog_query,
+            rate_controller=rate_controller,
+            retry_budget=retry_budget,
+            failure_report=failure_report,
+            metrics=metrics,
+            content_store=content_store,
+            include_music=include_music,
+            include_images=include_images,
+            video_variant=video_variant,
+            aweme_source=aweme_source,
+            queue_worker=queue_worker,
+        )
+    finally:
+        await reporter.stop()
+        if not session.closed:
+            await session.close()
+        if manifest is not None:
+            manifest.close()
+        if content_store is not None:
+            content_store.close()
+        if queue_worker is not None:
+            queue_worker.job_queue.close()
+        # 多进程下载时只由第一个分片保存镜像统计, 避免同时写同一个文件
+        if race_mirrors and mirror_stats.hosts and not worker_shard:
+            mirror_stats.save(mirror_stats_path)
+    logger.info(f"connection stats: {connection_stats.summary()}")
+    logger.info(f"rate control: {rate_controller.summary()}")
+    if content_store is not None:
+        logger.info(f"content store: {content_store.summary()}")
+    logger.info(
+        f"retries: {retry_budget.retries}/{retry_budget.attempts} attempts, "
+        f"{failure_report.summary()}"
+    )
+    if queue_worker is not None:
+        logger.info(f"worker {queue_worker.worker_id} finished shard {worker_shard}")
+        return
+    failures_path = base_path / "failures.json"
+    if failure_report.failures:
+        failure_report.save(failures_path)
+        logger.warning(f"failed downloads saved to {failures_path.as_posix()}")
+    elif failures_path.exists():
+        failures_path.unlink()
+    print("[green]\n\nAll download tasks are completed\n[/green]")
+
+
+async def download_main_sharded(
+    base_path: Path,
+    processes: int = 4,
+    run_id: str = "default",
+    join_run: bool = False,
+    join_timeout: float = 600,
+    queue_journal_mode: str = "WAL",
+    metrics_interval: float = 1.0,
+    metrics_port: int | None = None,
+    download_kwargs: dict | None = None,
+):
+    """
+    多进程下载的协调进程
+    单个事件循环只能用一个核, TLS解密/写盘/进度刷新会先把一个核跑满;
+    这里把下载任务按aweme_id哈希分片写入数据目录下的任务队列(job_queue.sqlite3),
+    启动processes个工作进程(各自运行download_main, 有自己的事件循环和连接池)领取任务,
+    协调进程汇总各进程上报的指标显示进度, 结束后把所有失败记录写到failures.json.
+    join_run为True时不写入任务, 只启动工作进程加入其他机器上已经开始的同一个run_id,
+    运行已经结束, 或者等待join_timeout秒还没有创建时直接返回
+    """
+    download_kwargs = download_kwargs or {}
+    job_queue = JobQueue(base_path, journal_mode=queue_journal_mode)
+    if join_run:
+        logger.info(f"waiting for run {run_id} in {base_path.as_posix()}")
+        deadline = time.monotonic() + join_timeout
+        while (run := job_queue.get_run(run_id)) is None:
+            if time.monotonic() >= deadline:
+                logger.error(f"run {run_id} was not created in {join_timeout}s")
+                job_queue.close()
+                return
+            await asyncio.sleep(1)
+        if run["finished"]:
+            logger.warning(f"run {run_id} has already finished, nothing to join")
+            job_queue.close()
+            return
+        shards = run["shards"]
+    else:
+        shards = processes
+        job_queue.create_run(run_id, shards)
+
+    context = multiprocessing.get_context("spawn")
+    worker_processes = [
+        context.Process(
+            target=run_download_worker,
+            args=(
+                base_path,
+                run_id,
+                index % shards,
+                queue_journal_mode,
+                download_kwargs,
+            ),
+            name=f"download-worker-{index}",
+        )
+        for index in range(processes)
+    ]
+    for process in worker_processes:
+        process.start()
+
+    metrics = RunMetrics("download")
+    reporter = MetricsReporter(
+        metrics,
+        None if join_run else base_path / "run_metrics.json",
+        interval=metrics_interval,
+        prometheus_port=metrics_port,
+    )
+    try:
+        await reporter.start()
+        if not join_run:
+            # 写入任务在线程中进行(使用自己的数据库连接), 工作进程可以边写边领取
+            enqueued = await asyncio.to_thread(
+                enqueue_download_jobs,
+                base_path,
+                run_id,
+                shards,
+                queue_journal_mode,
+                download_kwargs,
+            )
+            logger.info(f"enqueued {enqueued} download jobs in {shards} shards")
+        while any(process.is_alive() for process in worker_processes):
+            await asyncio.sleep(metrics_interval)
+            metrics.load_snapshots(job_queue.worker_snapshots(run_id))
+        metrics.load_snapshots(job_queue.worker_snapshots(run_id))
+    finally:
+        await reporter.stop()
+        for process in worker_processes:
+            if process.is_alive():
+                process.terminate()
+            await asyncio.to_thread(process.join)
+
+    counts = job_queue.counts(run_id)
+    logger.info(f"job queue {run_id}: {counts}")
+    if not join_run:
+        failure_report = FailureReport(
+            [DownloadFailure(**failure) for failure in job_queue.failures(run_id)]
+        )
+        logger.info(failure_report.summary())
+        failures_path = base_path / "failures.json"
+        if failure_report.failures:
+            failure_report.save(failures_path)
+            logger.warning(f"failed downloads saved to {failures_path.as_posix()}")
+        elif failures_path.exists():
+            failures_path.unlink()
+    remaining = job_queue.remaining(run_id)
+    if remaining:
+        # 工作进程异常退出, 任务还在队列中, 用join_run=True加入同一个run_id可以继续
+        logger.warning(
+            f"{remaining} jobs of run {run_id} are not finished, "
+            "rerun with join_run=True to continue"
+        )
+    elif not join_run:
+        job_queue.finish_run(run_id)
+    job_queue.close()
+    if not remaining:
+        print("[green]\n\nAll download tasks are completed\n[/green]")
+
+
+def enqueue_download_jobs(
+    base_path: Path,
+    run_id: str,
+    shards: int,
+    queue_journal_mode: str,
+    download_kwargs: dict,
+) -> int:
+    job_queue = JobQueue(base_path, journal_mode=queue_journal_mode)
+    manifest = (
+        DownloadManifest(base_path)
+        if download_kwargs.get("use_manifest", True)
+        else None
+    )
+    try:
+        jobs = iter_download_jobs(
+            base_path,
+            download_kwargs.get("download_quality"),
+            folder_index=AwemeFolderIndex(manifest),
+            **{
+                name: download_kwargs[name]
+                for name in (
+                    "download_num",
+                    "race_mirrors",
+                    "catalog_query",
+                    "include_music",
+                    "include_images",
+                    "video_variant",
+                )
+                if name in download_kwargs
+            },
+        )
+        return job_queue.enqueue(run_id, shards, map(job_to_payload, jobs))
+    finally:
+        job_queue.close()
+        if manifest is not None:
+            manifest.close()
+
+
+def run_download_worker(
+    base_path: Path,
+    run_id: str,
+    shard: int,
+    queue_journal_mode: str,
+    download_kwargs: dict,
+) -> None:
+    """工作进程入口, 每个进程有自己的事件循环, 只输出警告以上的日志"""
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    asyncio.run(
+        download_main(
+            base_path,
+            run_id=run_id,
+            queue_journal_mode=queue_journal_mode,
+            worker_shard=shard,
+            **download_kwargs,
+        )
+    )
+
+
+async def _download_main(
+    base_path: Path,
+    download_quality: int | None,
+    download_num: int,
+    session: aiohttp.ClientSession,
+    workers: int = 32,
+    queue_size: int = 100,
+    segments: int = 1,
+    race_mirrors: bool = False,
+    mirror_stats: MirrorStats | None = None,
+    manifest: DownloadManifest | None = None,
+    catalog_query: dict | None = None,
+    rate_controller: RateController | None = None,
+    retry_budget: RetryBudget | None = None,
+    failure_report: FailureReport | None = None,
+    metrics: RunMetrics | None = None,
+    content_store: ContentStore | None = None,
+    include_music: bool = False,
+    include_images: bool = False,
+    video_variant: dict | None = None,
+    aweme_source: AsyncIterator[tuple[Path, dict]] | None = None,
+    queue_worker: QueueWorker | None = None,
+):
+    """
+    生产者/消费者下载调度
+    生产者按需遍历aweme.json生成下载任务, 队列有上限所以内存占用不随视频数量增长,
+    消费者固定数量, 队列满时生产者会等待(背压);
+    queue_worker不为None时(多进程下载的工作进程)生产者从任务队列领取任务, 消费者把结果写回;
+    aweme_source不为None时生产者为抓取到的作品生成任务, 抓取结束后下载完剩余任务再退出
+    """
+    assert (
+        isinstance(workers, int) and workers > 0
+    ), "workers must be a positive integer"
+    assert (
+        isinstance(queue_size, int) and queue_size > 0
+    ), "queue_size must be a positive integer"
+
+    mirror_stats = mirror_stats if mirror_stats is not None else MirrorStats()
+    rate_controller = rate_controller or RateController()
+    retry_budget = retry_budget or RetryBudget()
+    failure_report = failure_report if failure_report is not None else FailureReport()
+    metrics = metrics if metrics is not None else RunMetrics("download")
+    queue: asyncio.Queue[DownloadJob | None] = asyncio.Queue(maxsize=queue_size)
+
+    async def producer():
+        if queue_worker is not None:
+            async for job_id, payload in queue_worker.iter_jobs():
+                await queue.put(job_from_payload(job_id, payload))
+        elif aweme_source is not None:
+            await produce_stream_jobs()
+        else:
+            await produce_local_jobs()
+        # 每个消费者一个结束标记
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def produce_local_jobs():
+        folder_index = AwemeFolderIndex(manifest)
+        for job in iter_download_jobs(
+            base_path,
+            download_quality,
+            download_num,
+            race_mirrors,
+            catalog_query,
+            include_music=include_music,
+            include_images=include_images,
+            folder_index=folder_index,
+            video_variant=video_variant,
+        ):
+            await queue.put(job)
+        if folder_index.renamed:
+            logger.info(f"renamed {folder_index.renamed} aweme folders")
+
+    async def produce_stream_jobs():
+        folder_index = AwemeFolderIndex(manifest)
+        # 作品还没有抓取完, 不能提前估算, 预算按到达顺序使用
+        variant_planner = VariantPlanner.from_config(video_variant)
+        download_num_count = 0
+        async for user_dir, data in aweme_source:
+            if not (data.get("desc") and data.get("aweme_id")):
+                continue
+            for job in build_aweme_jobs(
+                data,
+                user_dir,
+                download_quality,
+                race_mirrors,
+                include_music=include_music,
+                include_images=include_images,
+                folder_index=folder_index,
+                variant_planner=variant_planner,
+            ):
+                await queue.put(job)
+            download_num_count += 1
+            if download_num > 0 and download_num_count >= download_num:
+                logger.success(
+                    f"download_num_count: {download_num_count} == {download_num}"
+                )
+                break
+        if variant_planner is not None:
+            logger.info(variant_planner.summary())
+
+    async def consumer():
+        while True:
+            job = await queue.get()
+            try:
+                if job is None:
+                    return
+                if await is_complete(job):
+                    logger.debug(f"Skip completed file: {job.file_save_path}")
+                    metrics.files_skipped += 1
+                    if queue_worker is not None:
+                        await queue_worker.finish(job.job_id, "skipped")
+                    continue
+                start_time = metrics.file_started()
+                status = "failed"
+                failure = None
+                try:
+                    await download_job(job)
+                    status = "completed"
+                except DownloadFailedError as e:
+                    failure = e.failure
+                except Exception as e:
+                    # 清单/素材库的OSError, sqlite3错误等只让这一个文件失败, 不中断整个运行
+                    logger.opt(exception=e).error(
+                        f"Unexpected error downloading {job.file_save_path}"
+                    )
+                    failure = unexpected_failure(job, type(e).__name__, str(e))
+                finally:
+                    metrics.file_finished(start_time, status)
+                if failure is not None:
+                    failure_report.add(failure)
+                if queue_worker is not None:
+                    await queue_worker.finish(
+                        job.job_id, status, asdict(failure) if failure else None
+                    )
+            finally:
+                queue.task_done()
+
+    async def is_complete(job: DownloadJob) -> bool:
+        if manifest is None:
+            return False
+        try:
+            return await manifest.is_complete_async(job.file_save_path)
+        except Exception as e:
+            logger.warning(f"Failed to check manifest, download again: {e}")
+            return False
+
+    def unexpected_failure(
+        job: DownloadJob, error_type: str, message: str
+    ) -> DownloadFailure:
+        return DownloadFailure(
+            func_name="download_job",
+            url=job.url,
+            file_save_path=job.file_save_path.as_posix(),
+            reason="unexpected",
+            error_type=error_type,
+            message=message,
+        )
+
+    async def download_job(job: DownloadJob):
+        if job.asset_key and content_store is not None:
+            await download_asset(job)
+            return
+        await fetch_job(job, job.file_save_path, manifest)
+
+    async def download_asset(job: DownloadJob):
+        # 素材先下载到素材库的临时文件, 按内容哈希入库后链接到作品目录
+        object_path = await content_store.materialize(
+            job.asset_key,
+            job.file_save_path,
+            lambda tmp_path: fetch_job(job, tmp_path, None),
+        )
+        if object_path is None:
+            raise DownloadFailedError(
+                DownloadFailure(
+                    func_name="download_asset",
+                    url=job.url,
+                    file_save_path=job.file_save_path.as_posix(),
+                    reason="permanent",
+                    error_type="EmptyFile",
+                    message="downloaded file is missing or empty",
+                )
+            )
+        if manifest is not None:
+            await manifest.record_async(
+                job.file_save_path,
+                job.url,
+                job.aweme_id,
+                object_path.stat().st_size,
+                sha256=object_path.stem,
+            )
+
+    async def fetch_job(
+        job: DownloadJob, file_save_path: Path, manifest: DownloadManifest | None
+    ):
+        if len(job.mirror_urls) > 1:
+            result = await download_file_from_mirrors_async(
+                job.mirror_urls,
+                file_save_path=file_save_path,
+                session=session,
+                mirror_stats=mirror_stats,
+                manifest=manifest,
+                aweme_id=job.aweme_id,
+                rate_controller=rate_controller,
+                metrics=metrics,
+                retry_budget=retry_budget,
+            )
+        else:
+            result = await download_file_async(
+                job.url,
+                file_save_path=file_save_path,
+                session=session,
+                segments=job_segments(job),
+                manifest=manifest,
+                aweme_id=job.aweme_id,
+                rate_controller=rate_controller,
+                metrics=metrics,
+                retry_budget=retry_budget,
+            )
+        if result is None:
+            # logger.catch把意外的异常(AssertionError等)记录到日志后返回None, 不能算下载完成
+            raise DownloadFailedError(
+                unexpected_failure(
+                    job, "UnexpectedError", "download returned no result, see the log"
+                )
+            )
+
+    def job_segments(job: DownloadJob) -> int:
+        # 只有视频值得分段, 封面/音乐/图片和声明大小不够分成两段的视频不用多一次探测请求
+        if (
+            segments == 1
+            or job.asset_key
+            or job.file_save_path.suffix.lower() != ".mp4"
+            or (job.expected_size and job.expected_size < 2 * MIN_SEGMENT_SIZE)
+        ):
+            return 1
+        return segments
+
+    producer_task = asyncio.create_task(producer())
+    consumer_tasks = [asyncio.create_task(consumer()) for _ in range(workers)]
+    try:
+        await asyncio.gather(producer_task, *consumer_tasks)
+    except BaseException:
+        # 取消时(Ctrl+C等)停止生产并等待所有消费者退出, 不留下悬空的任务
+        for task in [producer_task, *consumer_tasks]:
+            task.cancel()
+        await asyncio.gather(producer_task, *consumer_tasks, return_exceptions=True)
+        raise
+
+
+def iter_download_jobs(
+    base_path: Path,
+    download_quality: int | None,
+    download_num: int = 0,
+    race_mirrors: bool = False,
+    catalog_query: dict | None = None,
+    include_music: bool = False,
+    include_images: bool = False,
+    folder_index: AwemeFolderIndex | None = None,
+    video_variant: dict | None = None,
+) -> Iterator[DownloadJob]:
+    """
+    生成下载任务
+    catalog_query为None时遍历所有aweme.json, 否则从作品索引(catalog.sqlite3)中按条件查询,
+    catalog_query是AwemeCatalog.iter_awemes的参数, 例如{"order_by": "digg_count", "limit": 100};
+    folder_index按aweme_id找到已有的作品目录, 点赞数/描述变化后沿用(重命名)旧目录;
+    video_variant不为None时先遍历一遍作品估算视频的总大小(见VariantPlanner.plan)
+    """
+    variant_planner = VariantPlanner.from_config(video_variant)
+    if variant_planner is not None:
+        variant_planner.plan(
+            data
+            for _, data in islice(
+                iter_source_awemes(base_path, catalog_query), download_num or None
+            )
+        )
     download_num_count = 0
+    for user_dir, data in iter_source_awemes(base_path, catalog_query):
+        yield from build_aweme_jobs(
+            data,
+            user_dir,
+            download_quality,
+            race_mirrors,
+            include_music=include_music,
+            include_images=include_images,
+            folder_index=folder_index,
+            variant_planner=variant_planner,
+        )
+
+        download_num_count += 1
+        logger.info(f"download_num_count: {download_num_count}")
+        if download_num > 0 and download_num_count >= download_num:
+            logger.success(
+                f"download_num_count: {download_num_count} == {download_num}"
+            )
+            break
+    if variant_planner is not None:
+        logger.info(variant_planner.summary())
+
+
+def iter_source_awemes(
+    base_path: Path, catalog_query: dict | None = None
+) -> Iterator[tuple[Path, dict]]:
+    return (
+        iter_aweme_json_tree(base_path)
+        if catalog_query is None
+        else iter_catalog_awemes(base_path, catalog_query)
+    )
+
+
+def iter_aweme_json_tree(base_path: Path) -> Iterator[tuple[Path, dict]]:
+    # 只读取aweme.json, 避免把分段下载记录/镜像统计等其他json当成作品数据
+    json_files_generator = base_path.glob("**/aweme.json")
     for json_file in json_files_generator:
         logger.info(f"loading aweme json data: {json_file.as_posix()}")
+        # 逐个读取接口响应, 一次只在内存中保留一页数据
         with open(json_file, "r", encoding="utf-8") as f:
-            load_json_objs = json.load(f)
-        aweme_lists = [
-            obj.get("aweme_list") for obj in load_json_objs if obj.get("aweme_list")
-        ]
-        id_aweme_data_dict_set = [
-            {aweme.get("aweme_id"): aweme}
-            for aweme_list in aweme_lists
-            for aweme in aweme_list
-            if aweme.get("desc") and aweme.get("aweme_id")
-        ]
-
-        for aweme_data in id_aweme_data_dict_set:
-            assert isinstance(
-                aweme_data, dict
-            ), f"Error aweme_data type: {type(aweme_data)}"
-            for aweme_id, data in aweme_data.items():
-                digg_count = data.get("statistics", {}).get("digg_count", 0)
-                nickname = data.get("author", {}).get("nickname", "")
-                formatted_digg_count_str = format_digg_count(digg_count)
-                logger.info(
-                    f"视频id:{aweme_id}, 点赞数: {digg_count}, nickname: {nickname}"
-                )
+            for obj in iter_json_array_items(f):
+                for aweme in obj.get("aweme_list") or []:
+                    if aweme.get("desc") and aweme.get("aweme_id"):
+                        yield json_file.parent, aweme
 
-                desc = data.get("desc", "unknown_desc")
-                sanitized_desc = sanitize_filename(desc)
-                aweme_folder = (
-                    json_file.parent
-                    / f"{sanitized_desc}-{aweme_id}-{formatted_digg_count_str}"
-                )
-                cover_folder, mp3_folder, video_folder, images_folder = [
-                    aweme_folder / folder
-                    for folder in ["cover", "mp3", "video", "images"]
-                ]
-
-                await add_download_tasks(
-                    data,
-                    cover_folder,
-                    mp3_folder,
-                    video_folder,
-                    images_folder,
-                    download_quality,
-                    sanitized_desc,
-                    session,
-                    tasks,
-                )
 
-                download_num_count += 1
-                logger.info(f"download_num_count: {download_num_count}")
-                if download_num > 0 and download_num_count >= download_num:
-                    logger.success(
-                        f"download_num_count: {download_num_count} == {download_num}"
-                    )
-                    break
-            if download_num > 0 and download_num_count >= download_num:
-                break
-    await asyncio.gather(*tasks)
-    if session and isinstance(session, aiohttp.ClientSession) and not session.closed:
-        await session.close()
-    print("[green]\n\nAll download tasks are completed\n[/green]")
+def iter_catalog_awemes(
+    base_path: Path, catalog_query: dict
+) -> Iterator[tuple[Path, dict]]:
+    catalog = AwemeCatalog(base_path)
+    try:
+        for user_dir, data in catalog.iter_awemes(**catalog_query):
+            if data.get("desc") and data.get("aweme_id"):
+                yield user_dir, data
+    finally:
+        catalog.close()
+
+
+def build_aweme_jobs(
+    data: dict,
+    user_dir: Path,
+    download_quality: int | None,
+    race_mirrors: bool = False,
+    include_music: bool = False,
+    include_images: bool = False,
+    folder_index: AwemeFolderIndex | None = None,
+    variant_planner: VariantPlanner | None = None,
+) -> list[DownloadJob]:
+    aweme_id = data.get("aweme_id")
+    digg_count = data.get("statistics", {}).get("digg_count", 0)
+    nickname = data.get("author", {}).get("nickname", "")
+    formatted_digg_count_str = format_digg_count(digg_count)
+    logger.info(f"视频id:{aweme_id}, 点赞数: {digg_count}, nickname: {nickname}")
+
+    desc = data.get("desc", "unknown_desc")
+    sanitized_desc = sanitize_filename(desc)
+    folder_name = f"{sanitized_desc}-{aweme_id}-{formatted_digg_count_str}"
+    aweme_folder = (
+        folder_index.resolve(user_dir, aweme_id, folder_name)
+        if folder_index is not None
+        else user_dir / folder_name
+    )
+    cover_folder, mp3_folder, video_folder, images_folder = [
+        aweme_folder / folder for folder in ["cover", "mp3", "video", "images"]
+    ]
+
+    jobs = []
+    add_download_tasks(
+        data,
+        cover_folder,
+        mp3_folder,
+        video_folder,
+        images_folder,
+        download_quality,
+        sanitized_desc,
+        jobs,
+        race_mirrors,
+        include_music=include_music,
+        include_images=include_images,
+        variant_planner=variant_planner,
+    )
+    return jobs
 
 
-async def add_download_tasks(
+def add_download_tasks(
     data,
     cover_folder,
     mp3_folder,
@@ -222,27 +1650,62 @@ async def add_download_tasks(
     images_folder,
     download_quality,
     sanitized_desc,
-    session,
-    tasks,
+    jobs,
+    race_mirrors=False,
+    include_music=False,
+    include_images=False,
+    variant_planner=None,
 ):
-    await download_cover(data, cover_folder, download_quality, session, tasks)
-    await download_video(
-        data, video_folder, download_quality, sanitized_desc, session, tasks
-    )
-    # await download_music(
-    #     data, mp3_folder, download_quality, sanitized_desc, session, tasks
-    # )
-    # await download_images(
-    #     data, images_folder, download_quality, sanitized_desc, session, tasks
-    # )
+    download_cover(data, cover_folder, download_quality, jobs, race_mirrors)
+    if variant_planner is not None:
+        download_video_variant(
+            data, video_folder, sanitized_desc, jobs, variant_planner, race_mirrors
+        )
+    else:
+        download_video(
+            data, video_folder, download_quality, sanitized_desc, jobs, race_mirrors
+        )
+    if include_music:
+        download_music(data, mp3_folder, download_quality, sanitized_desc, jobs)
+    if include_images:
+        download_images(data, images_folder, download_quality, sanitized_desc, jobs)
 
 
-async def download_cover(data, cover_folder, download_quality, session, tasks):
+def add_mirror_job(url_list, file_path, jobs, aweme_id=None, asset_kind=None):
+    # url_list中的地址是同一个文件的不同镜像, 只下载一份
+    mirror_urls = [
+        url
+        for url in url_list
+        if url and isinstance(url, str) and url.startswith("http")
+    ]
+    if mirror_urls:
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        jobs.append(
+            DownloadJob(
+                mirror_urls[0],
+                file_path,
+                mirror_urls=mirror_urls,
+                aweme_id=aweme_id,
+                asset_key=asset_kind and media_asset_key(asset_kind, mirror_urls[0]),
+            )
+        )
+        logger.info(f"added mirror download task: {len(mirror_urls)} mirrors")
+
+
+def download_cover(data, cover_folder, download_quality, jobs, race_mirrors=False):
     cover_obj = data.get("video", {}).get("cover", {})
     if cover_obj:
         url_list = cover_obj.get("url_list", [])
         if url_list:
-            if not download_quality:
+            if race_mirrors:
+                add_mirror_job(
+                    url_list,
+                    cover_folder / "cover.jpg",
+                    jobs,
+                    data.get("aweme_id"),
+                    asset_kind="cover",
+                )
+            elif not download_quality:
                 for index, cover_url in enumerate(url_list):
                     if (
                         cover_url
@@ -251,9 +1714,12 @@ async def download_cover(data, cover_folder, download_quality, session, tasks):
                     ):
                         cover_path = cover_folder / f"cover_{index}.jpg"
                         cover_path.parent.mkdir(parents=True, exist_ok=True)
-                        tasks.append(
-                            download_file_async(
-                                cover_url, file_save_path=cover_path, session=session
+                        jobs.append(
+                            DownloadJob(
+                                cover_url,
+                                file_save_path=cover_path,
+                                aweme_id=data.get("aweme_id"),
+                                asset_key=media_asset_key("cover", cover_url),
                             )
                         )
                         logger.info(
@@ -268,16 +1734,19 @@ async def download_cover(data, cover_folder, download_quality, session, tasks):
                 ):
                     cover_path = cover_folder / "cover.jpg"
                     cover_path.parent.mkdir(parents=True, exist_ok=True)
-                    tasks.append(
-                        download_file_async(
-                            cover_url, file_save_path=cover_path, session=session
+                    jobs.append(
+                        DownloadJob(
+                            cover_url,
+                            file_save_path=cover_path,
+                            aweme_id=data.get("aweme_id"),
+                            asset_key=media_asset_key("cover", cover_url),
                         )
                     )
                     logger.info(f"added cover_url download task: {cover_url}")
 
 
-async def download_video(
-    data, video_folder, download_quality, sanitized_desc, session, tasks
+def download_video(
+    data, video_folder, download_quality, sanitized_desc, jobs, race_mirrors=False
 ):
     video_obj = data.get("video", {})
     if video_obj:
@@ -285,7 +1754,14 @@ async def download_video(
         if play_addr_obj:
             url_list = play_addr_obj.get("url_list", [])
             if url_list:
-                if not download_quality:
+                if race_mirrors:
+                    add_mirror_job(
+                        url_list,
+                        video_folder / f"{sanitized_desc}.mp4",
+                        jobs,
+                        data.get("aweme_id"),
+                    )
+                elif not download_quality:
                     for index, play_addr_url in enumerate(url_list):
                         if (
                             play_addr_url
@@ -295,11 +1771,12 @@ async def download_video(
                             video_filename = f"{sanitized_desc}_{index}.mp4"
                             video_path = video_folder / video_filename
                             video_path.parent.mkdir(parents=True, exist_ok=True)
-                            tasks.append(
-                                download_file_async(
+                            jobs.append(
+                                DownloadJob(
                                     play_addr_url,
                                     file_save_path=video_path,
-                                    session=session,
+                                    aweme_id=data.get("aweme_id"),
+                                    expected_size=play_addr_obj.get("data_size"),
                                 )
                             )
                             logger.info(
@@ -315,11 +1792,12 @@ async def download_video(
                         video_filename = f"{sanitized_desc}.mp4"
                         video_path = video_folder / video_filename
                         video_path.parent.mkdir(parents=True, exist_ok=True)
-                        tasks.append(
-                            download_file_async(
+                        jobs.append(
+                            DownloadJob(
                                 play_addr_url,
                                 file_save_path=video_path,
-                                session=session,
+                                aweme_id=data.get("aweme_id"),
+                                expected_size=play_addr_obj.get("data_size"),
                             )
                         )
                         logger.info(
@@ -327,14 +1805,40 @@ async def download_video(
                         )
 
 
-async def download_music(
-    data, mp3_folder, download_quality, sanitized_desc, session, tasks
+def download_video_variant(
+    data, video_folder, sanitized_desc, jobs, variant_planner, race_mirrors=False
 ):
+    # 按选择策略从video.bit_rate中选一个版本, 超过预算时不下载
+    variant = variant_planner.choose(data)
+    if variant is None:
+        return
+    video_path = video_folder / f"{sanitized_desc}.mp4"
+    if race_mirrors:
+        add_mirror_job(variant.url_list, video_path, jobs, data.get("aweme_id"))
+        return
+    video_path.parent.mkdir(parents=True, exist_ok=True)
+    jobs.append(
+        DownloadJob(
+            variant.url_list[0],
+            file_save_path=video_path,
+            aweme_id=data.get("aweme_id"),
+            expected_size=variant.data_size or None,
+        )
+    )
+    logger.info(
+        f"added video variant download task: {variant.gear_name or 'play_addr'} "
+        f"{variant.resolution}p {variant.estimated_size} bytes"
+    )
+
+
+def download_music(data, mp3_folder, download_quality, sanitized_desc, jobs):
     music_obj = data.get("music", {})
     if music_obj:
         play_url_obj = music_obj.get("play_url", {})
         if play_url_obj:
             url_list = play_url_obj.get("url_list", [])
+            # 背景音乐被很多作品共用, 用音乐id作为素材键
+            music_id = str(music_obj.get("id") or music_obj.get("mid") or "")
             if url_list:
                 if not download_quality:
                     for index, music_uri in enumerate(url_list):
@@ -346,11 +1850,16 @@ async def download_music(
                             music_filename = f"{sanitized_desc}_{index}.mp3"
                             music_path = mp3_folder / music_filename
                             music_path.parent.mkdir(parents=True, exist_ok=True)
-                            tasks.append(
-                                download_file_async(
+                            jobs.append(
+                                DownloadJob(
                                     music_uri,
                                     file_save_path=music_path,
-                                    session=session,
+                                    aweme_id=data.get("aweme_id"),
+                                    asset_key=media_asset_key(
+                                        "music",
+                                        music_uri,
+                                        music_id and f"{music_id}_{index}",
+                                    ),
                                 )
                             )
                             logger.info(
@@ -366,17 +1875,18 @@ async def download_music(
                         music_filename = f"{sanitized_desc}.mp3"
                         music_path = mp3_folder / music_filename
                         music_path.parent.mkdir(parents=True, exist_ok=True)
-                        tasks.append(
-                            download_file_async(
-                                music_uri, file_save_path=music_path, session=session
+                        jobs.append(
+                            DownloadJob(
+                                music_uri,
+                                file_save_path=music_path,
+                                aweme_id=data.get("aweme_id"),
+                                asset_key=media_asset_key("music", music_uri, music_id),
                             )
                         )
                         logger.info(f"added music_uri download task: {music_uri}")
 
 
-async def download_images(
-    data, images_folder, download_quality, sanitized_desc, session, tasks
-):
+def download_images(data, images_folder, download_quality, sanitized_desc, jobs):
     images = data.get("images")
     if images and isinstance(images, (list, tuple, set)) and len(images) > 0:
         if not download_quality:
@@ -388,9 +1898,12 @@ async def download_images(
                 ):
                     image_path = images_folder / f"{sanitized_desc}_{idx + 1}.jpg"
                     image_path.parent.mkdir(parents=True, exist_ok=True)
-                    tasks.append(
-                        download_file_async(
-                            image_url, file_save_path=image_path, session=session
+                    jobs.append(
+                        DownloadJob(
+                            image_url,
+                            file_save_path=image_path,
+                            aweme_id=data.get("aweme_id"),
+                            asset_key=media_asset_key("image", image_url),
                         )
                     )
                     logger.info(f"added image_url download task: {image_url}")
@@ -403,9 +1916,12 @@ async def download_images(
             ):
                 image_path = images_folder / f"{sanitized_desc}.jpg"
                 image_path.parent.mkdir(parents=True, exist_ok=True)
-                tasks.append(
-                    download_file_async(
-                        image_url, file_save_path=image_path, session=session
+                jobs.append(
+                    DownloadJob(
+                        image_url,
+                        file_save_path=image_path,
+                        aweme_id=data.get("aweme_id"),
+                        asset_key=media_asset_key("image", image_url),
                     )
                 )
                 logger.info(f"added image_url download task: {image_url}")
@@ -1,7 +1,4 @@
-from download_videos import download_main
-from playwright_dy import (
-    save_user_videos_aneme_jsonobjs_async,
-)
+from crawl_pipeline import crawl_and_download
 import asyncio
 from loguru import logger
 import shutil
@@ -43,15 +40,20 @@ user_home_page_urls = list(
 # shutil.rmtree("datatest", ignore_errors=True)
 data_dir = "datatest"
 if __name__ == "__main__":
-    # 保存用户视频信息,如果用户视频信息已经保存过,注释掉这行代码，直接下载视频
+    # 边抓取边下载: 抓取到的作品直接进入下载队列, 同时保存用户视频信息(aweme.json)
     return_datas = asyncio.run(
-        save_user_videos_aneme_jsonobjs_async(
-            user_home_page_urls, data_dir  # , headless=True
+        crawl_and_download(
+            user_home_page_urls,
+            data_dir,
+            # crawl_kwargs=dict(headless=True),
+            download_kwargs=dict(download_quality=-1, download_num=0),
         )
     )
     # print(return_datas)
-    # 下载视频
-    asyncio.run(
-        download_main(data_save_path=data_dir, download_quality=-1, download_num=0)
-    )
+    # 如果用户视频信息已经保存过, 注释掉上面的代码, 直接下载视频
+    # from download_videos import download_main
+    #
+    # asyncio.run(
+    #     download_main(data_save_path=data_dir, download_quality=-1, download_num=0)
+    # )
     # -1表示下载最高清晰度，0表示下载所有视频
@@ -0,0 +1,82 @@
+import json
+from dataclasses import dataclass, asdict, field
+from pathlib import Path
+from urllib.parse import urlsplit
+from loguru import logger
+
+
+@dataclass
+class HostStats:
+    # 首字节时间的指数移动平均(秒), None表示还没有成功过
+    ttfb: float | None = None
+    successes: int = 0
+    failures: int = 0
+
+    @property
+    def error_rate(self) -> float:
+        total = self.successes + self.failures
+        return self.failures / total if total else 0.0
+
+
+@dataclass
+class MirrorStats:
+    """
+    记录每个CDN域名的首字节延迟和错误率, 用于给镜像url排序
+    没有记录的域名排在前面, 这样新的镜像也会被尝试到
+    """
+
+    alpha: float = 0.3
+    error_penalty: float = 5.0
+    hosts: dict[str, HostStats] = field(default_factory=dict)
+
+    @staticmethod
+    def host_of(url: str) -> str:
+        return urlsplit(url).netloc
+
+    def _host(self, url: str) -> HostStats:
+        return self.hosts.setdefault(self.host_of(url), HostStats())
+
+    def record_success(self, url: str, ttfb: float) -> None:
+        host = self._host(url)
+        host.successes += 1
+        host.ttfb = (
+            ttfb
+            if host.ttfb is None
+            else self.alpha * ttfb + (1 - self.alpha) * host.ttfb
+        )
+
+    def record_failure(self, url: str) -> None:
+        self._host(url).failures += 1
+
+    def score(self, url: str) -> float:
+        host = self.hosts.get(self.host_of(url))
+        if host is None:
+            return 0.0
+        ttfb = host.ttfb if host.ttfb is not None else 1.0
+        return ttfb * (1 + self.error_penalty * host.error_rate)
+
+    def rank(self, urls: list[str]) -> list[str]:
+        # sorted是稳定排序, 分数相同时保持接口返回的顺序
+        return sorted(urls, key=self.score)
+
+    def save(self, path: str | Path) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(
+                {host: asdict(stats) for host, stats in self.hosts.items()},
+                f,
+                indent=4,
+                ensure_ascii=False,
+            )
+
+    @classmethod
+    def load(cls, path: str | Path) -> "MirrorStats":
+        mirror_stats = cls()
+        if Path(path).exists():
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    mirror_stats.hosts = {
+                        host: HostStats(**stats) for host, stats in json.load(f).items()
+                    }
+            except (ValueError, TypeError) as e:
+                logger.warning(f"Ignoring broken mirror stats file {path}: {e}")
+        return mirror_stats
@@ -2,36 +2,98 @@ import asyncio
 import json
 import os
 import re
+import time
 from pathlib import Path
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from functools import lru_cache
-from typing import List, Dict, Tuple, Any
-from playwright.async_api import async_playwright, Page, Request, Route, Response
+from typing import Awaitable, Callable, List, Dict, Tuple, Any, Set
+from playwright.async_api import async_playwright, Page, Response
+from request_router import RequestRouter, DEFAULT_BLOCK_RESOURCE_TYPES
+from aweme_catalog import AwemeCatalog
+from run_metrics import MetricsReporter, RunMetrics
+from crawl_replay import CrawlReplay
 from loguru import logger
 from rich import print
 
 
-async def handle_route_banimg_and_media(route: Route, request: Request) -> None:
-    if request.resource_type in ["image", "media"]:
-        await route.abort()
-        logger.debug(f"Abort: {request.url}")
-    else:
-        await route.continue_()
+class AwemeCollector:
+    """
+    收集hook到的aweme/post响应
+    每来一页就增量更新去重集合和计数, 并通知滚动循环, 不需要每次重新遍历所有响应;
+    调用stream_to后每一页的新作品同时交给on_awemes(边抓取边下载)
+    """
 
+    def __init__(self, metrics: RunMetrics | None = None):
+        self.metrics = metrics
+        self.jsons: List[Dict[str, Any]] = []
+        self.aweme_keys: Set[Tuple[str, str]] = set()
+        self.known_aweme_ids: Set[str] = set()
+        self.reached_known_aweme = False
+        self.new_page_event = asyncio.Event()
+        # 第一个aweme/post请求的url(已经带有签名参数), 接口翻页时以它为模板
+        self.first_post_url: str | None = None
+        self.user_dir: Path | None = None
+        self.on_awemes: Callable[[Path, List[Dict[str, Any]]], None] | None = None
+        self.streamed_aweme_ids: Set[str] = set()
 
-async def handle_special_block_urls_keywords(route: Route, request: Request) -> None:
-    block_urls_keywords = ["lf-douyin-pc-web", "If9-sec", "bytetos"]
-    if any(keyword in request.url for keyword in block_urls_keywords):
-        await route.abort()
-        logger.debug(f"Abort: {request.url}")
-    else:
-        await route.continue_()
+    @property
+    def count(self) -> int:
+        return len(self.aweme_keys)
+
+    def add(self, response_json: Dict[str, Any], url: str | None = None) -> None:
+        if self.first_post_url is None:
+            self.first_post_url = url
+        self.jsons.append(response_json)
+        if self.metrics is not None:
+            self.metrics.page_crawled()
+        self.aweme_keys.update(
+            (aweme.get("aweme_id"), aweme.get("desc"))
+            for aweme in response_json.get("aweme_list") or []
+            if aweme.get("desc")
+        )
+        if self.known_aweme_ids and is_known_aweme_page(
+            response_json, self.known_aweme_ids
+        ):
+            self.reached_known_aweme = True
+        if self.on_awemes is not None:
+            self.stream(response_json)
+        self.new_page_event.set()
+
+    def set_known_aweme_ids(self, known_aweme_ids: Set[str]) -> None:
+        # 设置前可能已经收到了几页, 补充检查一次
+        self.known_aweme_ids = known_aweme_ids
+        if known_aweme_ids and any(
+            is_known_aweme_page(obj, known_aweme_ids) for obj in self.jsons
+        ):
+            self.reached_known_aweme = True
+
+    def stream_to(
+        self,
+        user_dir: Path,
+        on_awemes: Callable[[Path, List[Dict[str, Any]]], None],
+    ) -> None:
+        # 用户目录要等读到昵称和抖音号才能确定, 之前收到的页面在这里补发
+        self.user_dir = user_dir
+        self.on_awemes = on_awemes
+        for obj in self.jsons:
+            self.stream(obj)
+
+    def stream(self, response_json: Dict[str, Any]) -> None:
+        aweme_list = [
+            aweme
+            for aweme in response_json.get("aweme_list") or []
+            if aweme.get("aweme_id") not in self.streamed_aweme_ids
+        ]
+        self.streamed_aweme_ids.update(aweme.get("aweme_id") for aweme in aweme_list)
+        if aweme_list:
+            self.on_awemes(self.user_dir, aweme_list)
 
 
-async def handle_response(response: Response, jsons: List[Dict[str, Any]]) -> None:
+async def handle_response(response: Response, collector: AwemeCollector) -> None:
     if "aweme/v1/web/aweme/post" in response.url:
         try:
             response_json = await response.json()
-            jsons.append(response_json)
+            collector.add(response_json, response.url)
             logger.debug(f"Hooked: {response.url}")
         except Exception as e:
             logger.error(f"Error processing response: {e}")
@@ -65,50 +127,263 @@ async def match_expected_works_count(page: Page) -> str:
 
 
 async def roll_page_and_get_all_aweme(
-    page: Page, jsons: List[Dict[str, Any]], expected_works_count: int
+    page: Page,
+    collector: AwemeCollector,
+    expected_works_count: int,
+    min_wait: float = 0.5,
+    max_wait: float = 8,
+    max_idle_time: float = 120,
 ) -> None:
+    """
+    滚动到最后一个作品, 然后等待新的一页响应到达(或超时)再继续滚动;
+    没有新数据时等待时间指数增加(min_wait到max_wait), 连续max_idle_time秒没有新数据就停止
+    """
+    last_li = page.locator(
+        "#douyin-right-container > div.parent-route-container.route-scroll-container.IhmVuo1S > div > div > div > div.XA9ZQ2av > div > div > div.z_YvCWYy.Klp5EcJu > div.N8dcwU0m > div.pCVdP6Bb > ul > li"
+    ).last
+    end_tag = page.locator("div.gqga5U3W > div.E5QmyeTo", has_text="暂时没有更多了")
+    wait_time = min_wait
+    idle_time = 0.0
     while True:
-        scroll_div_li_list = await page.query_selector_all(
-            "#douyin-right-container > div.parent-route-container.route-scroll-container.IhmVuo1S > div > div > div > div.XA9ZQ2av > div > div > div.z_YvCWYy.Klp5EcJu > div.N8dcwU0m > div.pCVdP6Bb > ul > li"
-        )
-        if scroll_div_li_list:
-            await scroll_div_li_list[-1].scroll_into_view_if_needed()
+        # 滚动之前清除, 滚动过程中到达的响应也算新的一页
+        collector.new_page_event.clear()
+        if await last_li.count():
+            await last_li.scroll_into_view_if_needed()
             print("滚动页面 scroll_div_li_list[-1]")
-        end_tag = page.locator("div.gqga5U3W > div.E5QmyeTo", has_text="暂时没有更多了")
-        current_count = par_jsons(jsons)
-        if await end_tag.is_visible() or current_count >= int(expected_works_count):
-            print(
-                "没有更多了"
-                if await end_tag.is_visible()
-                else "当前作品数量已经达到总作品数量"
-            )
+        try:
+            await asyncio.wait_for(collector.new_page_event.wait(), timeout=wait_time)
+            wait_time = min_wait
+            idle_time = 0.0
+        except asyncio.TimeoutError:
+            idle_time += wait_time
+            wait_time = min(wait_time * 2, max_wait)
+        if collector.reached_known_aweme:
+            # 增量模式: 某一页(不算置顶作品)全是已经保存过的作品, 后面的也都保存过了
+            print("已经读取到之前保存过的作品, 停止滚动")
+            break
+        current_count = collector.count
+        if current_count >= int(expected_works_count):
+            print("当前作品数量已经达到总作品数量")
+            break
+        if idle_time and await end_tag.is_visible():
+            print("没有更多了")
+            break
+        if idle_time >= max_idle_time:
+            logger.warning(f"{max_idle_time}秒内没有新的作品数据, 停止滚动")
             break
         print(f"当前读取作品数量: {current_count}，总作品数量: {expected_works_count}")
 
 
-def par_jsons(jsons: List[Dict[str, Any]]) -> int:
-    aweme_lists = [obj.get("aweme_list") for obj in jsons if obj.get("aweme_list")]
-    video_informations = {
-        (aweme.get("aweme_id"), aweme.get("desc"))
-        for aweme_list in aweme_lists
-        for aweme in aweme_list
-        if aweme.get("desc")
+# 在页面内发起XHR请求, 抖音页面的脚本会给XHR加上签名参数, cookie也由浏览器自动带上;
+# 响应本身由handle_response hook到, 这里只返回状态码, 长度和这个请求自己的翻页游标
+FETCH_IN_PAGE_JS = """
+async (url) => {
+    return await new Promise((resolve) => {
+        const xhr = new XMLHttpRequest();
+        xhr.open("GET", url, true);
+        xhr.withCredentials = true;
+        xhr.onload = () => {
+            let cursor = {};
+            try {
+                const body = JSON.parse(xhr.responseText);
+                cursor = {max_cursor: body.max_cursor, has_more: body.has_more};
+            } catch (e) {}
+            resolve({status: xhr.status, length: xhr.responseText.length, ...cursor});
+        };
+        xhr.onerror = () => resolve({status: 0, length: 0});
+        xhr.send();
+    });
+}
+"""
+
+
+def build_next_post_url(first_post_url: str, max_cursor: int | str) -> str:
+    """替换max_cursor, 去掉旧的签名参数, 由页面脚本重新签名"""
+    url_parts = urlsplit(first_post_url)
+    query = [
+        (key, value)
+        for key, value in parse_qsl(url_parts.query, keep_blank_values=True)
+        if key not in ("max_cursor", "a_bogus", "X-Bogus")
+    ]
+    query.append(("max_cursor", str(max_cursor)))
+    return urlunsplit(url_parts._replace(query=urlencode(query)))
+
+
+async def fetch_all_aweme_by_api(
+    page: Page,
+    collector: AwemeCollector,
+    expected_works_count: int,
+    first_page_timeout: float = 15,
+    page_timeout: float = 15,
+    request_interval: float = 0.3,
+) -> bool:
+    """
+    不滚动页面, 直接在页面上下文中按max_cursor/has_more翻页请求aweme/post接口
+    游标取自页面自己的第一个请求, 之后只用我们发出的请求返回的游标,
+    不依赖响应到达的顺序, 也不受页面其他aweme/post请求的影响;
+    返回False表示接口翻页失败(例如签名没有生效返回空内容), 调用方应退回滚动方式
+    """
+    if not collector.jsons:
+        try:
+            await asyncio.wait_for(
+                collector.new_page_event.wait(), timeout=first_page_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("没有捕获到aweme/post请求, 无法使用接口翻页")
+            return False
+    max_cursor = collector.jsons[0].get("max_cursor", 0)
+    has_more = collector.jsons[0].get("has_more")
+    while True:
+        if collector.reached_known_aweme:
+            print("已经读取到之前保存过的作品, 停止翻页")
+            return True
+        if not has_more or collector.count >= int(expected_works_count):
+            print("没有更多了")
+            return True
+        print(
+            f"当前读取作品数量: {collector.count}，总作品数量: {expected_works_count}"
+        )
+        next_url = build_next_post_url(collector.first_post_url, max_cursor)
+        collector.new_page_event.clear()
+        result = await page.evaluate(FETCH_IN_PAGE_JS, next_url)
+        if (
+            result.get("status") != 200
+            or not result.get("length")
+            or "has_more" not in result
+        ):
+            logger.warning(f"接口翻页失败: {result}, 退回滚动方式")
+            return False
+        max_cursor = result.get("max_cursor", 0)
+        has_more = result["has_more"]
+        try:
+            await asyncio.wait_for(
+                collector.new_page_event.wait(), timeout=page_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("接口翻页响应没有被捕获, 退回滚动方式")
+            return False
+        await asyncio.sleep(request_interval)
+
+
+def is_known_aweme_page(obj: Dict[str, Any], known_aweme_ids: Set[str]) -> bool:
+    not_top_aweme_ids = [
+        aweme.get("aweme_id")
+        for aweme in obj.get("aweme_list") or []
+        if not aweme.get("is_top")
+    ]
+    return bool(not_top_aweme_ids) and all(
+        aweme_id in known_aweme_ids for aweme_id in not_top_aweme_ids
+    )
+
+
+def user_aweme_json_path(
+    data_save_dir: str | Path, name: str, douyin_number: str
+) -> Path:
+    return Path(
+        f"{data_save_dir}/{re.sub(r'[<>:\"/\\|?*]', '', name)}_{re.sub(r'[<>:\"/\\|?*]', '', douyin_number)}/aweme.json"
+    )
+
+
+def load_aweme_jsons(aweme_json_path: Path) -> List[Dict[str, Any]]:
+    if not aweme_json_path.exists():
+        return []
+    with open(aweme_json_path, "r", encoding="UTF-8") as f:
+        return json.load(f)
+
+
+def get_aweme_ids(jsons: List[Dict[str, Any]]) -> Set[str]:
+    return {
+        aweme.get("aweme_id")
+        for obj in jsons
+        for aweme in obj.get("aweme_list") or []
+        if aweme.get("aweme_id")
     }
-    return len(video_informations)
+
+
+def merge_aweme_jsons(
+    new_jsons: List[Dict[str, Any]], old_jsons: List[Dict[str, Any]]
+) -> List[Dict[str, Any]]:
+    """新抓取的响应在前, 旧响应中去掉重复的作品(以新数据为准), 去掉后为空的响应丢弃"""
+    new_aweme_ids = get_aweme_ids(new_jsons)
+    merged_jsons = list(new_jsons)
+    for obj in old_jsons:
+        aweme_list = [
+            aweme
+            for aweme in obj.get("aweme_list") or []
+            if aweme.get("aweme_id") not in new_aweme_ids
+        ]
+        if aweme_list:
+            merged_jsons.append({**obj, "aweme_list": aweme_list})
+    return merged_jsons
 
 
 async def parse_home_page(
-    page: Page, user_home_url: str, isloaded: bool
+    page: Page,
+    user_home_url: str,
+    isloaded: bool,
+    data_save_dir: str | None = None,
+    incremental: bool = False,
+    crawl_engine: str = "scroll",
+    request_router: RequestRouter | None = None,
+    metrics: RunMetrics | None = None,
+    on_awemes: Callable[[Path, List[Dict[str, Any]]], None] | None = None,
 ) -> Dict[str, Any]:
-    jsons = []
-    page.on(
-        "response",
-        lambda response: asyncio.create_task(handle_response(response, jsons)),
-    )
+    """
+    crawl_engine: "scroll"滚动页面抓取, "api"在页面上下文中直接按游标请求接口翻页
+    request_router: 请求拦截规则, 默认拦截图片/视频/字体/websocket/埋点/直播等请求,
+    api方式不依赖页面布局, 默认还会拦截样式表
+    on_awemes: 每收到一页就调用on_awemes(用户目录, 新作品列表), 需要data_save_dir
+    """
+    assert crawl_engine in ("scroll", "api"), "crawl_engine must be 'scroll' or 'api'"
+    if request_router is None:
+        request_router = RequestRouter(
+            block_resource_types=(
+                (*DEFAULT_BLOCK_RESOURCE_TYPES, "stylesheet")
+                if crawl_engine == "api"
+                else DEFAULT_BLOCK_RESOURCE_TYPES
+            )
+        )
+    collector = AwemeCollector(metrics)
+
+    def on_response(response: Response) -> None:
+        asyncio.create_task(handle_response(response, collector))
+
+    page.on("response", on_response)
     if isloaded:
-        await page.route("**/*", handle_special_block_urls_keywords)
-        await page.route("**/*", handle_route_banimg_and_media)
+        await request_router.attach(page)
+    try:
+        data = await _parse_home_page(
+            page,
+            collector,
+            user_home_url,
+            data_save_dir,
+            incremental,
+            crawl_engine,
+            on_awemes,
+        )
+    finally:
+        # 页面会被页面池复用, 解除本次注册的监听和路由
+        page.remove_listener("response", on_response)
+        if isloaded:
+            await request_router.detach(page)
+    logger.info(f"{data['name']} 请求统计: {request_router.stats.summary()}")
+    if metrics is not None:
+        metrics.profiles_crawled += 1
+    data["request_stats"] = request_router.stats
+    return data
+
+
+async def _parse_home_page(
+    page: Page,
+    collector: AwemeCollector,
+    user_home_url: str,
+    data_save_dir: str | None,
+    incremental: bool,
+    crawl_engine: str,
+    on_awemes: Callable[[Path, List[Dict[str, Any]]], None] | None = None,
+) -> Dict[str, Any]:
     logger.debug("正在打开对应抖音用户主页")
+    start_time = time.perf_counter()
     await page.goto(
         user_home_url,
         wait_until="domcontentloaded",
@@ -121,22 +396,91 @@ async def parse_home_page(
     logger.info(f"抖音号: {douyin_number}")
     logger.info(f"用户昵称: {name}")
     logger.info(f"总作品数量: {expected_works_count}")
-    await roll_page_and_get_all_aweme(page, jsons, expected_works_count)
-    return {"jsons": jsons, "douyin_number": douyin_number, "name": name}
+    loaded_time = time.perf_counter()
+    if incremental and data_save_dir:
+        collector.set_known_aweme_ids(
+            get_aweme_ids(
+                load_aweme_jsons(
+                    user_aweme_json_path(data_save_dir, name, douyin_number)
+                )
+            )
+        )
+        logger.info(f"增量模式, 已保存作品数量: {len(collector.known_aweme_ids)}")
+    if on_awemes is not None and data_save_dir:
+        collector.stream_to(
+            user_aweme_json_path(data_save_dir, name, douyin_number).parent, on_awemes
+        )
+    if crawl_engine != "api" or not await fetch_all_aweme_by_api(
+        page, collector, expected_works_count
+    ):
+        await roll_page_and_get_all_aweme(page, collector, expected_works_count)
+    return {
+        "jsons": collector.jsons,
+        "douyin_number": douyin_number,
+        "name": name,
+        "expected_works_count": expected_works_count,
+        "incremental": bool(collector.known_aweme_ids),
+        # 打开主页并读取用户信息的耗时, 翻页抓取作品的耗时(秒)
+        "timings": {
+            "load": loaded_time - start_time,
+            "crawl": time.perf_counter() - loaded_time,
+        },
+    }
 
 
 async def print_aweme_responses(
-    user_home_urls: List[str], headless: bool = None
+    user_home_urls: List[str],
+    headless: bool = None,
+    data_save_dir: str | None = None,
+    incremental: bool = False,
+    crawl_engine: str = "scroll",
+    max_pages: int = 4,
+    browser_processes: int = 1,
+    contexts_per_browser: int = 1,
+    profile_timeout: float | None = 1800,
+    metrics: RunMetrics | None = None,
+    replay: CrawlReplay | None = None,
+    on_awemes: Callable[[Path, List[Dict[str, Any]]], None] | None = None,
+    on_profile: Callable[[Dict[str, Any]], Awaitable[Any]] | None = None,
 ) -> List[Dict[str, Any]]:
+    """
+    用有上限的页面池抓取多个用户主页
+    最多同时打开max_pages个页面, 页面抓取完一个用户后复用给下一个用户;
+    页面轮流分布在browser_processes个浏览器进程 x contexts_per_browser个上下文中,
+    多个浏览器进程可以利用多核; 单个用户超过profile_timeout秒没有完成就跳过
+    replay: 录制抓取会话到HAR, 或者从HAR离线回放(不需要登录, 不访问网络)
+    on_awemes见parse_home_page; 每个用户抓取完成时await on_profile(data), 不用等所有用户都抓取完
+    """
+    assert (
+        isinstance(max_pages, int) and max_pages > 0
+    ), "max_pages must be a positive integer"
+    assert (
+        isinstance(browser_processes, int) and browser_processes > 0
+    ), "browser_processes must be a positive integer"
+    assert (
+        isinstance(contexts_per_browser, int) and contexts_per_browser > 0
+    ), "contexts_per_browser must be a positive integer"
+    assert (
+        replay is None
+        or replay.offline
+        or (browser_processes == 1 and contexts_per_browser == 1)
+    ), "recording a crawl session needs a single browser context"
     async with async_playwright() as p:
-        isloaded = os.path.exists("state.json")
-        browser = await p.chromium.launch(
-            headless=(headless if headless is not None else isloaded),
-            args=["--incognito", "--disable-gpu"],
-        )
-        context = await browser.new_context(
-            storage_state="state.json" if isloaded else None
+        has_state = os.path.exists("state.json")
+        # 回放时不需要登录
+        isloaded = has_state or (replay is not None and replay.offline)
+        browsers = [
+            await p.chromium.launch(
+                headless=(headless if headless is not None else isloaded),
+                args=["--incognito", "--disable-gpu"],
+            )
+            for _ in range(browser_processes)
+        ]
+        context = await browsers[0].new_context(
+            storage_state="state.json" if has_state else None
         )
+        if replay is not None:
+            await replay.attach(context)
         if not isloaded:
             page = await context.new_page()
             logger.debug("等待用户登录")
@@ -150,49 +494,178 @@ async def print_aweme_responses(
             )
             logger.debug("登录成功")
             await context.storage_state(path="state.json")
+        contexts = [context]
+        for browser_index, browser in enumerate(browsers):
+            for _ in range(contexts_per_browser - (1 if browser_index == 0 else 0)):
+                extra_context = await browser.new_context(
+                    storage_state="state.json" if os.path.exists("state.json") else None
+                )
+                if replay is not None:
+                    await replay.attach(extra_context)
+                contexts.append(extra_context)
+        page_pool: asyncio.Queue[Page] = asyncio.Queue()
+        for index in range(min(max_pages, len(user_home_urls))):
+            await page_pool.put(await contexts[index % len(contexts)].new_page())
+
+        async def crawl(user_home_url: str) -> Dict[str, Any] | None:
+            page = await page_pool.get()
+            try:
+                return await asyncio.wait_for(
+                    parse_home_page(
+                        page,
+                        user_home_url,
+                        isloaded,
+                        data_save_dir,
+                        incremental,
+                        crawl_engine,
+                        metrics=metrics,
+                        on_awemes=on_awemes,
+                    ),
+                    timeout=profile_timeout,
+                )
+            except asyncio.TimeoutError:
+                logger.error(f"抓取超时({profile_timeout}s), 跳过: {user_home_url}")
+                # 超时的页面状态不确定, 换一个新页面放回池中
+                page_context = page.context
+                await page.close()
+                page = await page_context.new_page()
+                return None
+            finally:
+                await page_pool.put(page)
+
         datas = []
         try:
             for future in asyncio.as_completed(
-                [
-                    parse_home_page(await context.new_page(), user_home_url, isloaded)
-                    for user_home_url in user_home_urls
-                ]
+                [crawl(user_home_url) for user_home_url in user_home_urls]
             ):
-                datas.append(await future)
-            await context.storage_state(path="state.json")
-            await browser.close()
+                data = await future
+                if data is not None:
+                    datas.append(data)
+                    if on_profile is not None:
+                        await on_profile(data)
+            if replay is None or not replay.offline:
+                await context.storage_state(path="state.json")
+            # 录制的HAR在上下文关闭时写入
+            for page_context in contexts:
+                await page_context.close()
+            for browser in browsers:
+                await browser.close()
             return datas
         except Exception as e:
             logger.error(f"Error: {e}")
-            if os.path.exists("state.json"):
+            if os.path.exists("state.json") and (replay is None or not replay.offline):
                 acf = input("是否删除state.json文件然后继续(y/n): ")
                 if acf.lower() == "y":
                     logger.debug("删除state.json")
                     os.remove("state.json")
                     logger.debug("重试开始")
-                    return await print_aweme_responses(user_home_urls, headless)
+                    return await print_aweme_responses(
+                        user_home_urls,
+                        headless,
+                        data_save_dir,
+                        incremental,
+                        crawl_engine,
+                        max_pages,
+                        browser_processes,
+                        contexts_per_browser,
+                        profile_timeout,
+                        metrics,
+                        replay,
+                        on_awemes,
+                        on_profile,
+                    )
             raise e
 
 
 async def save_user_videos_aneme_jsonobjs_async(
-    user_home_urls: List[str], data_save_dir: str = "data", headless: bool = None
+    user_home_urls: List[str],
+    data_save_dir: str = "data",
+    headless: bool = None,
+    incremental: bool = False,
+    crawl_engine: str = "scroll",
+    max_pages: int = 4,
+    browser_processes: int = 1,
+    contexts_per_browser: int = 1,
+    profile_timeout: float | None = 1800,
+    update_catalog: bool = True,
+    metrics_interval: float = 1.0,
+    metrics_port: int | None = None,
+    replay: CrawlReplay | None = None,
+    on_awemes: Callable[[Path, List[Dict[str, Any]]], None] | None = None,
 ) -> List[Dict[str, str]]:
-    datas = await print_aweme_responses(user_home_urls, headless)
+    """
+    incremental=True时只抓取aweme.json中还没有的新作品, 并合并到原文件中
+    update_catalog=True时同时把作品写入数据目录下的索引(catalog.sqlite3)
+    crawl_engine="api"时不滚动页面, 直接按游标翻页请求接口
+    max_pages/browser_processes/contexts_per_browser/profile_timeout见print_aweme_responses
+    抓取指标(每分钟翻页数等)写到{data_save_dir}/crawl_metrics.json, metrics_port见download_main
+    replay=CrawlReplay(har_path, "record"/"replay")时录制或离线回放抓取会话
+    on_awemes见parse_home_page, 每个用户抓取完成时就保存aweme.json并更新索引
+    """
+    Path(data_save_dir).mkdir(parents=True, exist_ok=True)
+    metrics = RunMetrics("crawl")
     return_datas = []
-    for data in datas:
-        jsons = data.get("jsons")
-        douyin_number = data.get("douyin_number")
-        name = data.get("name")
-        save_path = Path(
-            f"{data_save_dir}/{re.sub(r'[<>:\"/\\|?*]', '', name)}_{re.sub(r'[<>:\"/\\|?*]', '', douyin_number)}/aweme.json"
-        )
-        save_path.parent.mkdir(parents=True, exist_ok=True)
-        with open(save_path, "w", encoding="UTF-8") as f:
-            logger.success(
-                f"抖音{name}_{douyin_number},保存视频anemejsonlist数据到: {save_path.as_posix()}"
+    catalog = AwemeCatalog(data_save_dir) if update_catalog else None
+
+    async def on_profile(data: Dict[str, Any]) -> None:
+        return_datas.append(await save_user_aweme_jsons(data, data_save_dir, catalog))
+
+    async with MetricsReporter(
+        metrics,
+        Path(data_save_dir) / "crawl_metrics.json",
+        interval=metrics_interval,
+        prometheus_port=metrics_port,
+    ):
+        try:
+            await print_aweme_responses(
+                user_home_urls,
+                headless,
+                data_save_dir,
+                incremental,
+                crawl_engine,
+                max_pages,
+                browser_processes,
+                contexts_per_browser,
+                profile_timeout,
+                metrics,
+                replay,
+                on_awemes,
+                on_profile,
             )
-            json.dump(jsons, f, indent=4, ensure_ascii=False)
-        return_datas.append(
-            {"douyin_number": douyin_number, "name": name, "save_path": save_path}
-        )
+        finally:
+            if catalog is not None:
+                catalog.close()
     return return_datas
+
+
+def write_aweme_jsons(
+    save_path: Path, jsons: List[Dict[str, Any]], incremental: bool = False
+) -> List[Dict[str, Any]]:
+    """写入aweme.json, incremental时先合并原文件中的作品, 返回写入的内容"""
+    save_path.parent.mkdir(parents=True, exist_ok=True)
+    if incremental:
+        jsons = merge_aweme_jsons(jsons, load_aweme_jsons(save_path))
+    with open(save_path, "w", encoding="UTF-8") as f:
+        json.dump(jsons, f, indent=4, ensure_ascii=False)
+    return jsons
+
+
+async def save_user_aweme_jsons(
+    data: Dict[str, Any], data_save_dir: str, catalog: AwemeCatalog | None = None
+) -> Dict[str, Any]:
+    """
+    读写文件在线程中进行, 不卡住还在抓取的页面;
+    索引的数据库连接只能在创建它的线程中使用, 在事件循环中更新
+    """
+    douyin_number = data.get("douyin_number")
+    name = data.get("name")
+    save_path = user_aweme_json_path(data_save_dir, name, douyin_number)
+    logger.success(
+        f"抖音{name}_{douyin_number},保存视频anemejsonlist数据到: {save_path.as_posix()}"
+    )
+    jsons = await asyncio.to_thread(
+        write_aweme_jsons, save_path, data.get("jsons"), bool(data.get("incremental"))
+    )
+    if catalog is not None:
+        catalog.upsert_aweme_jsons(jsons, save_path.parent)
+    return {"douyin_number": douyin_number, "name": name, "save_path": save_path}
@@ -0,0 +1,284 @@
+import asyncio
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field, replace
+from pathlib import Path
+from typing import AsyncIterator
+from urllib.parse import urlsplit
+from loguru import logger
+
+# CDN限流/拒绝时返回的状态码
+THROTTLE_STATUSES = frozenset({403, 429, 503})
+
+# 小文件(封面/图片)的后缀, 其他文件(视频/音乐)都算大文件
+SMALL_FILE_SUFFIXES = frozenset({".jpg", ".jpeg", ".png", ".webp", ".gif", ".avif"})
+
+
+@dataclass
+class PoolConfig:
+    """
+    一个下载池的限流参数, 所有值都是针对单个域名的
+    并发数和每秒请求数都按AIMD调整: 成功时加性增加, 被限流/延迟突增时乘性减少
+    """
+
+    initial_concurrency: int = 4
+    min_concurrency: int = 1
+    max_concurrency: int = 16
+    # 每秒请求数(令牌桶)
+    rate: float = 5.0
+    min_rate: float = 0.5
+    max_rate: float = 20.0
+    burst: int = 5
+    rate_increase: float = 0.2
+    # 被限流时乘以throttle_decrease, 延迟突增/连接出错时乘以congestion_decrease
+    throttle_decrease: float = 0.5
+    congestion_decrease: float = 0.8
+    # 首字节时间超过平均值latency_factor倍算延迟突增
+    latency_factor: float = 3.0
+    latency_alpha: float = 0.2
+    # 两次减速之间至少间隔的秒数, 同一批并发请求一起失败时只减一次
+    decrease_cooldown: float = 2.0
+
+
+DEFAULT_POOL_CONFIGS = {
+    "small": PoolConfig(
+        initial_concurrency=8,
+        max_concurrency=32,
+        rate=20.0,
+        max_rate=100.0,
+        burst=20,
+        rate_increase=1.0,
+    ),
+    "large": PoolConfig(),
+}
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: int):
+        assert rate > 0, "rate must be positive"
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = asyncio.get_running_loop().time()
+
+    def _refill(self) -> None:
+        now = asyncio.get_running_loop().time()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self) -> None:
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class HostLimiter:
+    """单个域名的令牌桶 + AIMD并发限制"""
+
+    def __init__(self, host: str, config: PoolConfig):
+        self.host = host
+        self.config = config
+        self.concurrency = float(config.initial_concurrency)
+        self.bucket = TokenBucket(config.rate, config.burst)
+        self.active = 0
+        self.latency: float | None = None
+        self.successes = 0
+        self.throttled = 0
+        self.congested = 0
+        self.last_decrease = float("-inf")
+        self._waiters: deque[asyncio.Future] = deque()
+
+    @property
+    def limit(self) -> int:
+        return max(self.config.min_concurrency, int(self.concurrency))
+
+    async def acquire(self) -> None:
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # 已经分到并发名额后才被取消, 把名额还回去
+                    self.release()
+                else:
+                    self._waiters.remove(waiter)
+                raise
+        try:
+            await self.bucket.acquire()
+        except BaseException:
+            self.release()
+            raise
+
+    def release(self) -> None:
+        self.active -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self) -> None:
+        while self._waiters and self.active < self.limit:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                self.active += 1
+                waiter.set_result(None)
+
+    def on_success(self, latency: float) -> None:
+        config = self.config
+        self.successes += 1
+        if (
+            self.latency is not None
+            and self.successes > 5
+            and latency > self.latency * config.latency_factor
+        ):
+            self.on_congestion()
+        else:
+            # 每个并发窗口的请求都成功后并发数大约加1
+            self.concurrency = min(
+                config.max_concurrency, self.concurrency + 1 / self.concurrency
+            )
+            self.bucket.rate = min(
+                config.max_rate, self.bucket.rate + config.rate_increase
+            )
+            self._wake_waiters()
+        self.latency = (
+            latency
+            if self.latency is None
+            else config.latency_alpha * latency
+            + (1 - config.latency_alpha) * self.latency
+        )
+
+    def on_throttle(self, status: int) -> None:
+        self.throttled += 1
+        if self._decrease(self.config.throttle_decrease):
+            logger.warning(
+                f"{self.host} returned {status}, slow down to "
+                f"{self.limit} concurrent, {self.bucket.rate:.1f} req/s"
+            )
+
+    def on_congestion(self) -> None:
+        self.congested += 1
+        if self._decrease(self.config.congestion_decrease):
+            logger.debug(
+                f"{self.host} latency spike or connection error, slow down to "
+                f"{self.limit} concurrent, {self.bucket.rate:.1f} req/s"
+            )
+
+    def _decrease(self, factor: float) -> bool:
+        now = asyncio.get_running_loop().time()
+        if now - self.last_decrease < self.config.decrease_cooldown:
+            return False
+        self.last_decrease = now
+        self.concurrency = max(self.config.min_concurrency, self.concurrency * factor)
+        self.bucket.rate = max(self.config.min_rate, self.bucket.rate * factor)
+        return True
+
+    def summary(self) -> str:
+        return (
+            f"{self.host}: concurrency {self.limit}, {self.bucket.rate:.1f} req/s, "
+            f"successes {self.successes}, throttled {self.throttled}, "
+            f"congested {self.congested}"
+        )
+
+
+class RateSlot:
+    """
+    一次请求占用的名额, 收到响应头后调用observe反馈状态码和首字节时间,
+    请求结束(包括读完响应体)后调用release
+    """
+
+    def __init__(self, limiter: HostLimiter):
+        self.limiter = limiter
+        self.start_time = asyncio.get_running_loop().time()
+        self.observed = False
+        self.released = False
+
+    def observe(self, status: int) -> None:
+        if self.observed:
+            return
+        self.observed = True
+        if status in THROTTLE_STATUSES:
+            self.limiter.on_throttle(status)
+        elif status < 400:
+            self.limiter.on_success(asyncio.get_running_loop().time() - self.start_time)
+
+    def fail(self) -> None:
+        # 没有收到响应头就出错(连接失败/超时)
+        if not self.observed:
+            self.observed = True
+            self.limiter.on_congestion()
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self.limiter.release()
+
+
+@dataclass
+class RateController:
+    """
+    下载限流: 按池(small: 封面/图片, large: 视频/音乐)和域名分别限制每秒请求数和并发数,
+    每个域名的限制根据响应自动调整, 不需要手动调参
+    """
+
+    pool_configs: dict[str, PoolConfig] = field(
+        default_factory=lambda: dict(DEFAULT_POOL_CONFIGS)
+    )
+    limiters: dict[tuple[str, str], HostLimiter] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, config: dict[str, dict] | None = None) -> "RateController":
+        """config按池覆盖默认参数, 例如{"large": {"max_concurrency": 8}}"""
+        pool_configs = dict(DEFAULT_POOL_CONFIGS)
+        for pool, overrides in (config or {}).items():
+            assert pool in pool_configs, f"pool must be one of {set(pool_configs)}"
+            pool_configs[pool] = replace(pool_configs[pool], **overrides)
+        return cls(pool_configs=pool_configs)
+
+    @property
+    def max_host_concurrency(self) -> int:
+        """同一个域名上所有池加起来的最大并发数, 连接池的limit_per_host不能小于它"""
+        return sum(config.max_concurrency for config in self.pool_configs.values())
+
+    @staticmethod
+    def pool_for(file_path: str | Path) -> str:
+        return (
+            "small"
+            if Path(file_path).suffix.lower() in SMALL_FILE_SUFFIXES
+            else "large"
+        )
+
+    def limiter(self, url: str, pool: str) -> HostLimiter:
+        host = urlsplit(url).netloc
+        limiter = self.limiters.get((pool, host))
+        if limiter is None:
+            limiter = self.limiters[(pool, host)] = HostLimiter(
+                host, self.pool_configs[pool]
+            )
+        return limiter
+
+    async def acquire(self, url: str, pool: str) -> RateSlot:
+        limiter = self.limiter(url, pool)
+        await limiter.acquire()
+        return RateSlot(limiter)
+
+    @asynccontextmanager
+    async def slot(self, url: str, pool: str) -> AsyncIterator[RateSlot]:
+        rate_slot = await self.acquire(url, pool)
+        try:
+            yield rate_slot
+        except Exception:
+            rate_slot.fail()
+            raise
+        finally:
+            rate_slot.release()
+
+    def summary(self) -> str:
+        return "; ".join(
+            f"[{pool}] {limiter.summary()}"
+            for (pool, _), limiter in self.limiters.items()
+        )
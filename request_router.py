@@ -0,0 +1,164 @@
+import asyncio
+import re
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Iterable
+from playwright.async_api import Page, Request, Route
+from loguru import logger
+
+# 抓取作品数据不需要的资源类型
+DEFAULT_BLOCK_RESOURCE_TYPES = (
+    "image",
+    "media",
+    "font",
+    "websocket",
+    "eventsource",
+    "manifest",
+    "texttrack",
+    "ping",
+)
+
+# 静态资源CDN, 埋点/监控上报, 直播预加载
+DEFAULT_BLOCK_URL_PATTERNS = (
+    "lf-douyin-pc-web",
+    "If9-sec",
+    "bytetos",
+    "mcs.zijieapi.com",
+    "mon.zijieapi.com",
+    "mssdk.bytedance.com",
+    "slardar",
+    "/monitor_browser/",
+    "/web/report",
+    "webcast",
+    "live.douyin.com",
+    r"\.(?:woff2?|ttf|otf|mp4|m3u8|flv|webp|jpe?g|png|gif|avif)(?:\?|$)",
+)
+
+# 无论如何都放行的请求(作品数据接口和用户信息接口)
+DEFAULT_ALLOW_URL_PATTERNS = (
+    "aweme/v1/web/aweme/post",
+    "aweme/v1/web/user/profile",
+)
+
+
+def compile_url_patterns(patterns: Iterable[str]) -> re.Pattern | None:
+    """
+    多个规则合并成一个正则, 每个请求只需要匹配一次
+    纯文本规则按字面匹配, 含正则特殊字符的规则按正则匹配
+    """
+    parts = [
+        pattern if re.search(r"[\\()\[\]|?*+^$]", pattern) else re.escape(pattern)
+        for pattern in patterns
+    ]
+    return re.compile("|".join(f"(?:{part})" for part in parts)) if parts else None
+
+
+@dataclass
+class RequestStats:
+    """
+    被拦截的请求没有发出, 拿不到真实大小, 只能估算:
+    按同一资源类型放行请求的平均大小估算被拦截的字节数, 没有放行过的类型不计入估算;
+    需要准确的对比时, 用空的拦截规则抓取同一个主页得到基准的passed_bytes
+    """
+
+    passed_requests: int = 0
+    blocked_requests: int = 0
+    passed_bytes: int = 0
+    blocked_by_type: Counter = field(default_factory=Counter)
+    # 拿到了大小的放行请求, 按资源类型统计数量和字节数
+    sized_by_type: Counter = field(default_factory=Counter)
+    passed_bytes_by_type: Counter = field(default_factory=Counter)
+
+    def add_passed_size(self, resource_type: str, size: int) -> None:
+        self.passed_bytes += size
+        self.sized_by_type[resource_type] += 1
+        self.passed_bytes_by_type[resource_type] += size
+
+    def estimated_blocked_bytes(self) -> tuple[int, int]:
+        """返回(估算的拦截字节数, 无法估算的拦截请求数)"""
+        estimated = 0
+        unestimated = 0
+        for resource_type, count in self.blocked_by_type.items():
+            sized = self.sized_by_type[resource_type]
+            if sized:
+                estimated += count * self.passed_bytes_by_type[resource_type] // sized
+            else:
+                unestimated += count
+        return estimated, unestimated
+
+    def summary(self) -> str:
+        total = self.passed_requests + self.blocked_requests
+        blocked_bytes, unestimated = self.estimated_blocked_bytes()
+        return (
+            f"passed requests: {self.passed_requests}, blocked requests: {self.blocked_requests}"
+            f" ({self.blocked_requests / max(total, 1):.0%} of {total}), "
+            f"passed bytes: {self.passed_bytes / 1024 / 1024:.2f}MB, "
+            f"estimated blocked bytes: {blocked_bytes / 1024 / 1024:.2f}MB"
+            f" ({unestimated} blocked requests of unknown size), "
+            f"blocked by type: {dict(self.blocked_by_type)}"
+        )
+
+
+class RequestRouter:
+    """
+    页面的请求拦截规则, 一个页面只注册一个route处理函数
+    先看放行规则, 再按资源类型(集合查找)和url规则(预编译的一个正则)决定是否拦截,
+    同时统计放行/拦截的请求数, 放行的字节数和估算的拦截字节数(见RequestStats)
+    """
+
+    def __init__(
+        self,
+        block_resource_types: Iterable[str] = DEFAULT_BLOCK_RESOURCE_TYPES,
+        block_url_patterns: Iterable[str] = DEFAULT_BLOCK_URL_PATTERNS,
+        allow_url_patterns: Iterable[str] = DEFAULT_ALLOW_URL_PATTERNS,
+    ):
+        self.block_resource_types = frozenset(block_resource_types)
+        self.block_url_regex = compile_url_patterns(block_url_patterns)
+        self.allow_url_regex = compile_url_patterns(allow_url_patterns)
+        self.stats = RequestStats()
+        self._size_tasks: set[asyncio.Task] = set()
+
+    def should_block(self, url: str, resource_type: str) -> bool:
+        if self.allow_url_regex and self.allow_url_regex.search(url):
+            return False
+        if resource_type == "document":
+            return False
+        if resource_type in self.block_resource_types:
+            return True
+        return bool(self.block_url_regex and self.block_url_regex.search(url))
+
+    async def handle_route(self, route: Route, request: Request) -> None:
+        if self.should_block(request.url, request.resource_type):
+            self.stats.blocked_requests += 1
+            self.stats.blocked_by_type[request.resource_type] += 1
+            await route.abort()
+        else:
+            self.stats.passed_requests += 1
+            # 交给上下文的路由(录制/回放)继续处理, 没有其他路由时正常发出请求
+            await route.fallback()
+
+    async def _add_response_size(self, request: Request) -> None:
+        try:
+            sizes = await request.sizes()
+            self.stats.add_passed_size(
+                request.resource_type,
+                sizes["responseBodySize"] + sizes["responseHeadersSize"],
+            )
+        except Exception as e:
+            logger.debug(f"Failed to get request sizes: {e}")
+
+    def on_request_finished(self, request: Request) -> None:
+        task = asyncio.create_task(self._add_response_size(request))
+        self._size_tasks.add(task)
+        task.add_done_callback(self._size_tasks.discard)
+
+    async def attach(self, page: Page) -> None:
+        await page.route("**/*", self.handle_route)
+        page.on("requestfinished", self.on_request_finished)
+
+    async def detach(self, page: Page) -> None:
+        page.remove_listener("requestfinished", self.on_request_finished)
+        if not page.is_closed():
+            await page.unroute("**/*", self.handle_route)
+        if self._size_tasks:
+            await asyncio.gather(*self._size_tasks, return_exceptions=True)
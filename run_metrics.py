@@ -0,0 +1,404 @@
+import asyncio
+import json
+import time
+from bisect import bisect_left
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Awaitable, Callable
+import aiohttp
+from aiohttp import web
+from loguru import logger
+from tqdm import tqdm
+
+# 延迟直方图的桶(秒)
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+@dataclass
+class Histogram:
+    buckets: tuple[float, ...] = LATENCY_BUCKETS
+    counts: list[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1))
+    total: float = 0.0
+    count: int = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float | None:
+        """按桶估算分位数, 返回所在桶的上界"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for upper, count in zip((*self.buckets, float("inf")), self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return upper
+        return float("inf")
+
+    def to_dict(self) -> dict:
+        return {
+            "count": self.count,
+            "sum": round(self.total, 3),
+            "p50": self.quantile(0.5),
+            "p90": self.quantile(0.9),
+            "p99": self.quantile(0.99),
+            "buckets": dict(
+                zip([str(upper) for upper in (*self.buckets, "+Inf")], self.counts)
+            ),
+        }
+
+    def merge_dict(self, data: dict) -> None:
+        """累加另一个直方图to_dict()的结果(多进程下载时汇总各工作进程)"""
+        for index, count in enumerate(data.get("buckets", {}).values()):
+            self.counts[index] += count
+        self.total += data.get("sum", 0)
+        self.count += data.get("count", 0)
+
+    def prometheus(self, name: str, help_text: str) -> list[str]:
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for upper, count in zip((*self.buckets, "+Inf"), self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{le="{upper}"}} {cumulative}')
+        lines.append(f"{name}_sum {self.total}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+@dataclass
+class RunMetrics:
+    """
+    一次运行(抓取或下载)的汇总指标
+    字节数/文件数/正在下载数由下载流程更新, 请求延迟和各域名错误数由session的trace更新,
+    抓取时记录翻页数和用户数
+    """
+
+    name: str = "download"
+    started_at: float = field(default_factory=time.time)
+    bytes_downloaded: int = 0
+    files_completed: int = 0
+    files_failed: int = 0
+    files_skipped: int = 0
+    in_flight: int = 0
+    pages_crawled: int = 0
+    profiles_crawled: int = 0
+    # 首字节时间, 每个文件的总耗时
+    ttfb: Histogram = field(default_factory=Histogram)
+    file_time: Histogram = field(default_factory=Histogram)
+    retries_by_cause: Counter = field(default_factory=Counter)
+    host_requests: Counter = field(default_factory=Counter)
+    host_errors: Counter = field(default_factory=Counter)
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.time() - self.started_at, 1e-6)
+
+    def add_bytes(self, size: int) -> None:
+        self.bytes_downloaded += size
+
+    def file_started(self) -> float:
+        self.in_flight += 1
+        return time.monotonic()
+
+    def file_finished(self, start_time: float, status: str = "completed") -> None:
+        """status: completed / failed"""
+        self.in_flight -= 1
+        self.file_time.observe(time.monotonic() - start_time)
+        if status == "completed":
+            self.files_completed += 1
+        else:
+            self.files_failed += 1
+
+    def observe_response(self, host: str, status: int, ttfb: float) -> None:
+        self.host_requests[host] += 1
+        self.ttfb.observe(ttfb)
+        if status >= 400:
+            self.host_errors[host] += 1
+
+    def observe_request_error(self, host: str) -> None:
+        self.host_requests[host] += 1
+        self.host_errors[host] += 1
+
+    def page_crawled(self) -> None:
+        self.pages_crawled += 1
+
+    def snapshot(self) -> dict:
+        elapsed = self.elapsed
+        return {
+            "name": self.name,
+            "started_at": self.started_at,
+            "elapsed": round(elapsed, 3),
+            "bytes_downloaded": self.bytes_downloaded,
+            "bytes_per_second": round(self.bytes_downloaded / elapsed, 1),
+            "files_completed": self.files_completed,
+            "files_failed": self.files_failed,
+            "files_skipped": self.files_skipped,
+            "files_per_second": round(self.files_completed / elapsed, 3),
+            "in_flight": self.in_flight,
+            "pages_crawled": self.pages_crawled,
+            "pages_per_minute": round(self.pages_crawled * 60 / elapsed, 2),
+            "profiles_crawled": self.profiles_crawled,
+            "ttfb_seconds": self.ttfb.to_dict(),
+            "file_seconds": self.file_time.to_dict(),
+            "retries_by_cause": dict(self.retries_by_cause),
+            "hosts": {
+                host: {
+                    "requests": requests,
+                    "errors": self.host_errors[host],
+                    "error_rate": round(self.host_errors[host] / requests, 4),
+                }
+                for host, requests in self.host_requests.items()
+            },
+        }
+
+    def load_snapshots(self, snapshots: list[dict]) -> None:
+        """用各工作进程的snapshot()重新计算汇总指标, 开始时间取协调进程自己的"""
+        self.bytes_downloaded = sum(s["bytes_downloaded"] for s in snapshots)
+        self.files_completed = sum(s["files_completed"] for s in snapshots)
+        self.files_failed = sum(s["files_failed"] for s in snapshots)
+        self.files_skipped = sum(s["files_skipped"] for s in snapshots)
+        self.in_flight = sum(s["in_flight"] for s in snapshots)
+        self.ttfb, self.file_time = Histogram(), Histogram()
+        self.retries_by_cause = Counter()
+        self.host_requests, self.host_errors = Counter(), Counter()
+        for snapshot in snapshots:
+            self.ttfb.merge_dict(snapshot["ttfb_seconds"])
+            self.file_time.merge_dict(snapshot["file_seconds"])
+            self.retries_by_cause.update(snapshot["retries_by_cause"])
+            for host, stats in snapshot["hosts"].items():
+                self.host_requests[host] += stats["requests"]
+                self.host_errors[host] += stats["errors"]
+
+    def progress_text(self) -> str:
+        elapsed = self.elapsed
+        text = (
+            f"files {self.files_completed} ({self.files_completed / elapsed:.1f}/s), "
+            f"in flight {self.in_flight}, failed {self.files_failed}, "
+            f"skipped {self.files_skipped}, retries {sum(self.retries_by_cause.values())}"
+        )
+        if self.pages_crawled:
+            text += (
+                f", pages {self.pages_crawled} ({self.pages_crawled * 60 / elapsed:.1f}/min)"
+                f", profiles {self.profiles_crawled}"
+            )
+        return text
+
+    def to_prometheus(self) -> str:
+        prefix = f"douyin_{self.name}"
+        lines = []
+        for metric, value, help_text in (
+            ("bytes_total", self.bytes_downloaded, "Downloaded bytes"),
+            ("files_completed_total", self.files_completed, "Completed files"),
+            ("files_failed_total", self.files_failed, "Failed files"),
+            ("files_skipped_total", self.files_skipped, "Files skipped by manifest"),
+            ("pages_crawled_total", self.pages_crawled, "Crawled aweme pages"),
+            ("profiles_crawled_total", self.profiles_crawled, "Crawled profiles"),
+        ):
+            lines += [
+                f"# HELP {prefix}_{metric} {help_text}",
+                f"# TYPE {prefix}_{metric} counter",
+                f"{prefix}_{metric} {value}",
+            ]
+        lines += [
+            f"# HELP {prefix}_in_flight Files being downloaded",
+            f"# TYPE {prefix}_in_flight gauge",
+            f"{prefix}_in_flight {self.in_flight}",
+        ]
+        lines += self.ttfb.prometheus(
+            f"{prefix}_ttfb_seconds", "Time to first byte of requests"
+        )
+        lines += self.file_time.prometheus(
+            f"{prefix}_file_seconds", "Total time per downloaded file"
+        )
+        lines += [
+            f"# HELP {prefix}_retries_total Retries by cause",
+            f"# TYPE {prefix}_retries_total counter",
+        ]
+        lines += [
+            f'{prefix}_retries_total{{cause="{cause}"}} {count}'
+            for cause, count in self.retries_by_cause.items()
+        ]
+        lines += [
+            f"# HELP {prefix}_host_requests_total Requests by host",
+            f"# TYPE {prefix}_host_requests_total counter",
+        ]
+        lines += [
+            f'{prefix}_host_requests_total{{host="{host}"}} {count}'
+            for host, count in self.host_requests.items()
+        ]
+        lines += [
+            f"# HELP {prefix}_host_errors_total Failed requests by host",
+            f"# TYPE {prefix}_host_errors_total counter",
+        ]
+        lines += [
+            f'{prefix}_host_errors_total{{host="{host}"}} {count}'
+            for host, count in self.host_errors.items()
+        ]
+        return "\n".join(lines) + "\n"
+
+    def save_json(self, path: str | Path, snapshot: dict | None = None) -> None:
+        """
+        snapshot: 已经取好的snapshot(), 在线程中写文件时由事件循环先取好,
+        避免线程遍历计数字典时事件循环同时在修改
+        """
+        # 先写临时文件再替换, 仪表盘不会读到写了一半的文件
+        path = Path(path)
+        tmp_path = path.with_name(f"{path.name}.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                snapshot if snapshot is not None else self.snapshot(),
+                f,
+                indent=4,
+                ensure_ascii=False,
+            )
+        tmp_path.replace(path)
+
+
+def create_metrics_trace_config(metrics: RunMetrics) -> aiohttp.TraceConfig:
+    """记录每个请求的首字节时间和各域名的请求/错误数"""
+    trace_config = aiohttp.TraceConfig(trace_config_ctx_factory=SimpleNamespace)
+
+    async def on_request_start(session, ctx, params):
+        ctx.start_time = asyncio.get_running_loop().time()
+
+    async def on_request_end(session, ctx, params):
+        metrics.observe_response(
+            params.url.host or "",
+            params.response.status,
+            asyncio.get_running_loop().time() - ctx.start_time,
+        )
+
+    async def on_request_exception(session, ctx, params):
+        # 竞速镜像时被取消的请求不算错误
+        if not isinstance(params.exception, asyncio.CancelledError):
+            metrics.observe_request_error(params.url.host or "")
+
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+
+class FileProgress:
+    """代替单个文件的tqdm进度条, 只把字节数累加到汇总指标里"""
+
+    def __init__(self, metrics: RunMetrics, initial: int = 0):
+        self.metrics = metrics
+        self.n = initial
+
+    def update(self, size: int) -> None:
+        self.n += size
+        self.metrics.add_bytes(size)
+
+    def set_postfix_str(self, text: str) -> None:
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class MetricsReporter:
+    """
+    汇总进度显示和指标导出
+    每interval秒刷新一次唯一的进度条, 每export_interval秒把指标写到json_path,
+    prometheus_port不为None时在该端口提供/metrics(Prometheus文本格式);
+    多进程下载的工作进程不显示进度条(show_progress=False), 由publish把snapshot上报给协调进程
+    """
+
+    def __init__(
+        self,
+        metrics: RunMetrics,
+        json_path: str | Path | None = None,
+        interval: float = 1.0,
+        export_interval: float = 5.0,
+        prometheus_port: int | None = None,
+        show_progress: bool = True,
+        publish: Callable[[dict], Awaitable[None]] | None = None,
+    ):
+        self.metrics = metrics
+        self.json_path = Path(json_path) if json_path is not None else None
+        self.interval = interval
+        self.export_interval = export_interval
+        self.prometheus_port = prometheus_port
+        self.show_progress = show_progress
+        self.publish = publish
+        self.bar: tqdm | None = None
+        self._task: asyncio.Task | None = None
+        self._runner: web.AppRunner | None = None
+        self._last_export = 0.0
+
+    async def handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(
+            text=self.metrics.to_prometheus(), content_type="text/plain"
+        )
+
+    async def start(self) -> None:
+        if self.show_progress:
+            self.bar = tqdm(
+                desc=self.metrics.name,
+                unit="iB",
+                unit_scale=True,
+                unit_divisor=1024,
+                smoothing=0.1,
+                colour="green",
+            )
+        if self.prometheus_port is not None:
+            app = web.Application()
+            app.router.add_get("/metrics", self.handle_metrics)
+            self._runner = web.AppRunner(app, access_log=None)
+            await self._runner.setup()
+            await web.TCPSite(self._runner, port=self.prometheus_port).start()
+            logger.info(
+                f"prometheus metrics: http://localhost:{self.prometheus_port}/metrics"
+            )
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.report()
+
+    async def report(self, force_export: bool = False) -> None:
+        if self.bar is not None:
+            self.bar.update(self.metrics.bytes_downloaded - self.bar.n)
+            self.bar.set_postfix_str(self.metrics.progress_text())
+        now = time.monotonic()
+        if not force_export and now - self._last_export < self.export_interval:
+            return
+        self._last_export = now
+        # 在事件循环中取快照, 线程中只写文件
+        snapshot = self.metrics.snapshot()
+        if self.publish is not None:
+            await self.publish(snapshot)
+        if self.json_path is not None:
+            try:
+                await asyncio.to_thread(
+                    self.metrics.save_json, self.json_path, snapshot
+                )
+            except OSError as e:
+                logger.warning(f"Failed to save metrics to {self.json_path}: {e}")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+            await self.report(force_export=True)
+        if self.bar is not None:
+            self.bar.close()
+            self.bar = None
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self) -> "MetricsReporter":
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.stop()
@@ -1,39 +1,43 @@
 from rich.console import Console
 from functools import wraps
-from pathlib import Path
-import aiohttp
 import asyncio
-import random
-from loguru import logger
 from typing import Any, Callable, Coroutine
 from useful_tools import read_statejson_and_get_cookie_headers
+from download_errors import (
+    DownloadFailedError,
+    DownloadFailure,
+    RetryBudget,
+    backoff_delay,
+    classify_exception,
+)
 
 console = Console()
 
 
-def semaphore_decorator(semaphore: asyncio.Semaphore = asyncio.Semaphore(10)):
-    def semaphore_decorator_wrapper(func):
-        async def wrapper(*args, **kwargs):
-            async with semaphore:
-                return await func(*args, **kwargs)
-
-        return wrapper
-
-    return semaphore_decorator_wrapper
-
-
 def async_download_retry_decorator(
     retry_times: int = 10,
-    sleep_interval_min: int = 1,
-    sleep_interval_max: int = 2,
+    sleep_interval_min: float = 1,
+    sleep_interval_max: float = 60,
     reset_session_interval: int = 2,
 ) -> Callable[..., Coroutine[Any, Any, Any]]:
+    """
+    下载重试
+    错误分为不可重试(404/410, 不是媒体文件等, 直接失败)和临时错误(超时/断开/429/5xx等);
+    临时错误按指数退避重试: 第i次等待约 sleep_interval_min * 2**i 秒(带随机抖动),
+    最多sleep_interval_max秒, 服务器返回Retry-After时至少等待这么久.
+    被装饰的函数可以额外传入retry_budget(RetryBudget), 整个运行共用一个重试预算.
+    最终失败时抛出DownloadFailedError, 其中的failure是结构化的失败信息
+    """
+
     def wrapper2(
         func: Callable[..., Coroutine[Any, Any, Any]]
     ) -> Callable[..., Coroutine[Any, Any, Any]]:
         @wraps(func)
         async def wrapper(*args: Any, **kwargs: Any) -> Any:
-            last_exception = None
+            # 重试预算只给装饰器用, 不传给被装饰的函数
+            retry_budget: RetryBudget | None = kwargs.pop("retry_budget", None)
+            if retry_budget is not None:
+                retry_budget.record_attempt()
 
             for i in range(retry_times):
                 try:
@@ -44,24 +48,33 @@ def async_download_retry_decorator(
                     )
                     raise e
                 except Exception as e:
-                    last_exception = e
+                    retryable, status, retry_after = classify_exception(e)
                     console.print(
                         f"\nError type: {type(e)}: {str(e)}\n", style="bold red"
                     )
-                    console.print(
-                        f"\nRetrying {func.__name__} for the {i+1}/{retry_times} time\n",
-                        style="bold yellow",
+                    if not retryable:
+                        reason = "permanent"
+                    elif i + 1 >= retry_times:
+                        reason = "retries_exhausted"
+                    elif retry_budget is not None and not retry_budget.try_spend(
+                        str(status) if status else type(e).__name__
+                    ):
+                        reason = "budget_exhausted"
+                    else:
+                        console.print(
+                            f"\nRetrying {func.__name__} for the {i+1}/{retry_times} time\n",
+                            style="bold yellow",
+                        )
+                        await asyncio.sleep(
+                            backoff_delay(
+                                i, sleep_interval_min, sleep_interval_max, retry_after
+                            )
+                        )
+                        continue
+                    failure = handle_retry_limit(
+                        args, kwargs, func.__name__, e, reason, status, i + 1
                     )
-                    await asyncio.sleep(
-                        random.randint(sleep_interval_min, sleep_interval_max)
-                    )
-
-                    # if (i + 1) % reset_session_interval == 0:
-                    # await reset_session(kwargs, func.__name__)
-
-            await handle_retry_limit(kwargs, func.__name__, last_exception)
-
-            return 0
+                    raise DownloadFailedError(failure) from e
 
         return wrapper
 
@@ -86,9 +99,15 @@ def async_download_retry_decorator(
 #         console.print(f"\n{func_name} session has been reset\n", style="bold green")
 
 
-async def handle_retry_limit(
-    kwargs: dict, func_name: str, last_exception: Exception
-) -> None:
+def handle_retry_limit(
+    args: tuple,
+    kwargs: dict,
+    func_name: str,
+    last_exception: Exception,
+    reason: str,
+    status: int | None,
+    attempts: int,
+) -> DownloadFailure:
     # if "file_save_path" in kwargs and isinstance(kwargs["file_save_path"], (str, Path)):
     #     file_path = (
     #         Path(kwargs["file_save_path"])
@@ -99,15 +118,25 @@ async def handle_retry_limit(
     #         logger.error(f"Deleting {file_path.name} because of reached retry limit")
     #         file_path.unlink()
 
-    if (
-        "session" in kwargs
-        and isinstance(kwargs["session"], aiohttp.ClientSession)
-        # and not kwargs["session"].closed
-    ):
-        await kwargs["session"].close()
-        console.print(f"\n{func_name} session has been closed\n", style="bold green")
-
+    # session由调用方(download_main)统一管理, 单个文件失败不能关闭共享的session
+
+    # 下载函数的第一个参数是url(或镜像url列表)
+    url = kwargs.get("url", kwargs.get("urls", args[0] if args else None))
+    if isinstance(url, list):
+        url = url[0] if url else None
+    file_save_path = kwargs.get("file_save_path")
+    failure = DownloadFailure(
+        func_name=func_name,
+        url=url if isinstance(url, str) else None,
+        file_save_path=str(file_save_path) if file_save_path is not None else None,
+        reason=reason,
+        error_type=type(last_exception).__name__,
+        message=str(last_exception),
+        status=status,
+        attempts=attempts,
+    )
     console.print(
-        f"\nRetry limit reached for {func_name}: {str(last_exception)}\n",
+        f"\nGive up {func_name} ({reason}) after {attempts} attempts: {str(last_exception)}\n",
         style="bold red",
     )
+    return failure
@@ -1,6 +1,7 @@
 import re
 from pathlib import Path
 import json
+from typing import Any, Iterator, TextIO
 
 
 def sanitize_filename(filename: str):
@@ -47,3 +48,50 @@ def read_statejson_and_get_cookie_headers(
         if item["name"]
     }
     return cookies, headers
+
+
+def iter_json_array_items(file: TextIO, chunk_size: int = 1024 * 1024) -> Iterator[Any]:
+    """
+    逐个读取json文件顶层数组中的元素, 不把整个文件读入内存
+    内存占用只和单个元素的大小有关, 和文件大小无关
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+
+    def fill() -> bool:
+        nonlocal buffer, pos, eof
+        chunk = file.read(chunk_size)
+        if not chunk:
+            eof = True
+            return False
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        return True
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            if not fill():
+                break
+            continue
+        if not started:
+            assert buffer[pos] == "[", "json file must be an array"
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # 元素还没有读完整
+            if eof or not fill():
+                raise
+            continue
+        pos = end
+        yield item
+    assert not started, "unexpected end of json array"
@@ -0,0 +1,242 @@
+import re
+from itertools import accumulate
+from dataclasses import dataclass, field, replace
+from typing import Iterable
+from loguru import logger
+
+# gear_name例如"normal_720_0", "adapt_lowest_1080_1", 没有宽高时从中取分辨率
+GEAR_RESOLUTION_PATTERN = re.compile(r"_(\d{3,4})_")
+
+
+@dataclass
+class VideoVariant:
+    """video.bit_rate中的一个清晰度/码率版本"""
+
+    url_list: list[str]
+    gear_name: str = ""
+    bit_rate: int = 0
+    width: int = 0
+    height: int = 0
+    # 声明的文件大小, 没有时为0
+    data_size: int = 0
+    is_h265: bool = False
+    # 作品时长(毫秒), 用来在没有data_size时按码率估算大小
+    duration: int = 0
+
+    @property
+    def resolution(self) -> int:
+        """短边像素数, 竖屏720x1280和横屏1280x720都是720(720p)"""
+        sides = [side for side in (self.width, self.height) if side]
+        if sides:
+            return min(sides)
+        match = GEAR_RESOLUTION_PATTERN.search(f"_{self.gear_name}_")
+        return int(match.group(1)) if match else 0
+
+    @property
+    def estimated_size(self) -> int:
+        return self.data_size or self.bit_rate * self.duration // 8000
+
+
+def parse_variants(data: dict) -> list[VideoVariant]:
+    """
+    取出作品的所有视频版本; 没有bit_rate时把play_addr当作唯一的版本
+    url_list中的地址是同一个版本的不同镜像
+    """
+    video = data.get("video") or {}
+    duration = int(video.get("duration") or 0)
+    variants = []
+    for item in video.get("bit_rate") or []:
+        play_addr = item.get("play_addr") or {}
+        url_list = [
+            url
+            for url in play_addr.get("url_list") or []
+            if url and isinstance(url, str) and url.startswith("http")
+        ]
+        if url_list:
+            variants.append(
+                VideoVariant(
+                    url_list,
+                    gear_name=item.get("gear_name") or "",
+                    bit_rate=int(item.get("bit_rate") or 0),
+                    width=int(play_addr.get("width") or 0),
+                    height=int(play_addr.get("height") or 0),
+                    data_size=int(play_addr.get("data_size") or 0),
+                    is_h265=bool(item.get("is_h265") or item.get("is_bytevc1")),
+                    duration=duration,
+                )
+            )
+    if not variants:
+        play_addr = video.get("play_addr") or {}
+        url_list = [
+            url
+            for url in play_addr.get("url_list") or []
+            if url and isinstance(url, str) and url.startswith("http")
+        ]
+        if url_list:
+            variants.append(
+                VideoVariant(
+                    url_list,
+                    width=int(play_addr.get("width") or video.get("width") or 0),
+                    height=int(play_addr.get("height") or video.get("height") or 0),
+                    data_size=int(play_addr.get("data_size") or 0),
+                    duration=duration,
+                )
+            )
+    return variants
+
+
+@dataclass
+class VariantPolicy:
+    """
+    视频版本选择策略, 不满足的条件为None
+    max_resolution: 短边最大像素数, 720表示最高720p
+    max_bit_rate: 最大码率(bps)
+    max_size: 单个视频的最大字节数
+    allow_h265: 为False时不选择h265/bytevc1编码的版本(播放器不支持时)
+    budget: 整次运行所有视频的总字节数, 估算的总大小超过预算时自动降低max_resolution,
+    最低的清晰度也超过预算时, 预算用完后的作品不再下载视频;
+    没有一个版本满足条件的作品不下载视频
+    """
+
+    max_resolution: int | None = None
+    max_bit_rate: int | None = None
+    max_size: int | None = None
+    allow_h265: bool = True
+    budget: int | None = None
+
+    def allows(self, variant: VideoVariant) -> bool:
+        return not (
+            (
+                self.max_resolution is not None
+                and variant.resolution > self.max_resolution
+            )
+            or (self.max_bit_rate is not None and variant.bit_rate > self.max_bit_rate)
+            or (self.max_size is not None and variant.estimated_size > self.max_size)
+            or (not self.allow_h265 and variant.is_h265)
+        )
+
+    def select(self, variants: list[VideoVariant]) -> VideoVariant | None:
+        """
+        满足条件的版本中分辨率最高的, 同样分辨率时选最小的(通常是h265或者低码率的版本);
+        都不满足时返回None
+        """
+        candidates = [variant for variant in variants if self.allows(variant)]
+        if not candidates:
+            return None
+        best_resolution = max(variant.resolution for variant in candidates)
+        return min(
+            (v for v in candidates if v.resolution == best_resolution),
+            key=lambda v: (v.estimated_size, v.bit_rate),
+        )
+
+
+@dataclass
+class VariantPlanner:
+    """
+    为一次运行中的所有作品选择视频版本
+    plan()在开始下载前用声明的大小估算总传输量, 有预算时选择不超过预算的最高清晰度;
+    choose()在生成下载任务时调用, 累计已选择的大小, 超过预算或者没有满足条件的版本时返回None
+    """
+
+    policy: VariantPolicy
+    planned_bytes: int = 0
+    selected: int = 0
+    over_budget: int = 0
+    unsatisfied: int = 0
+    resolution_counts: dict[int, int] = field(default_factory=dict)
+
+    @classmethod
+    def from_config(cls, config: dict | None) -> "VariantPlanner | None":
+        """config是VariantPolicy的参数, 例如{"max_resolution": 720, "budget": 50 * 1024**3}"""
+        return cls(VariantPolicy(**config)) if config else None
+
+    def plan(self, datas: Iterable[dict]) -> int:
+        """返回估算的总字节数, datas只遍历一次, 不保存作品数据"""
+        # 一个作品选择的大小只在它自己的版本分辨率处随清晰度上限变化,
+        # 记录每个分辨率处总大小的变化量, 任意上限下的总大小就是不超过它的变化量之和
+        size_deltas: dict[int, int] = {}
+        aweme_count = 0
+        for data in datas:
+            aweme_count += 1
+            variants = parse_variants(data)
+            previous_size = 0
+            for resolution in sorted(
+                {
+                    variant.resolution
+                    for variant in variants
+                    if self.policy.max_resolution is None
+                    or variant.resolution <= self.policy.max_resolution
+                }
+            ):
+                variant = replace(self.policy, max_resolution=resolution).select(
+                    variants
+                )
+                size = variant.estimated_size if variant is not None else 0
+                size_deltas[resolution] = (
+                    size_deltas.get(resolution, 0) + size - previous_size
+                )
+                previous_size = size
+        resolutions = sorted(size_deltas)
+        totals = dict(zip(resolutions, accumulate(size_deltas[r] for r in resolutions)))
+        estimated = totals[resolutions[-1]] if resolutions else 0
+        if self.policy.budget is not None and estimated > self.policy.budget:
+            # 从高到低依次尝试更低的清晰度上限, 直到估算的总大小不超过预算
+            for resolution in reversed(resolutions[:-1]):
+                self.policy = replace(self.policy, max_resolution=resolution)
+                estimated = totals[resolution]
+                if estimated <= self.policy.budget:
+                    break
+            logger.warning(
+                f"video budget {format_size(self.policy.budget)}: "
+                f"max resolution lowered to {self.policy.max_resolution}p"
+                + (
+                    ", still over budget, later awemes will be skipped"
+                    if estimated > self.policy.budget
+                    else ""
+                )
+            )
+        logger.info(
+            f"estimated video transfer: {format_size(estimated)} "
+            f"for {aweme_count} awemes ({self.policy})"
+        )
+        return estimated
+
+    def choose(self, data: dict) -> VideoVariant | None:
+        variants = parse_variants(data)
+        variant = self.policy.select(variants)
+        if variant is None:
+            if variants:
+                self.unsatisfied += 1
+                logger.info(
+                    f"no video variant of {data.get('aweme_id')} satisfies "
+                    f"{self.policy}, skip the video"
+                )
+            return None
+        size = variant.estimated_size
+        if self.policy.budget is not None and self.planned_bytes + size > (
+            self.policy.budget
+        ):
+            self.over_budget += 1
+            return None
+        self.planned_bytes += size
+        self.selected += 1
+        self.resolution_counts[variant.resolution] = (
+            self.resolution_counts.get(variant.resolution, 0) + 1
+        )
+        return variant
+
+    def summary(self) -> str:
+        resolutions = ", ".join(
+            f"{f'{resolution}p' if resolution else 'unknown'}: {count}"
+            for resolution, count in sorted(self.resolution_counts.items())
+        )
+        return (
+            f"selected video variants: {self.selected} ({resolutions}), "
+            f"declared size: {format_size(self.planned_bytes)}, "
+            f"skipped over budget: {self.over_budget}, "
+            f"skipped without a satisfying variant: {self.unsatisfied}"
+        )
+
+
+def format_size(size: int) -> str:
+    return f"{size / 1024 / 1024:.2f}MB"